@@ -1,42 +1,167 @@
 #!/usr/bin/env python3
-"""MQTT <-> GPIO bridge for the Phase 1 tap irrigation valve (Venus).
+"""MQTT <-> GPIO bridge for the tap irrigation valves (Venus).
 
-The valve is a dumb on/off switch: HA holds all watering policy and just
-publishes ON/OFF. This bridge subscribes to the command topic and drives one
-GPIO pin (relay -> 24VAC -> Rain Bird XCZ solenoid). It publishes state and an
-availability topic (LWT) so HA can see when the bridge is offline.
+The valves are dumb on/off switches: HA holds all watering policy and just
+publishes ON/OFF. This bridge subscribes to the command topic(s) and drives
+one GPIO pin per zone (relay -> 24VAC -> Rain Bird XCZ solenoid). It publishes
+state and an availability topic (LWT) so HA can see when the bridge is offline.
+
+Single zone (Phase 1, default): topics under TOPIC_BASE, pin GPIO_PIN.
+Multi zone: ZONES="front:17,back:27:1800" (name:pin[:max_on_seconds]) drives
+all zones from one process and one gpiochip handle. Topics are
+TOPIC_PREFIX/<zone>/{set,state,availability}, commands arrive through one
+wildcard subscription TOPIC_PREFIX/+/set, and the LWT is
+TOPIC_PREFIX/availability. At most MAX_OPEN zones are open at once (water
+pressure, 24VAC transformer load); an ON beyond that is refused and the zone
+reports OFF.
 
 Fail-safe by design -- the valve is closed:
   * at startup,
   * on SIGTERM / SIGINT,
-  * on MQTT disconnect (we can no longer receive an OFF),
-  * automatically after MAX_ON_SECONDS (watchdog) so a missed OFF or a crashed
-    scheduler can never flood the garden.
+  * on MQTT disconnect (we can no longer receive an OFF) -- except the zone
+    of a running plan, whose close the bridge schedules itself,
+  * automatically after MAX_ON_SECONDS (watchdog, per zone) so a missed OFF or
+    a crashed scheduler can never flood the garden.
+
+The watchdogs of all zones share one DeadlineScheduler thread (a heap of
+monotonic deadlines), so ON/OFF bursts re-arm a deadline instead of starting a
+thread per command.
+
+RUNTIME=asyncio runs the same bridge on an asyncio event loop instead of
+paho's network thread (AsyncBridge): commands are queued, GPIO writes run on
+an executor and publishes are tracked until their PUBACK.
+
+A command that matches the valve's current state is a no-op: no GPIO write,
+no watchdog re-arm, no state publish (retained replays on reconnect, chatty
+automations). With COALESCE_MS set, an ON waits that long and a burst of
+commands for a zone collapses to its final state; an OFF is never delayed and
+drops a pending ON.
+
+With JOURNAL_PATH set, every open, close, watchdog trip and fail-safe is
+appended to a JSON-lines journal, written and fsynced in batches by a
+background thread (JOURNAL_FLUSH_S) so the SD card sees few writes and no
+valve action ever waits for the disk. The file rotates at JOURNAL_MAX_BYTES,
+each new file starting with a totals snapshot. At startup the journal is
+replayed for per-zone run counts, water time and the last run, which are
+published retained on <zone topic>/stats.
+
+With FLOW_PIN set, pulses of a flow meter on that line are counted (lgpio
+edge callbacks) and published every FLOW_INTERVAL_S as rate and total on
+<base>/flow, not per pulse. A number of litres on <zone topic>/litres/set
+opens the zone and closes it once that much has flowed; flow while every
+valve is closed raises <base>/leak. The stub meter takes synthetic pulse
+trains ("HZ[:SECONDS]" on <base>/flow/inject).
+
+A run plan on <base>/plan/set ({"id": "evening", "steps": [{"zone": "front",
+"minutes": 10}, {"zone": "back", "minutes": 15}]}) runs on the bridge itself:
+each step opens its zone for its time on the bridge's monotonic scheduler,
+under the same watchdog and MAX_OPEN cap. The zone a plan is running is
+exempt from the disconnect fail-safe -- its close is already scheduled
+locally -- so a broker outage no longer kills the run. Progress events are
+buffered and published in one batch on <base>/plan/progress (at once while
+connected, on reconnect otherwise); <base>/plan/state holds the current plan
+(retained). CANCEL, or an OFF for the running zone, stops the plan.
+
+Cold start is logged phase by phase (imports, GPIO, broker lookup, TCP
+connect, CONNACK, first PUBACK). asyncio, the metrics server and the GPIO
+executor are imported only when used, BROKER_CACHE skips the DNS lookup on
+restart, and under systemd Type=notify the bridge reports READY=1 once HA
+sees it online (or after 10 s with valves closed if the broker is down).
+
+With METRICS_PORT set, GET /metrics serves Prometheus metrics: command ->
+GPIO write latency and PUBACK round-trip histograms, open seconds per zone,
+and counters for watchdog trips, disconnect fail-safes, ignored commands and
+reconnects.
 
 Config via environment variables (see the Ansible role defaults):
   MQTT_HOST       broker host             (default: mars.local)
   MQTT_PORT       broker port             (default: 1883)
+  MQTT_KEEPALIVE  keepalive seconds       (default: 30)
   TOPIC_BASE      topic prefix            (default: irrigation/tap)
   GPIO_BACKEND    real | stub             (default: stub)
   GPIO_CHIP       gpiochip number         (default: 0 -> /dev/gpiochip0)
   GPIO_PIN        BCM pin number          (default: 17)
   ACTIVE_HIGH     true | false            (default: true)
   MAX_ON_SECONDS  watchdog timeout, 0=off (default: 2400)
+  ZONES           name:pin[:max_on],...   (default: unset -> single zone)
+  TOPIC_PREFIX    multi-zone topic prefix (default: irrigation)
+  MAX_OPEN        zones open at once      (default: 1)
+  RUNTIME         thread | asyncio        (default: thread)
+  METRICS_PORT    Prometheus /metrics     (default: 0 -> off)
+  METRICS_HOST    metrics bind address    (default: 127.0.0.1)
+  COALESCE_MS     ON coalescing window    (default: 0 -> off)
+  JOURNAL_PATH    actuation journal file  (default: unset -> off)
+  JOURNAL_FLUSH_S journal fsync interval  (default: 60)
+  JOURNAL_MAX_BYTES rotate above this size (default: 1048576)
+  BROKER_CACHE    broker address cache    (default: unset -> resolve each start)
+  FLOW_PIN        flow meter BCM pin      (default: unset -> no meter)
+  FLOW_PULSES_PER_LITRE                   (default: 450, YF-S201)
+  FLOW_INTERVAL_S flow publish interval   (default: 10)
+  FLOW_LEAK_LITRES flow with all valves closed that raises the leak alarm
+                                          (default: 0.5)
+  FLOW_LEAK_GRACE_S drain time after a close, not a leak (default: 10)
 
 The 'stub' backend touches no hardware (just logs), so the whole MQTT/watchdog/
 fail-safe logic can be developed and tested on a laptop against the real broker
 with `mosquitto_pub`/`mosquitto_sub`. Switch to 'real' on Venus.
 """
-import logging
-import os
-import signal
-import sys
-import threading
+import time
+
+STARTED = time.monotonic()   # before the imports, which dominate a cold start
 
-import paho.mqtt.client as mqtt
+import bisect  # noqa: E402
+import collections  # noqa: E402
+import functools  # noqa: E402
+import heapq  # noqa: E402
+import importlib.util  # noqa: E402
+import itertools  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import signal  # noqa: E402
+import socket  # noqa: E402
+import sys  # noqa: E402
+import threading  # noqa: E402
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+
+def lazy_import(name):
+    """The module, executed on first attribute access (importlib LazyLoader).
+
+    asyncio costs more to import than the rest of the bridge together and is
+    only used by RUNTIME=asyncio.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+asyncio = lazy_import("asyncio")
+
+IMPORTED = time.monotonic()
 
 log = logging.getLogger("irrigation-tap")
 
+ON_PAYLOADS = ("ON", "1", "TRUE", "OPEN")
+OFF_PAYLOADS = ("OFF", "0", "FALSE", "CLOSE")
+
+# Asyncio runtime: PUBACK wait and reconnect backoff (seconds).
+PUBLISH_TIMEOUT_S = 5.0
+JOURNAL_BATCH = 512   # buffered records that wake the journal writer early
+RECONNECT_MIN_S = 1
+RECONNECT_MAX_S = 60
+READY_TIMEOUT_S = 10.0   # report ready to systemd even without a broker
+FLOW_TICK_S = 0.25       # volume limits and the leak watch are checked this often
+PLAN_MAX_STEPS = 64
+PLAN_EVENTS_MAX = 256    # progress events buffered through an outage
+UNACKED_MAX = 1024       # publishes awaiting a PUBACK that the metrics keep
+
 
 def env_bool(name, default):
     return os.environ.get(name, str(default)).strip().lower() in (
@@ -70,14 +195,16 @@ class StubValve(Valve):
 class RealValve(Valve):
     """Drives a relay via the lgpio character-device interface."""
 
-    def __init__(self, chip, pin, active_high):
+    def __init__(self, chip, pin, active_high, handle=None):
         import lgpio
 
         self._lgpio = lgpio
         self.pin = pin
         self.active = 1 if active_high else 0
         self.inactive = 0 if active_high else 1
-        self.handle = lgpio.gpiochip_open(chip)
+        # A shared handle (GpioChip) is closed by its owner, not per valve.
+        self.owns_handle = handle is None
+        self.handle = lgpio.gpiochip_open(chip) if handle is None else handle
         # Claim as output and start in the inactive (valve-closed) level.
         lgpio.gpio_claim_output(self.handle, pin, self.inactive)
         log.info(
@@ -96,36 +223,944 @@ class RealValve(Valve):
     def cleanup(self):
         try:
             self.close()
+            if self.owns_handle:
+                self._lgpio.gpiochip_close(self.handle)
+        except Exception:  # noqa: BLE001 - best effort on shutdown
+            pass
+
+
+class FlowMeter:
+    """Pulse count of a flow meter.
+
+    pulse() is the only writer (lgpio's callback thread, or one stub train)
+    and only ever increments, so readers need no lock: they snapshot
+    `pulses` and diff against their previous snapshot.
+    """
+
+    def __init__(self):
+        self.pulses = 0
+
+    def pulse(self, *args):
+        self.pulses += 1
+
+    def cleanup(self):
+        pass
+
+
+class StubFlowMeter(FlowMeter):
+    """No hardware: synthetic pulse trains through the same pulse() path."""
+
+    def __init__(self):
+        super().__init__()
+        self._train = None
+
+    def train(self, hz, seconds=None):
+        """Pulse at hz (0 = stop) for seconds (None = until stopped)."""
+        if self._train is not None:
+            self._train.set()
+        self._train = None
+        if hz <= 0:
+            return None
+        stop = self._train = threading.Event()
+        thread = threading.Thread(target=self._run_train, args=(hz, seconds, stop),
+                                  name="flow-stub", daemon=True)
+        thread.start()
+        return thread
+
+    def _run_train(self, hz, seconds, stop):
+        started = time.monotonic()
+        sent = 0
+        while not stop.is_set():
+            elapsed = time.monotonic() - started
+            if seconds is not None and elapsed >= seconds:
+                elapsed = seconds
+                stop.set()
+            for _ in range(int(elapsed * hz) - sent):
+                self.pulse()
+            sent = int(elapsed * hz)
+            stop.wait(0.01)
+
+    def cleanup(self):
+        self.train(0)
+
+
+class RealFlowMeter(FlowMeter):
+    """Counts rising edges of a flow meter's open-collector output (lgpio)."""
+
+    def __init__(self, chip, pin, handle=None):
+        import lgpio
+
+        super().__init__()
+        self._lgpio = lgpio
+        self.pin = pin
+        self.owns_handle = handle is None
+        self.handle = lgpio.gpiochip_open(chip) if handle is None else handle
+        lgpio.gpio_claim_alert(self.handle, pin, lgpio.RISING_EDGE, lgpio.SET_PULL_UP)
+        self.callback = lgpio.callback(self.handle, pin, lgpio.RISING_EDGE, self.pulse)
+        log.info("GPIO chip %d pin %d claimed for the flow meter", chip, pin)
+
+    def cleanup(self):
+        try:
+            self.callback.cancel()
+            self._lgpio.gpio_free(self.handle, self.pin)
+            if self.owns_handle:
+                self._lgpio.gpiochip_close(self.handle)
+        except Exception:  # noqa: BLE001 - best effort on shutdown
+            pass
+
+
+class GpioChip:
+    """One lgpio chip handle shared by the valves of all zones."""
+
+    def __init__(self, chip):
+        import lgpio
+
+        self._lgpio = lgpio
+        self.chip = chip
+        self.handle = lgpio.gpiochip_open(chip)
+
+    def valve(self, pin, active_high):
+        return RealValve(self.chip, pin, active_high, handle=self.handle)
+
+    def flow_meter(self, pin):
+        return RealFlowMeter(self.chip, pin, handle=self.handle)
+
+    def close(self):
+        try:
             self._lgpio.gpiochip_close(self.handle)
         except Exception:  # noqa: BLE001 - best effort on shutdown
             pass
 
 
-def make_valve():
+def make_valves(pins):
+    """{zone: Valve} for {zone: pin}, plus the GpioChip to close (or None)."""
     backend = os.environ.get("GPIO_BACKEND", "stub").strip().lower()
     if backend == "real":
-        chip = int(os.environ.get("GPIO_CHIP", "0"))
-        pin = int(os.environ.get("GPIO_PIN", "17"))
-        return RealValve(chip, pin, env_bool("ACTIVE_HIGH", True))
+        chip = GpioChip(int(os.environ.get("GPIO_CHIP", "0")))
+        active_high = env_bool("ACTIVE_HIGH", True)
+        return {name: chip.valve(pin, active_high) for name, pin in pins.items()}, chip
     log.info("Using STUB valve backend (no hardware)")
-    return StubValve()
+    return {name: StubValve() for name in pins}, None
+
+
+def make_flow_meter(pin, chip):
+    """The flow meter on pin: on the valves' chip, or a stub without one."""
+    if chip is not None:
+        return chip.flow_meter(pin)
+    log.info("Using STUB flow meter (synthetic pulses on <base>/flow/inject)")
+    return StubFlowMeter()
+
+
+def parse_zones(spec, default_max_on):
+    """'front:17,back:27:1800' -> [(name, pin, max_on_seconds), ...]."""
+    zones = []
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        parts = [p.strip() for p in item.split(":")]
+        if len(parts) not in (2, 3) or not parts[0]:
+            raise ValueError(f"bad zone {item!r}, expected name:pin[:max_on_seconds]")
+        name = parts[0]
+        if any(c in name for c in "/+#"):
+            raise ValueError(f"zone name {name!r} may not contain / + #")
+        if name == "plan":
+            raise ValueError("zone name 'plan' is reserved (TOPIC_PREFIX/plan/set)")
+        max_on = float(parts[2]) if len(parts) == 3 else default_max_on
+        zones.append((name, int(parts[1]), max_on))
+    names = [z[0] for z in zones]
+    pins = [z[1] for z in zones]
+    if not zones or len(set(names)) != len(names) or len(set(pins)) != len(pins):
+        raise ValueError(f"ZONES needs unique zone names and pins: {spec!r}")
+    return zones
+
+
+class Deadline:
+    """Handle of one scheduled call; cancel() is O(1) and idempotent."""
+
+    __slots__ = ("when", "fn", "cancelled", "_scheduler")
+
+    def __init__(self, scheduler, when, fn):
+        self._scheduler = scheduler
+        self.when = when
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self):
+        self._scheduler._discard(self)
+
+
+class DeadlineScheduler:
+    """Runs callbacks at monotonic deadlines from one thread.
+
+    Deadlines live in a heap: arming is O(log n), cancelling marks the handle
+    and the entry is dropped when it reaches the top (or when cancelled
+    entries make up half the heap, so toggling cannot grow it unbounded).
+    The thread starts with the first deadline and sleeps until the earliest
+    one; a callback runs outside the scheduler lock.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._cancelled = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap) - self._cancelled
+
+    def call_later(self, delay, fn):
+        with self._cond:
+            deadline = Deadline(self, self.clock() + delay, fn)
+            heapq.heappush(self._heap, (deadline.when, next(self._seq), deadline))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="deadline-scheduler", daemon=True
+                )
+                self._thread.start()
+            elif self._heap[0][2] is deadline:
+                self._cond.notify()   # new earliest deadline: wake up sooner
+            return deadline
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _discard(self, deadline):
+        with self._cond:
+            if deadline.cancelled:
+                return
+            deadline.cancelled = True
+            self._cancelled += 1
+            if self._cancelled > 32 and self._cancelled * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if not e[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _next_due(self):
+        """Pop the next due, live deadline; blocks. None once stopped."""
+        with self._cond:
+            while not self._stopped:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - self.clock()
+                if wait <= 0:
+                    deadline = heapq.heappop(self._heap)[2]
+                    deadline.cancelled = True   # fired; a late cancel() is a no-op
+                    return deadline
+                self._cond.wait(wait)
+            return None
+
+    def _run(self):
+        while True:
+            deadline = self._next_due()
+            if deadline is None:
+                return
+            try:
+                deadline.fn()
+            except Exception:  # noqa: BLE001 - keep the other deadlines running
+                log.exception("Scheduled callback failed")
+
+
+class Histogram:
+    """Prometheus histogram with one series per label value."""
+
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value=""):
+        with self.lock:
+            counts = self.series.setdefault(label_value, [0] * (len(self.buckets) + 2))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value   # sum; the total count is sum(counts[:-1])
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = {key: list(counts) for key, counts in self.series.items()}
+        for label_value, counts in sorted(series.items()):
+            base = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield f'{self.name}_bucket{{{base}le="{le}"}} {cumulative}'
+            labels = f"{{{base.rstrip(',')}}}" if base else ""
+            yield f"{self.name}_sum{labels} {counts[-1]:.6f}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def _put_bounded(pending, mid, t):
+    pending.pop(mid, None)     # mids wrap around at 65535
+    pending[mid] = t
+    while len(pending) > UNACKED_MAX:
+        del pending[next(iter(pending))]   # the oldest
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Metrics:
+    """Counters and histograms of one bridge, in Prometheus text format."""
+
+    def __init__(self):
+        self.command_latency = Histogram(
+            "irrigation_command_latency_seconds",
+            "MQTT command received to GPIO write done.", LATENCY_BUCKETS, "zone",
+        )
+        self.publish_ack = Histogram(
+            "irrigation_publish_ack_seconds",
+            "QoS 1 publish to PUBACK round trip.", LATENCY_BUCKETS,
+        )
+        self.watchdog_trips = collections.Counter()    # zone -> n
+        self.unknown_commands = collections.Counter()  # reason -> n
+        self.coalesced = collections.Counter()         # zone -> n
+        self.volume_closes = collections.Counter()     # zone -> n
+        self.leak_alarms = 0
+        self.plans = collections.Counter()             # final status -> n
+        self.failsafe_closes = 0
+        self.connects = 0
+        self.disconnects = 0
+        # Thread runtime: paho's network thread can deliver the PUBACK before
+        # publish() has returned the mid, so either side may come first.
+        self._sent = {}    # mid -> monotonic publish time, awaiting the PUBACK
+        self._early = {}   # mid -> monotonic PUBACK time, awaiting published()
+        self.lock = threading.Lock()
+
+    def command_done(self, zone, received):
+        if received is not None:
+            self.command_latency.observe(time.monotonic() - received, zone.name)
+
+    def published(self, info, sent):
+        """Record a publish stamped `sent` (taken before client.publish())."""
+        mid = getattr(info, "mid", None)
+        if mid is None:
+            return
+        with self.lock:
+            acked = self._early.pop(mid, None)
+            if acked is None:
+                _put_bounded(self._sent, mid, sent)
+        if acked is not None:
+            self.publish_ack.observe(acked - sent)
+
+    def acked(self, mid):
+        now = time.monotonic()
+        with self.lock:
+            sent = self._sent.pop(mid, None)
+            if sent is None:
+                _put_bounded(self._early, mid, now)
+        if sent is not None:
+            self.publish_ack.observe(now - sent)
+
+    def forget_unacked(self):
+        """Drop the pending publishes: after a disconnect a PUBACK may never come."""
+        with self.lock:
+            self._sent.clear()
+            self._early.clear()
+
+    def render(self, bridge):
+        now = time.monotonic()
+        lines = list(self.command_latency.lines()) + list(self.publish_ack.lines())
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value:.10g}")
+
+        zones = sorted(bridge.zones.values(), key=lambda z: z.name)
+        family("irrigation_zone_open", "gauge", "1 while the zone valve is open.",
+               [(f'{{zone="{z.name}"}}', int(z.is_open)) for z in zones])
+        family("irrigation_zone_open_seconds_total", "counter",
+               "Seconds the zone valve has been open.",
+               [(f'{{zone="{z.name}"}}', z.open_seconds(now)) for z in zones])
+        family("irrigation_valve_transitions_total", "counter",
+               "Valve state changes.",
+               [(f'{{zone="{z.name}",state="{state}"}}', z.transitions[state])
+                for z in zones for state in ("open", "closed")])
+        family("irrigation_commands_coalesced_total", "counter",
+               "Commands that caused no valve write (superseded or no change).",
+               [(f'{{zone="{z.name}"}}', self.coalesced[z.name]) for z in zones])
+        family("irrigation_watchdog_trips_total", "counter",
+               "Valves closed by the max-on watchdog.",
+               [(f'{{zone="{z.name}"}}', self.watchdog_trips[z.name]) for z in zones])
+        family("irrigation_failsafe_closes_total", "counter",
+               "Disconnects that closed all valves fail-safe.",
+               [("", self.failsafe_closes)])
+        family("irrigation_unknown_commands_total", "counter",
+               "Ignored commands (unknown zone or payload).",
+               [(f'{{reason="{r}"}}', self.unknown_commands[r]) for r in ("zone", "payload")])
+        family("irrigation_mqtt_reconnects_total", "counter",
+               "MQTT connections after the first one.",
+               [("", max(self.connects - 1, 0))])
+        family("irrigation_mqtt_disconnects_total", "counter",
+               "MQTT disconnects.", [("", self.disconnects)])
+        flow = bridge.flow
+        if flow is not None:
+            family("irrigation_flow_litres_total", "counter",
+                   "Litres through the flow meter since the bridge started.",
+                   [("", flow.litres(flow.meter.pulses))])
+            family("irrigation_flow_rate_litres_per_minute", "gauge",
+                   "Flow over the last publish interval.", [("", flow.rate_lpm)])
+            family("irrigation_leak", "gauge",
+                   "1 while flow is seen with every valve closed.", [("", int(flow.leak))])
+            family("irrigation_leak_alarms_total", "counter",
+                   "Leak alarms raised.", [("", self.leak_alarms)])
+            family("irrigation_volume_closes_total", "counter",
+                   "Valves closed by a litres limit.",
+                   [(f'{{zone="{z.name}"}}', self.volume_closes[z.name]) for z in zones])
+        family("irrigation_plans_total", "counter",
+               "Run plans by how they ended.",
+               [(f'{{status="{s}"}}', self.plans[s])
+                for s in ("done", "cancelled", "replaced", "aborted", "rejected")])
+        family("irrigation_startup_phase_seconds", "gauge",
+               "Cold-start phase durations (see StartupTimer).",
+               [(f'{{phase="{name}"}}', bridge.startup.phases[name])
+                for name in StartupTimer.PHASES if name in bridge.startup.phases])
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(bridge, host, port):
+    """Serve /metrics from a daemon thread; returns the server."""
+    # http.server is imported only when metrics are enabled (cold start).
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = self.server.bridge.metrics.render(self.server.bridge).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass   # scrapes every 15 s would drown the journal
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.bridge = bridge
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Serving metrics on http://%s:%d/metrics", host, server.server_address[1])
+    return server
+
+
+class JournalStats:
+    """Per-zone run count, water seconds and last run, folded from records.
+
+    Durations come from the close records (monotonic clock), so a wall clock
+    that jumps at boot (no RTC on the Pi) does not skew the totals.
+    """
+
+    def __init__(self):
+        self.zones = {}    # zone -> {"runs", "seconds", "litres", "last_run"}
+        self.open = {}     # zone -> wall time of the unclosed open
+        self.last_t = None
+
+    def zone(self, name):
+        return self.zones.setdefault(
+            name, {"runs": 0, "seconds": 0.0, "litres": 0.0, "last_run": None}
+        )
+
+    def apply(self, record):
+        ev, name, t = record.get("ev"), record.get("zone"), record.get("t")
+        self.last_t = t if t is not None else self.last_t
+        if ev == "totals":
+            self.zone(name).update(
+                {key: record[key] for key in ("runs", "seconds", "litres", "last_run")
+                 if key in record}
+            )
+        elif ev == "open":
+            self.open[name] = t
+        elif ev == "close" and name in self.open:
+            stats = self.zone(name)
+            stats["runs"] += 1
+            stats["seconds"] += record.get("s", 0.0)
+            stats["litres"] += record.get("l", 0.0)
+            stats["last_run"] = {"start": self.open.pop(name), "end": t,
+                                 "seconds": record.get("s", 0.0),
+                                 "reason": record.get("reason", "")}
+            if "l" in record:
+                stats["last_run"]["litres"] = record["l"]
+
+    def unclosed(self):
+        """Close records for runs a crash left open, ending at the last record.
+
+        The valve closed when the process died (the pin is released); how
+        much later than the last record is unknown, so this is a lower bound.
+        """
+        return [{"t": self.last_t, "ev": "close", "zone": name,
+                 "s": round(max(self.last_t - opened, 0.0), 3), "reason": "bridge restart"}
+                for name, opened in sorted(self.open.items())]
+
+    def snapshot(self, t):
+        """Records that replay to the current state: the runs still open
+        (first, so the snapshot time stays the last time seen), then totals."""
+        opened = [{"t": opened, "ev": "open", "zone": name}
+                  for name, opened in sorted(self.open.items())]
+        return opened + [dict(t=t, ev="totals", zone=name, **stats)
+                         for name, stats in sorted(self.zones.items())]
+
+
+class Journal:
+    """Append-only JSON-lines actuation journal, fsynced in batches.
+
+    record() only appends to a buffer and never touches the disk, so it is
+    safe on the close path. A writer thread writes, flushes and fsyncs the
+    buffer every flush_s seconds (sooner once JOURNAL_BATCH records or an
+    urgent record are waiting). Above max_bytes the file rotates to .1 .. .keep
+    and the new file starts with a snapshot (the open records of runs still
+    in progress and the totals), so replaying the current file alone gives
+    the full statistics, and a close after the rotation finds its open.
+    """
+
+    def __init__(self, path, flush_s=60.0, max_bytes=1 << 20, keep=3, clock=time.time):
+        self.path = path
+        self.flush_s = flush_s
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.clock = clock
+        self.buffer = []
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.stats = JournalStats()
+        for record in self._read():
+            self.stats.apply(record)
+        for record in self.stats.unclosed():
+            log.warning("Journal: %s was open when the bridge stopped; counting %.0fs",
+                        record["zone"], record["s"])
+            self.record(record.pop("ev"), **record)
+        self.record("start")
+        self.file = None
+        self.thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        """Records of the current file (or of .1 if a rotation was cut short)."""
+        for path in (self.path, f"{self.path}.1"):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass   # a line torn by a power cut
+            return records
+        return []
+
+    def record(self, ev, zone=None, urgent=False, **fields):
+        t = fields.pop("t", None)
+        record = {"t": round(self.clock() if t is None else t, 3), "ev": ev}
+        if zone is not None:
+            record["zone"] = zone
+        record.update(fields)
+        with self.cond:
+            self.stats.apply(record)
+            self.buffer.append(record)
+            if urgent or len(self.buffer) >= JOURNAL_BATCH:
+                self.cond.notify()
+
+    def zone_stats(self, name):
+        with self.cond:
+            return dict(self.stats.zone(name))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.stopped and len(self.buffer) < JOURNAL_BATCH:
+                    self.cond.wait(self.flush_s)
+                stopped = self.stopped
+            try:
+                self.flush()
+            except OSError as exc:
+                log.error("Journal write to %s failed: %s", self.path, exc)
+            if stopped:
+                return
+
+    def flush(self):
+        with self.cond:
+            records, self.buffer = self.buffer, []
+            snapshot = self.stats.snapshot(round(self.clock(), 3))
+        if not records:
+            return
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write("".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.file.tell() >= self.max_bytes:
+            self._rotate(snapshot)
+
+    def _rotate(self, snapshot):
+        self.file.close()
+        for i in range(self.keep - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write("".join(json.dumps(r, separators=(",", ":")) + "\n" for r in snapshot))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """Write what is buffered and stop the writer."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class StartupTimer:
+    """Durations of the cold-start phases, each measured from the previous one.
+
+    imports: the module's imports; gpio: bridge set up, pins claimed
+    and valves closed; dns: broker address (cache or lookup); connect: TCP
+    socket open; connack: MQTT session up; publish: first PUBACK (HA sees the
+    bridge online). Only the first occurrence of each phase counts.
+    """
+
+    PHASES = ("imports", "gpio", "dns", "connect", "connack", "publish")
+
+    def __init__(self, started=STARTED):
+        self.started = started
+        self.last = started
+        self.phases = {}
+
+    def mark(self, phase, now=None):
+        if phase in self.phases:
+            return
+        now = time.monotonic() if now is None else now
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def done(self):
+        return "publish" in self.phases
+
+    def summary(self):
+        parts = [f"{name} {self.phases[name] * 1000:.0f}ms"
+                 for name in self.PHASES if name in self.phases]
+        return ", ".join(parts) + f"; total {(self.last - self.started) * 1000:.0f}ms"
+
+
+class BrokerAddress:
+    """The broker's IP, cached in a file so a restart skips the DNS lookup.
+
+    A cached address is tried first; when connecting fails, resolve() looks
+    the name up again and rewrites the cache if the address changed.
+    """
+
+    def __init__(self, host, port, cache_path=""):
+        self.host = host
+        self.port = port
+        self.cache_path = cache_path
+
+    def cached(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("host") == self.host and entry.get("port") == self.port:
+            return entry.get("ip")
+        return None
+
+    def resolve(self):
+        """A fresh IP for host (cached), or None if the lookup failed."""
+        try:
+            infos = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        except OSError as exc:
+            log.warning("Cannot resolve broker %s: %s", self.host, exc)
+            return None
+        ip = infos[0][4][0]
+        if self.cache_path and ip != self.cached():
+            try:
+                tmp = f"{self.cache_path}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"host": self.host, "port": self.port, "ip": ip}, f)
+                os.replace(tmp, self.cache_path)
+            except OSError as exc:
+                log.warning("Cannot cache broker address in %s: %s", self.cache_path, exc)
+        return ip
+
+    def lookup(self):
+        """(address to connect to, "cache" | "dns" | "none")."""
+        ip = self.cached()
+        if ip:
+            return ip, "cache"
+        ip = self.resolve()
+        if ip:
+            return ip, "dns"
+        return self.host, "none"   # let paho retry the name itself
+
+
+def sd_notify(state):
+    """Send a state (e.g. "READY=1") to systemd when run as Type=notify."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        address = "\0" + address[1:]   # abstract namespace
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError as exc:
+        log.warning("sd_notify failed: %s", exc)
+        return False
+    return True
+
+
+class Flow:
+    """The bridge's flow meter: pulses -> litres, rate, leak watch, topics."""
+
+    def __init__(self, meter, topic_base, pulses_per_litre, interval, leak_litres, leak_grace):
+        self.meter = meter
+        self.pulses_per_litre = pulses_per_litre
+        self.interval = interval
+        self.leak_pulses = max(int(leak_litres * pulses_per_litre), 1)
+        self.leak_grace = leak_grace
+        self.t_flow = f"{topic_base}/flow"
+        self.t_leak = f"{topic_base}/leak"
+        self.t_inject = f"{topic_base}/flow/inject"
+        self.timer = None
+        self.leak = False
+        self.leak_base = 0            # pulses when the valves were last open
+        self.last_open = float("-inf")
+        self.sampled = (time.monotonic(), 0)   # (time, pulses) of the last publish
+        self.published = None          # payload of the last flow publish
+        self.rate_lpm = 0.0
+
+    def litres(self, pulses):
+        return pulses / self.pulses_per_litre
+
+
+class Zone:
+    """One valve with its own topics, state and watchdog limit."""
+
+    def __init__(self, name, valve, topic_base, max_on):
+        self.name = name
+        self.valve = valve
+        self.max_on = max_on
+        self.t_set = f"{topic_base}/set"
+        self.t_state = f"{topic_base}/state"
+        self.t_avail = f"{topic_base}/availability"
+        self.t_stats = f"{topic_base}/stats"
+        self.t_litres = f"{topic_base}/litres/set"
+        self.is_open = False
+        self.timer = None
+        self.run = 0   # bumped on every open; a stale watchdog trip is ignored
+        self.opened_at = None
+        self.closed_seconds = 0.0   # open time of the completed runs
+        self.transitions = collections.Counter()   # "open"/"closed" -> n
+        self.pending = None         # deferred ON (COALESCE_MS)
+        self.pending_received = None
+        self.burst = 0              # bumped per deferred ON; a stale flush is ignored
+        self.journal = None
+        self.flow = None
+        self.plan = None            # the Plan running this zone, if any
+        self.open_pulses = 0
+        self.limit_pulses = None    # meter count at which to close ("litres")
+
+    def mark(self, is_open, reason=""):
+        """Set is_open; a change is logged, counted and its open time accounted."""
+        if is_open == self.is_open:
+            return
+        now = time.monotonic()
+        pulses = self.flow.meter.pulses if self.flow is not None else 0
+        if is_open:
+            self.opened_at = now
+            self.open_pulses = pulses
+            if self.journal is not None:
+                self.journal.record("open", self.name, reason=reason)
+        else:
+            self.closed_seconds += now - self.opened_at
+            self.limit_pulses = None
+            if self.journal is not None:
+                fields = {"s": round(now - self.opened_at, 3), "reason": reason}
+                if self.flow is not None:
+                    fields["l"] = round(self.flow.litres(pulses - self.open_pulses), 2)
+                self.journal.record("close", self.name, **fields)
+        self.is_open = is_open
+        state = "open" if is_open else "closed"
+        self.transitions[state] += 1
+        log.info("Valve %s %s%s", self.name, state, f": {reason}" if reason else "")
+
+    def open_seconds(self, now):
+        return self.closed_seconds + (now - self.opened_at if self.is_open else 0.0)
+
+
+class Plan:
+    """A run plan: zones opened one after another, timed by the bridge."""
+
+    def __init__(self, plan_id, steps):
+        self.id = plan_id
+        self.steps = steps          # [(zone, seconds), ...]
+        self.index = -1
+        self.zone = None            # zone of the running step
+        self.timer = None
+        self.step_started = None
+
+    def remaining(self, now):
+        if self.zone is None:
+            return sum(seconds for _, seconds in self.steps)
+        left = self.steps[self.index][1] - (now - self.step_started)
+        return max(left, 0.0) + sum(seconds for _, seconds in self.steps[self.index + 1:])
+
+
+def parse_plan(text, zones, default_id):
+    """Plan JSON -> Plan; a bare list of steps is accepted too.
+
+    A step is {"zone": name, "seconds": n} or {"zone": name, "minutes": n};
+    the zone may be left out with a single zone. No step may outlast its
+    zone's watchdog, which restarts with every step.
+    """
+    data = json.loads(text)
+    if isinstance(data, list):
+        data = {"steps": data}
+    if not isinstance(data, dict) or not isinstance(data.get("steps"), list):
+        raise ValueError("expected {\"steps\": [...]}")
+    if not 0 < len(data["steps"]) <= PLAN_MAX_STEPS:
+        raise ValueError(f"a plan has 1..{PLAN_MAX_STEPS} steps")
+    only = next(iter(zones)) if len(zones) == 1 else None
+    steps = []
+    for step in data["steps"]:
+        if not isinstance(step, dict):
+            raise ValueError(f"bad step {step!r}")
+        name = step.get("zone", only)
+        zone = zones.get(name)
+        if zone is None:
+            raise ValueError(f"unknown zone {name!r}")
+        seconds = float(step.get("seconds", 0)) + 60 * float(step.get("minutes", 0))
+        if seconds <= 0:
+            raise ValueError(f"step for {name} has no duration")
+        if 0 < zone.max_on < seconds:
+            raise ValueError(
+                f"{seconds:.0f}s for {name} exceeds its max-on {zone.max_on:.0f}s"
+            )
+        steps.append((zone, seconds))
+    return Plan(str(data.get("id") or default_id), steps)
+
+
+def plan_id_of(text):
+    """The id a plan that failed to parse names, if any (for its rejection)."""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    return str(data["id"]) if isinstance(data, dict) and data.get("id") else None
 
 
 class Bridge:
     def __init__(self):
         self.host = os.environ.get("MQTT_HOST", "mars.local")
         self.port = int(os.environ.get("MQTT_PORT", "1883"))
-        base = os.environ.get("TOPIC_BASE", "irrigation/tap").rstrip("/")
-        self.t_set = f"{base}/set"
-        self.t_state = f"{base}/state"
-        self.t_avail = f"{base}/availability"
+        self.keepalive = int(os.environ.get("MQTT_KEEPALIVE", "30"))
         self.max_on = float(os.environ.get("MAX_ON_SECONDS", "2400"))
+        self.max_open = int(os.environ.get("MAX_OPEN", "1"))
+        self.metrics_host = os.environ.get("METRICS_HOST", "127.0.0.1")
+        self.metrics_port = int(os.environ.get("METRICS_PORT", "0"))
+        self.coalesce = float(os.environ.get("COALESCE_MS", "0")) / 1000
+        self.journal_path = os.environ.get("JOURNAL_PATH", "").strip()
+        self.startup = StartupTimer()
+        self.startup.mark("imports", IMPORTED)
+        self.broker = BrokerAddress(
+            self.host, self.port, os.environ.get("BROKER_CACHE", "").strip()
+        )
+        self.address = self.host
+        self.ready = False
+        self.journal = None
+        self.metrics = Metrics()
+        self.metrics_server = None
+
+        spec = os.environ.get("ZONES", "").strip()
+        if spec:
+            prefix = os.environ.get("TOPIC_PREFIX", "irrigation").rstrip("/")
+            zones = parse_zones(spec, self.max_on)
+            bases = {name: f"{prefix}/{name}" for name, _, _ in zones}
+            self.t_set = f"{prefix}/+/set"
+            self.t_litres = f"{prefix}/+/litres/set"
+            self.t_avail = f"{prefix}/availability"
+            bridge_base = prefix
+        else:
+            # Phase 1 contract: one zone, topics directly under TOPIC_BASE.
+            base = os.environ.get("TOPIC_BASE", "irrigation/tap").rstrip("/")
+            zones = [(base.rsplit("/", 1)[-1], int(os.environ.get("GPIO_PIN", "17")),
+                      self.max_on)]
+            bases = {zones[0][0]: base}
+            self.t_set = f"{base}/set"
+            self.t_litres = f"{base}/litres/set"
+            self.t_avail = f"{base}/availability"
+            bridge_base = base
+        self.t_plan = f"{bridge_base}/plan/set"
+        self.t_plan_state = f"{bridge_base}/plan/state"
+        self.t_plan_progress = f"{bridge_base}/plan/progress"
+        self.plan = None
+        self.plan_state = None     # last plan state payload, republished on connect
+        self.plan_events = collections.deque(maxlen=PLAN_EVENTS_MAX)
+
+        valves, self.chip = make_valves({name: pin for name, pin, _ in zones})
+        self.zones = {
+            name: Zone(name, valves[name], bases[name], max_on)
+            for name, _, max_on in zones
+        }
+        self.zone_by_topic = {zone.t_set: zone for zone in self.zones.values()}
+        self.zone_by_litres = {zone.t_litres: zone for zone in self.zones.values()}
+        self.flow = None
+        flow_pin = os.environ.get("FLOW_PIN", "").strip()
+        if flow_pin:
+            self.flow = Flow(
+                make_flow_meter(int(flow_pin), self.chip), bridge_base,
+                pulses_per_litre=float(os.environ.get("FLOW_PULSES_PER_LITRE", "450")),
+                interval=float(os.environ.get("FLOW_INTERVAL_S", "10")),
+                leak_litres=float(os.environ.get("FLOW_LEAK_LITRES", "0.5")),
+                leak_grace=float(os.environ.get("FLOW_LEAK_GRACE_S", "10")),
+            )
+            for zone in self.zones.values():
+                zone.flow = self.flow
+        if self.journal_path:
+            self.journal = Journal(
+                self.journal_path,
+                flush_s=float(os.environ.get("JOURNAL_FLUSH_S", "60")),
+                max_bytes=int(os.environ.get("JOURNAL_MAX_BYTES", str(1 << 20))),
+            )
+            for zone in self.zones.values():
+                zone.journal = self.journal
+                stats = self.journal.zone_stats(zone.name)
+                log.info("Journal: %s %d runs, %.0fs water, last run %s", zone.name,
+                         stats["runs"], stats["seconds"], stats["last_run"])
+        # Single zone: its state topic is the bridge's (Phase 1 attribute).
+        self.t_state = next(iter(self.zones.values())).t_state if not spec else None
 
-        self.valve = make_valve()
         self.lock = threading.RLock()
-        self.is_open = False
-        self.timer = None
+        self.scheduler = DeadlineScheduler()
         self.stopping = False
+        self.connected = False
 
         try:
             self.client = mqtt.Client(
@@ -139,106 +1174,834 @@ class Bridge:
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_connect_fail = self._on_connect_fail
+
+    @property
+    def is_open(self):
+        return any(zone.is_open for zone in self.zones.values())
+
+    def open_zones(self):
+        return [zone for zone in self.zones.values() if zone.is_open]
 
     # --- valve control + watchdog -------------------------------------
-    def _cancel_timer(self):
-        if self.timer is not None:
-            self.timer.cancel()
-            self.timer = None
-
-    def _open(self):
-        with self.lock:
-            self.valve.open()
-            self.is_open = True
-            self._cancel_timer()
-            if self.max_on > 0:
-                self.timer = threading.Timer(self.max_on, self._watchdog)
-                self.timer.daemon = True
-                self.timer.start()
-            self._publish_state()
-
-    def _close(self, reason=""):
-        with self.lock:
-            self.valve.close()
-            self.is_open = False
-            self._cancel_timer()
-            self._publish_state()
-            if reason:
-                log.info("Valve closed: %s", reason)
-
-    def _watchdog(self):
+    def _cancel_timer(self, zone):
+        if zone.timer is not None:
+            zone.timer.cancel()
+            zone.timer = None
+
+    def _refuse_open(self, zone):
+        """True (and logged) if opening zone would exceed MAX_OPEN."""
+        if zone.is_open or len(self.open_zones()) < self.max_open:
+            return False
+        zone.limit_pulses = None
         log.warning(
-            "WATCHDOG: max-on %.0fs reached, forcing valve closed", self.max_on
+            "Refusing to open %s: %d of max %d zones already open (%s)",
+            zone.name, len(self.open_zones()), self.max_open,
+            ", ".join(z.name for z in self.open_zones()),
         )
-        self._close("watchdog timeout")
+        return True
+
+    def _arm_watchdog(self, zone):
+        self._cancel_timer(zone)
+        if zone.max_on > 0:
+            zone.timer = self.scheduler.call_later(
+                zone.max_on, functools.partial(self._watchdog, zone, zone.run)
+            )
+
+    def _rearm_watchdog(self, zone):
+        """Restart the max-on clock of an open zone as a new run; a trip of the
+        old deadline that is already on its way is then ignored."""
+        zone.run += 1
+        self._arm_watchdog(zone)
+
+    def _open(self, zone, received=None, reason="command ON"):
+        with self.lock:
+            if self._refuse_open(zone):
+                self._publish_state(zone)
+                return
+            zone.valve.open()
+            self.metrics.command_done(zone, received)
+            zone.mark(True, reason)
+            zone.run += 1
+            self._arm_watchdog(zone)
+            self._publish_state(zone)
+
+    def _close(self, zone, reason="", received=None):
+        with self.lock:
+            zone.valve.close()
+            self.metrics.command_done(zone, received)
+            was_open = zone.is_open
+            zone.mark(False, reason)
+            self._cancel_timer(zone)
+            self._publish_state(zone)
+            if was_open:
+                self._publish_stats(zone)
+
+    def _watchdog(self, zone, run=None):
+        self._trip(zone, run, "watchdog")
+
+    def _trip(self, zone, run, kind):
+        """Forced close of one run: "watchdog" (max-on) or "volume" (litres)."""
+        with self.lock:
+            # The deadline may have fired just as an OFF/ON re-armed the zone.
+            if run is not None and run != zone.run:
+                return
+            self._close(zone, self._tripped(zone, kind))
+
+    def _tripped(self, zone, kind):
+        """Count, log and journal a forced close; returns its reason."""
+        self._journal(kind, zone.name)
+        if zone.plan is not None:
+            self._end_plan(zone.plan, "aborted", kind, close=False)
+        if kind == "volume":
+            self.metrics.volume_closes[zone.name] += 1
+            log.warning("VOLUME: %s delivered %.1f L, closing valve", zone.name,
+                        self.flow.litres(self.flow.meter.pulses - zone.open_pulses))
+            return "volume limit"
+        self.metrics.watchdog_trips[zone.name] += 1
+        log.warning(
+            "WATCHDOG: %s max-on %.0fs reached, forcing valve closed",
+            zone.name, zone.max_on,
+        )
+        return "watchdog timeout"
+
+    # --- flow meter ----------------------------------------------------
+    def _start_flow(self):
+        if self.flow is not None:
+            self.flow.timer = self.scheduler.call_later(FLOW_TICK_S, self._flow_tick)
+
+    def _flow_tick(self, now=None):
+        """Check the litres limits and the leak watch; publish each interval."""
+        flow = self.flow
+        now = time.monotonic() if now is None else now
+        pulses = flow.meter.pulses   # one snapshot per tick
+        trips = []
+        with self.lock:
+            open_zones = self.open_zones()
+            for zone in open_zones:
+                if zone.limit_pulses is not None and pulses >= zone.limit_pulses:
+                    zone.limit_pulses = None
+                    trips.append((zone, zone.run))
+            self._watch_leak(now, pulses, bool(open_zones))
+            if now - flow.sampled[0] >= flow.interval:
+                self._publish_flow(now, pulses)
+        for zone, run in trips:
+            self._trip(zone, run, "volume")
+        if not self.stopping:
+            flow.timer = self.scheduler.call_later(FLOW_TICK_S, self._flow_tick)
+
+    def _watch_leak(self, now, pulses, any_open):
+        flow = self.flow
+        if any_open:
+            flow.last_open = now
+        if any_open or now - flow.last_open < flow.leak_grace:
+            flow.leak_base = pulses   # water is expected (or still draining)
+            return
+        if not flow.leak and pulses - flow.leak_base >= flow.leak_pulses:
+            flow.leak = True
+            self.metrics.leak_alarms += 1
+            log.warning("LEAK: %.2f L flowed with every valve closed",
+                        flow.litres(pulses - flow.leak_base))
+            self._journal("leak")
+            self._publish(flow.t_leak, "ON")
+
+    def _publish_flow(self, now, pulses, force=False):
+        flow = self.flow
+        then, before = flow.sampled
+        flow.rate_lpm = flow.litres(pulses - before) / max(now - then, 1e-9) * 60
+        flow.sampled = (now, pulses)
+        if flow.leak and pulses == before:
+            flow.leak = False
+            flow.leak_base = pulses
+            log.info("Leak alarm cleared: no flow for %.0fs", now - then)
+            self._publish(flow.t_leak, "OFF")
+        payload = {"rate_lpm": round(flow.rate_lpm, 2), "total_l": round(flow.litres(pulses), 3)}
+        if not force and payload == flow.published:
+            return None   # idle and already published
+        flow.published = payload
+        return self._publish(flow.t_flow, json.dumps(payload, sort_keys=True))
+
+    def _on_litres(self, zone, payload, received):
+        try:
+            litres = float(payload)
+        except ValueError:
+            self.metrics.unknown_commands["payload"] += 1
+            log.warning("Ignoring litres command for %s: %r", zone.name, payload)
+            return
+        with self.lock:
+            if litres <= 0:
+                zone.limit_pulses = None
+                log.info("Valve %s: litres limit cleared", zone.name)
+                return
+            zone.limit_pulses = self.flow.meter.pulses + int(litres * self.flow.pulses_per_litre)
+            log.info("Valve %s closes after %.1f L", zone.name, litres)
+        self._command(zone, True, received)
+
+    def _on_inject(self, payload):
+        """Stub meter only: "HZ[:SECONDS]" starts a synthetic pulse train."""
+        hz, _, seconds = payload.partition(":")
+        try:
+            self.flow.meter.train(float(hz), float(seconds) if seconds else None)
+        except ValueError:
+            log.warning("Ignoring flow inject %r (want HZ[:SECONDS])", payload)
+
+    # --- run plans -----------------------------------------------------
+    def _on_plan(self, text, retained=False):
+        if text.strip().upper() in ("", "CANCEL", *OFF_PAYLOADS):
+            with self.lock:
+                if self.plan is not None:
+                    self._end_plan(self.plan, "cancelled", "command CANCEL")
+            return
+        if retained:
+            # A retained plan would start again on every reconnect.
+            self.metrics.unknown_commands["payload"] += 1
+            log.warning("Ignoring retained plan on %s; publish plans non-retained",
+                        self.t_plan)
+            return
+        try:
+            plan = parse_plan(text, self.zones, f"{time.time():.0f}")
+        except (ValueError, TypeError) as exc:
+            self.metrics.unknown_commands["payload"] += 1
+            self.metrics.plans["rejected"] += 1
+            log.warning("Rejecting plan: %s", exc)
+            # The id (when the JSON names one) lets the sender match the rejection.
+            self.plan_state = {"id": plan_id_of(text), "status": "rejected", "error": str(exc)}
+            self._publish(self.t_plan_state, json.dumps(self.plan_state, sort_keys=True))
+            return
+        with self.lock:
+            old = self.plan
+            if old is not None and old.id == plan.id:
+                log.info("Plan %s is already running", plan.id)   # a redelivery
+                return
+            if old is not None:
+                # Keep a zone that the new plan starts with open, no blip.
+                self._end_plan(old, "replaced", close=old.zone is not plan.steps[0][0])
+            self.plan = plan
+            log.info("Plan %s: %s", plan.id, ", ".join(
+                f"{zone.name} {seconds:.0f}s" for zone, seconds in plan.steps))
+            self._plan_event(plan, "start", steps=len(plan.steps),
+                             seconds=round(plan.remaining(0), 1))
+            self._plan_step(plan, 0)
+
+    def _plan_step(self, plan, index):
+        """Close the previous step's zone and open the next (or finish)."""
+        with self.lock:
+            if plan is not self.plan:
+                return   # cancelled or replaced as the step timer fired
+            prev = plan.zone
+            while index < len(plan.steps):
+                zone, seconds = plan.steps[index]
+                others = [z for z in self.open_zones() if z is not prev and z is not zone]
+                if len(others) < self.max_open:
+                    break
+                log.warning("Plan %s: skipping %s, %d zones already open",
+                            plan.id, zone.name, len(others))
+                self._plan_event(plan, "skip", step=index + 1, zone=zone.name,
+                                 reason="max open")
+                index += 1
+            else:
+                self._end_plan(plan, "done")
+                return
+            if prev is not None and prev is not zone:
+                prev.plan = None
+                self._apply(prev, False, reason=f"plan {plan.id}")
+            plan.index, plan.zone, plan.step_started = index, zone, time.monotonic()
+            zone.plan = plan
+            if zone.is_open:
+                # Taken over from the previous step, a replaced plan or a
+                # manual ON: the step gets its own max-on from now.
+                self._rearm_watchdog(zone)
+            self._apply(zone, True,
+                        reason=f"plan {plan.id} step {index + 1}/{len(plan.steps)}")
+            plan.timer = self.scheduler.call_later(
+                seconds, functools.partial(self._plan_step, plan, index + 1)
+            )
+            self._plan_event(plan, "step", step=index + 1, zone=zone.name,
+                             seconds=round(seconds, 1))
+            self._publish_plan(plan, "running")
+
+    def _end_plan(self, plan, status, reason=None, close=True):
+        """Stop plan; close its zone unless the caller closes it anyway."""
+        if plan.timer is not None:
+            plan.timer.cancel()
+        if self.plan is plan:
+            self.plan = None
+        zone = plan.zone
+        if zone is not None:
+            zone.plan = None
+            if close:
+                self._apply(zone, False, reason=f"plan {plan.id} {status}")
+        self.metrics.plans[status] += 1
+        log.info("Plan %s %s%s", plan.id, status, f": {reason}" if reason else "")
+        fields = {"reason": reason} if reason else {}
+        self._plan_event(plan, status, step=plan.index + 1,
+                         zone=zone.name if zone else None, **fields)
+        self._publish_plan(plan, status)
 
-    def _publish_state(self):
-        payload = "ON" if self.is_open else "OFF"
-        self.client.publish(self.t_state, payload, qos=1, retain=True)
+    def _plan_event(self, plan, ev, **fields):
+        event = {"t": round(time.time(), 3), "plan": plan.id, "ev": ev, **fields}
+        self.plan_events.append(event)
+        if self.journal is not None:
+            self.journal.record("plan", fields.get("zone"), plan=plan.id, status=ev)
+        if self.connected:
+            self._flush_progress()
+
+    def _flush_progress(self):
+        """Publish the buffered progress events as one batch."""
+        if not self.plan_events:
+            return None
+        batch = list(self.plan_events)
+        self.plan_events.clear()
+        return self._publish(self.t_plan_progress, json.dumps(batch), retain=False)
+
+    def _publish_plan(self, plan, status):
+        self.plan_state = {
+            "id": plan.id, "status": status, "step": plan.index + 1,
+            "steps": len(plan.steps), "zone": plan.zone.name if plan.zone else None,
+            "remaining_s": round(plan.remaining(time.monotonic()), 1)
+            if status == "running" else 0,
+        }
+        if self.connected:
+            self._publish(self.t_plan_state, json.dumps(self.plan_state, sort_keys=True))
+
+    def _journal(self, ev, zone=None):
+        if self.journal is not None:
+            self.journal.record(ev, zone, urgent=True)
+
+    def _publish(self, topic, payload, retain=True):
+        sent = time.monotonic()
+        info = self.client.publish(topic, payload, qos=1, retain=retain)
+        self.metrics.published(info, sent)
+        return info
+
+    def _publish_state(self, zone):
+        return self._publish(zone.t_state, "ON" if zone.is_open else "OFF")
+
+    def _publish_stats(self, zone):
+        if self.journal is None:
+            return None
+        stats = self.journal.zone_stats(zone.name)
+        payload = {"runs": stats["runs"], "water_seconds": round(stats["seconds"], 1),
+                   "last_run": stats["last_run"]}
+        if self.flow is not None:
+            payload["water_litres"] = round(stats["litres"], 1)
+        return self._publish(zone.t_stats, json.dumps(payload, sort_keys=True))
+
+    def _publish_availability(self, payload):
+        topics = {self.t_avail} | {zone.t_avail for zone in self.zones.values()}
+        return [self._publish(topic, payload) for topic in sorted(topics)]
 
     # --- mqtt callbacks ------------------------------------------------
     def _on_connect(self, client, userdata, flags, rc, *args):
+        self.connected = rc == 0
         if rc != 0:
             log.error("MQTT connect failed rc=%s", rc)
             return
         log.info("Connected to %s:%d", self.host, self.port)
-        client.publish(self.t_avail, "online", qos=1, retain=True)
-        self._publish_state()
+        self.startup.mark("connack")
+        self.metrics.connects += 1
+        self._publish_availability("online")
+        for zone in self.zones.values():
+            self._publish_state(zone)
+            self._publish_stats(zone)
         client.subscribe(self.t_set, qos=1)
+        if self.flow is not None:
+            with self.lock:
+                self._publish(self.flow.t_leak, "ON" if self.flow.leak else "OFF")
+                self._publish_flow(time.monotonic(), self.flow.meter.pulses, force=True)
+            client.subscribe(self.t_litres, qos=1)
+            if isinstance(self.flow.meter, StubFlowMeter):
+                client.subscribe(self.flow.t_inject, qos=1)
+        with self.lock:
+            if self.plan is not None:
+                self._publish_plan(self.plan, "running")
+            elif self.plan_state is not None:
+                self._publish(self.t_plan_state, json.dumps(self.plan_state, sort_keys=True))
+            self._flush_progress()   # what happened while we were offline
+        client.subscribe(self.t_plan, qos=1)
 
     def _on_message(self, client, userdata, msg):
+        # paho stamps every message with time.monotonic() on receipt.
+        received = getattr(msg, "timestamp", None) or time.monotonic()
+        zone = self.zone_by_topic.get(msg.topic)
         cmd = msg.payload.decode(errors="ignore").strip().upper()
-        log.info("CMD %s = %s", msg.topic, cmd)
-        if cmd in ("ON", "1", "TRUE", "OPEN"):
-            self._open()
-        elif cmd in ("OFF", "0", "FALSE", "CLOSE"):
-            self._close("command OFF")
+        log.debug("CMD %s = %s", msg.topic, cmd)
+        if msg.topic == self.t_plan:
+            self._on_plan(msg.payload.decode(errors="ignore"), getattr(msg, "retain", False))
+        elif self.flow is not None and msg.topic in self.zone_by_litres:
+            self._on_litres(self.zone_by_litres[msg.topic], cmd, received)
+        elif self.flow is not None and msg.topic == self.flow.t_inject:
+            self._on_inject(cmd)
+        elif zone is None:
+            self.metrics.unknown_commands["zone"] += 1
+            log.warning("Ignoring command for unknown zone: %s", msg.topic)
+        elif cmd in ON_PAYLOADS:
+            self._command(zone, True, received)
+        elif cmd in OFF_PAYLOADS:
+            self._command(zone, False, received)
         else:
+            self.metrics.unknown_commands["payload"] += 1
             log.warning("Ignoring unknown command: %r", cmd)
 
+    def _command(self, zone, on, received=None):
+        with self.lock:
+            if not on and zone.plan is not None:
+                self._end_plan(zone.plan, "cancelled", "command OFF", close=False)
+            if on and self.coalesce > 0:
+                if zone.pending is None:
+                    zone.burst += 1
+                    zone.pending_received = received
+                    zone.pending = self.scheduler.call_later(
+                        self.coalesce, functools.partial(self._flush, zone, zone.burst)
+                    )
+                else:
+                    self.metrics.coalesced[zone.name] += 1
+                return
+            if self._drop_pending(zone):   # the OFF supersedes the deferred ON
+                self.metrics.coalesced[zone.name] += 1
+            if not on:
+                zone.limit_pulses = None
+            self._apply(zone, on, received)
+
+    def _drop_pending(self, zone):
+        if zone.pending is None:
+            return False
+        zone.pending.cancel()
+        zone.pending = None
+        return True
+
+    def _flush(self, zone, burst):
+        with self.lock:
+            # An OFF (or a disconnect) may have dropped this burst as it fired.
+            if zone.pending is None or burst != zone.burst:
+                return
+            zone.pending = None
+            self._apply(zone, True, zone.pending_received)
+
+    def _unchanged(self, zone, on):
+        """True (and counted) if the valve is already in the commanded state."""
+        if on != zone.is_open:
+            return False
+        self.metrics.coalesced[zone.name] += 1
+        log.debug("Valve %s already %s; no write", zone.name, "open" if on else "closed")
+        return True
+
+    def _apply(self, zone, on, received=None, reason=None):
+        if self._unchanged(zone, on):
+            return
+        if on:
+            self._open(zone, received, reason or "command ON")
+        else:
+            self._close(zone, reason or "command OFF", received)
+
+    def _on_publish(self, client, userdata, mid, *args):
+        self.metrics.acked(mid)
+        self._first_ack()
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.startup.mark("connect")
+        try:
+            # paho leaves Nagle on: the retained online/state publishes right
+            # after CONNACK would otherwise wait on the broker's delayed ACK.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            pass   # not a plain TCP socket (TLS/websocket wrapper)
+
+    def _on_connect_fail(self, client, userdata):
+        # The cached (or last) address may be stale; look the name up again.
+        ip = self.broker.resolve()
+        if ip and ip != self.address:
+            log.info("Broker %s now resolves to %s", self.host, ip)
+            self.address = ip
+            client.connect_async(ip, self.port, keepalive=self.keepalive)
+
     def _on_disconnect(self, *args):
+        self.connected = False
+        self.metrics.forget_unacked()
         if self.stopping:
             return
-        # Fail-safe: we can no longer receive an OFF, so close the valve.
+        # Fail-safe: we can no longer receive an OFF, so close every valve
+        # but the one a run plan holds (its close is scheduled locally).
         # paho's loop will keep trying to reconnect in the background.
-        log.warning("MQTT disconnected; closing valve fail-safe")
+        log.warning("MQTT disconnected; closing all valves fail-safe")
+        self.metrics.disconnects += 1
+        self.metrics.failsafe_closes += 1
+        self._journal("failsafe")
         with self.lock:
-            self.valve.close()
-            self.is_open = False
-            self._cancel_timer()
+            for zone in self._failsafe_zones():
+                self._drop_pending(zone)
+                zone.valve.close()
+                zone.mark(False, "fail-safe")
+                self._cancel_timer(zone)
+
+    def _failsafe_zones(self):
+        """Zones the disconnect fail-safe closes: all but a running plan's."""
+        plan = self.plan
+        if plan is not None and plan.zone is not None:
+            log.warning("Plan %s keeps %s open through the outage (%.0fs of the plan left)",
+                        plan.id, plan.zone.name, plan.remaining(time.monotonic()))
+        return [zone for zone in self.zones.values() if zone.plan is None]
 
     # --- lifecycle -----------------------------------------------------
+    def _lookup_broker(self):
+        address, source = self.broker.lookup()
+        self.startup.mark("dns")
+        log.info("Broker %s -> %s (%s)", self.host, address, source)
+        return address
+
+    def _first_ack(self):
+        with self.lock:
+            if self.startup.done():
+                return
+            self.startup.mark("publish")
+        log.info("Startup: %s", self.startup.summary())
+        self._ready("online")
+
+    def _ready(self, status):
+        """Tell systemd we are up (once): online, or still waiting for the broker."""
+        with self.lock:
+            if self.ready:
+                return
+            self.ready = True
+        sd_notify(f"READY=1\nSTATUS={status}")
+
+    def start_metrics(self):
+        if self.metrics_port:
+            self.metrics_server = start_metrics_server(
+                self, self.metrics_host, self.metrics_port
+            )
+
     def run(self):
-        # Ensure the valve is physically closed before we touch the network.
+        # Ensure the valves are physically closed before we touch the network.
         with self.lock:
-            self.valve.close()
-            self.is_open = False
-        self.client.connect_async(self.host, self.port, keepalive=30)
+            for zone in self.zones.values():
+                zone.valve.close()
+                zone.mark(False)
+        self.startup.mark("gpio")
+        self._start_flow()
+        self.start_metrics()
+        self.address = self._lookup_broker()
+        # Valves are safe either way: a down broker must not fail the start.
+        self.scheduler.call_later(
+            READY_TIMEOUT_S, functools.partial(self._ready, "waiting for broker")
+        )
+        self.client.connect_async(self.address, self.port, keepalive=self.keepalive)
         self.client.loop_start()
         signal.pause()
 
     def shutdown(self, *args):
         log.info("Shutting down")
+        sd_notify("STOPPING=1")
         self.stopping = True
         try:
-            self.client.publish(self.t_avail, "offline", qos=1, retain=True)
+            self._publish_availability("offline")
         except Exception:  # noqa: BLE001
             pass
-        self._close("shutdown")
+        with self.lock:
+            if self.plan is not None:
+                self._end_plan(self.plan, "aborted", "shutdown", close=False)
+        for zone in self.zones.values():
+            self._drop_pending(zone)
+            self._close(zone, "shutdown")
+        self.scheduler.stop()
         try:
             self.client.loop_stop()
             self.client.disconnect()
         except Exception:  # noqa: BLE001
             pass
-        self.valve.cleanup()
+        for zone in self.zones.values():
+            zone.valve.cleanup()
+        if self.flow is not None:
+            self.flow.meter.cleanup()
+        if self.chip is not None:
+            self.chip.close()
+        if self.journal is not None:
+            self.journal.close()
         sys.exit(0)
 
 
+class AsyncBridge(Bridge):
+    """The same bridge on an asyncio event loop (RUNTIME=asyncio).
+
+    paho does no I/O of its own here: the loop watches its socket
+    (on_socket_* callbacks -> loop_read/loop_write) and calls loop_misc for
+    keepalives, so callbacks run on the loop thread and never wait for GPIO.
+    Commands and watchdog trips go through one queue, handled in order by a
+    single consumer; valve writes run on a one-thread executor (ordered, off
+    the loop); every retained publish is tracked until its PUBACK. The loop's
+    timer heap replaces the DeadlineScheduler thread.
+
+    The disconnect fail-safe is unchanged: all valves close, and the close is
+    queued on the GPIO thread behind any write still in flight.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+        self._loop_thread = None
+        self.queue = None
+        self._consumer = None
+        self._disconnected = None
+        from concurrent.futures import ThreadPoolExecutor   # asyncio runtime only
+
+        self.gpio = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpio")
+        self._acks = {}
+        self._tasks = set()
+        self._sock_fd = None
+        self._misc = None
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    # --- paho socket <-> event loop -----------------------------------
+    def _in_loop(self, fn, *args):
+        if self._loop_thread == threading.get_ident():
+            fn(*args)
+        elif not self.loop.is_closed():   # connect() runs in an executor thread
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _watch_socket(self, sock):
+        if sock.fileno() < 0:
+            return
+        self._sock_fd = sock.fileno()
+        self.loop.add_reader(self._sock_fd, self.client.loop_read)
+        self._misc = self.loop.create_task(self._misc_loop())
+
+    def _unwatch_socket(self):
+        if self._sock_fd is not None:
+            self.loop.remove_reader(self._sock_fd)
+            self.loop.remove_writer(self._sock_fd)
+            self._sock_fd = None
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
+
+    def _on_socket_open(self, client, userdata, sock):
+        super()._on_socket_open(client, userdata, sock)
+        self._in_loop(self._watch_socket, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._in_loop(self._unwatch_socket)
+
+    def _watch_writes(self, wanted):
+        if self._sock_fd is None:
+            return
+        if wanted:
+            self.loop.add_writer(self._sock_fd, self.client.loop_write)
+        else:
+            self.loop.remove_writer(self._sock_fd)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self._watch_writes, True)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self._watch_writes, False)
+
+    async def _misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def _keep_connected(self):
+        delay = RECONNECT_MIN_S
+        while not self.stopping:
+            self._disconnected.clear()
+            try:
+                await self.loop.run_in_executor(
+                    None, self.client.connect, self.address, self.port, self.keepalive
+                )
+            except OSError as exc:
+                log.warning("MQTT connect to %s:%d failed (%s); retry in %ds",
+                            self.host, self.port, exc, delay)
+                ip = await self.loop.run_in_executor(None, self.broker.resolve)
+                if ip and ip != self.address:
+                    log.info("Broker %s now resolves to %s", self.host, ip)
+                    self.address = ip
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_S)
+                continue
+            delay = RECONNECT_MIN_S
+            await self._disconnected.wait()
+            await asyncio.sleep(RECONNECT_MIN_S)
+
+    # --- publishes with PUBACK tracking -------------------------------
+    def _publish(self, topic, payload, retain=True):
+        info = self.client.publish(topic, payload, qos=1, retain=retain)
+        ack = self.loop.create_future()
+        self._acks[info.mid] = ack
+        return self._spawn(self._await_ack(topic, info.mid, ack))
+
+    async def _await_ack(self, topic, mid, ack):
+        """Seconds until the PUBACK, or None if it did not come in time."""
+        started = self.loop.time()
+        try:
+            await asyncio.wait_for(ack, PUBLISH_TIMEOUT_S)
+            rtt = self.loop.time() - started
+            self.metrics.publish_ack.observe(rtt)
+            return rtt
+        except asyncio.TimeoutError:
+            log.warning("No PUBACK for %s within %.0fs", topic, PUBLISH_TIMEOUT_S)
+            return None
+        finally:
+            self._acks.pop(mid, None)
+
+    def _on_publish(self, client, userdata, mid, *args):
+        ack = self._acks.get(mid)
+        if ack is not None and not ack.done():
+            ack.set_result(None)
+        self._first_ack()
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    # --- commands -------------------------------------------------------
+    async def _gpio_write(self, fn):
+        await self.loop.run_in_executor(self.gpio, fn)
+
+    def _apply(self, zone, on, received=None, reason=None):
+        self.queue.put_nowait((zone, on, None, received, reason))
+
+    def _trip(self, zone, run, kind):
+        self.queue.put_nowait((zone, None, run, None, kind))
+
+    async def _consume(self):
+        while True:
+            zone, on, run, received, reason = await self.queue.get()
+            try:
+                if on is not None and self._unchanged(zone, on):
+                    pass
+                elif on:
+                    await self._open_async(zone, received, reason or "command ON")
+                elif on is False:
+                    await self._close_async(zone, reason or "command OFF", received)
+                elif run == zone.run and zone.is_open:
+                    await self._close_async(zone, self._tripped(zone, reason))
+            except Exception:  # noqa: BLE001 - keep serving commands
+                log.exception("Command for %s failed", zone.name)
+            finally:
+                self.queue.task_done()
+
+    async def _open_async(self, zone, received=None, reason="command ON"):
+        if self._refuse_open(zone):
+            self._publish_state(zone)
+            return
+        await self._gpio_write(zone.valve.open)
+        self.metrics.command_done(zone, received)
+        if not self.connected and zone.plan is None:
+            return   # disconnected meanwhile; the fail-safe close runs next
+        zone.mark(True, reason)
+        zone.run += 1
+        self._arm_watchdog(zone)
+        self._publish_state(zone)
+
+    async def _close_async(self, zone, reason="", received=None):
+        was_open = zone.is_open
+        zone.mark(False, reason)
+        self._cancel_timer(zone)
+        await self._gpio_write(zone.valve.close)
+        self.metrics.command_done(zone, received)
+        self._publish_state(zone)
+        if was_open:
+            self._publish_stats(zone)
+
+    # --- mqtt callbacks ------------------------------------------------
+    def _on_disconnect(self, *args):
+        self.connected = False
+        self._disconnected.set()
+        if self.stopping:
+            return
+        log.warning("MQTT disconnected; closing all valves fail-safe")
+        self.metrics.disconnects += 1
+        self.metrics.failsafe_closes += 1
+        self._journal("failsafe")
+        kept = []
+        while not self.queue.empty():   # commands we can no longer confirm
+            item = self.queue.get_nowait()
+            self.queue.task_done()
+            if item[0].plan is not None:
+                kept.append(item)      # a plan step: it runs without the broker
+        for item in kept:
+            self.queue.put_nowait(item)
+        for zone in self._failsafe_zones():
+            self._drop_pending(zone)
+            zone.mark(False, "fail-safe")
+            self._cancel_timer(zone)
+            self.gpio.submit(zone.valve.close)
+
+    # --- lifecycle -----------------------------------------------------
+    async def start(self):
+        """Bind to the running loop and start the command consumer."""
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.scheduler = self.loop
+        self.queue = asyncio.Queue()
+        self._disconnected = asyncio.Event()
+        for zone in self.zones.values():
+            zone.mark(False)
+            await self._gpio_write(zone.valve.close)
+        self.startup.mark("gpio")
+        self._consumer = self._spawn(self._consume())
+        self._start_flow()
+
+    async def serve(self, stop):
+        await self.start()
+        self.start_metrics()
+        self.address = await self.loop.run_in_executor(None, self._lookup_broker)
+        self.loop.call_later(READY_TIMEOUT_S, self._ready, "waiting for broker")
+        self._spawn(self._keep_connected())
+        await stop.wait()
+        await self.stop()
+
+    async def stop(self):
+        log.info("Shutting down")
+        sd_notify("STOPPING=1")
+        self.stopping = True
+        self._consumer.cancel()   # no more commands; queued ones are dropped
+        acks = list(self._publish_availability("offline"))
+        if self.plan is not None:
+            self._end_plan(self.plan, "aborted", "shutdown", close=False)
+        for zone in self.zones.values():
+            self._drop_pending(zone)
+            await self._close_async(zone, "shutdown")
+            acks.append(self._publish_state(zone))
+        await asyncio.wait(acks, timeout=PUBLISH_TIMEOUT_S)
+        self.client.disconnect()
+        self._unwatch_socket()
+        for zone in self.zones.values():
+            await self._gpio_write(zone.valve.cleanup)
+        if self.flow is not None:
+            if self.flow.timer is not None:
+                self.flow.timer.cancel()
+            await self._gpio_write(self.flow.meter.cleanup)
+        if self.chip is not None:
+            self.chip.close()
+        if self.journal is not None:
+            await self.loop.run_in_executor(None, self.journal.close)
+        self.gpio.shutdown(wait=True)
+
+    def run(self):
+        async def main():
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            await self.serve(stop)
+
+        asyncio.run(main())
+
+
 def main():
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s %(levelname)s %(message)s",
     )
+    if os.environ.get("RUNTIME", "thread").strip().lower() == "asyncio":
+        AsyncBridge().run()
+        return
     bridge = Bridge()
     signal.signal(signal.SIGTERM, bridge.shutdown)
     signal.signal(signal.SIGINT, bridge.shutdown)
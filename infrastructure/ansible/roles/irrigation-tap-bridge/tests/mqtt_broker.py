@@ -0,0 +1,251 @@
+"""Local MQTT brokers for the bridge soak harness (soak_bridge.py).
+
+The embedded broker is a minimal MQTT 3.1.1 broker on asyncio, enough for the
+bridge and a load driver: QoS 0/1 (PUBACK, no redelivery), retained messages,
+the last will, + and # wildcards, keepalive pings. `python3 mqtt_broker.py
+--port 1883` runs it standalone.
+
+make_broker() returns a BrokerProcess running `mosquitto` when it is
+installed, else the embedded broker, in a child process on a fixed port, so
+a test can kill and restart it under a live bridge.
+"""
+import argparse
+import asyncio
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+
+def free_port(host="127.0.0.1"):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def topic_matches(pattern, topic):
+    parts, levels = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(parts):
+        if part == "#":
+            return True
+        if i >= len(levels) or part not in ("+", levels[i]):
+            return False
+    return len(parts) == len(levels)
+
+
+def _string(data, pos):
+    (n,) = struct.unpack_from("!H", data, pos)
+    return data[pos + 2:pos + 2 + n], pos + 2 + n
+
+
+def _encode(text):
+    raw = text.encode() if isinstance(text, str) else text
+    return struct.pack("!H", len(raw)) + raw
+
+
+def packet(kind, flags, body):
+    """Fixed header (type, flags, remaining length) + body."""
+    n, length = len(body), bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        length.append(byte | (0x80 if n else 0))
+        if not n:
+            break
+    return bytes([kind << 4 | flags]) + bytes(length) + body
+
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 12, 13, 14
+
+
+class Session:
+    """One client connection."""
+
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.subscriptions = {}
+        self.will = None
+        self.mid = 0
+
+    async def read_packet(self):
+        (head,) = await self.reader.readexactly(1)
+        multiplier, length = 1, 0
+        while True:
+            (byte,) = await self.reader.readexactly(1)
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return head >> 4, head & 0x0F, await self.reader.readexactly(length)
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def deliver(self, topic, payload, qos, retain=False):
+        body = _encode(topic)
+        if qos:
+            self.mid = self.mid % 0xFFFF + 1
+            body += struct.pack("!H", self.mid)
+        self.send(packet(PUBLISH, (qos << 1) | int(retain), body + payload))
+
+    def _connect(self, body):
+        _, pos = _string(body, 0)   # protocol name
+        flags = body[pos + 1]
+        _, pos = _string(body, pos + 4)   # client id
+        if flags & 0x04:
+            topic, pos = _string(body, pos)
+            payload, pos = _string(body, pos)
+            self.will = (topic.decode(), payload, (flags >> 3) & 3, bool(flags & 0x20))
+
+    def _publish(self, flags, body):
+        qos = (flags >> 1) & 3
+        topic, pos = _string(body, 0)
+        if qos:
+            self.send(packet(PUBACK, 0, body[pos:pos + 2]))
+            pos += 2
+        self.broker.publish(topic.decode(), body[pos:], qos, bool(flags & 1))
+
+    def _subscribe(self, body):
+        mid, pos, granted = body[:2], 2, bytearray()
+        patterns = []
+        while pos < len(body):
+            pattern, pos = _string(body, pos)
+            qos = min(body[pos], 1)
+            pos += 1
+            self.subscriptions[pattern.decode()] = qos
+            patterns.append((pattern.decode(), qos))
+            granted.append(qos)
+        self.send(packet(SUBACK, 0, mid + bytes(granted)))
+        for topic, (payload, qos) in list(self.broker.retained.items()):
+            for pattern, sub_qos in patterns:
+                if topic_matches(pattern, topic):
+                    self.deliver(topic, payload, min(qos, sub_qos), retain=True)
+                    break
+
+    async def serve(self):
+        clean = False
+        try:
+            kind, _, body = await self.read_packet()
+            if kind != CONNECT:
+                return
+            self._connect(body)
+            self.send(packet(CONNACK, 0, b"\x00\x00"))
+            self.broker.sessions.add(self)
+            while True:
+                kind, flags, body = await self.read_packet()
+                if kind == PUBLISH:
+                    self._publish(flags, body)
+                elif kind == SUBSCRIBE:
+                    self._subscribe(body)
+                elif kind == PINGREQ:
+                    self.send(packet(PINGRESP, 0, b""))
+                elif kind == DISCONNECT:
+                    clean = True
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker.sessions.discard(self)
+            if not clean and self.will:
+                self.broker.publish(*self.will)
+            self.writer.close()
+
+
+class Broker:
+    """The embedded broker: asyncio server holding sessions and retained messages."""
+
+    def __init__(self):
+        self.sessions = set()
+        self.retained = {}
+
+    def publish(self, topic, payload, qos, retain):
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        for session in list(self.sessions):
+            for pattern, sub_qos in session.subscriptions.items():
+                if topic_matches(pattern, topic):
+                    session.deliver(topic, payload, min(qos, sub_qos))
+                    break
+
+    async def serve(self, host, port):
+        async def client(reader, writer):
+            await Session(self, reader, writer).serve()
+
+        server = await asyncio.start_server(client, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+class BrokerProcess:
+    """A broker in a child process on a fixed local port.
+
+    stop() is SIGKILL, like a crashed broker: no DISCONNECT, no will, no
+    retained state kept. Running it out of process also keeps the broker off
+    the GIL of the bridge under test.
+    """
+
+    def __init__(self, name, command, host="127.0.0.1", port=None):
+        self.name = name
+        self.host = host
+        self.port = port or free_port(host)
+        self.command = [part.format(port=self.port) for part in command]
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            self.command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection((self.host, self.port), timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.02)
+        self.stop()
+        raise RuntimeError(f"{self.name} broker did not listen on port {self.port}")
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def close(self):
+        self.stop()
+
+
+def make_broker(kind="auto", host="127.0.0.1", port=None):
+    """embedded | mosquitto | auto (mosquitto if installed)."""
+    mosquitto = shutil.which("mosquitto")
+    if kind == "mosquitto" or (kind == "auto" and mosquitto):
+        if not mosquitto:
+            raise RuntimeError("mosquitto is not installed")
+        return BrokerProcess("mosquitto", [mosquitto, "-p", "{port}"], host, port)
+    return BrokerProcess(
+        "embedded", [sys.executable, __file__, "--host", host, "--port", "{port}"],
+        host, port,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Minimal local MQTT 3.1.1 broker.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(Broker().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""Load / soak harness for the irrigation tap bridge.
+
+Runs the real bridge (stub valves, no GPIO) in-process against a local
+broker and drives it with a paho client, so network timing, reconnects and
+the fail-safe are exercised end to end:
+
+  driver --(direct)--> broker <--(DelayProxy)--> bridge --> RecordingValve
+
+  * broker: mosquitto if installed, else the embedded one (mqtt_broker.py),
+  * DelayProxy: TCP proxy on the bridge's link adding latency/jitter; it also
+    records when the bridge had a live connection,
+  * the driver toggles ON/OFF round-robin over the zones at --rate commands/s,
+  * chaos: the broker is killed every --kill-every s for --down-for s,
+  * a probe zone the driver leaves alone: the run starts once a command to it
+    is applied and ends once one sent after the last command is (no sleeps).
+
+Report: commands sent and applied per second, p50/p99/max latency from a
+command being sent to its valve write, and every interval in which a valve
+stayed open without a live bridge connection (the fail-safe window).
+
+Run from the role directory (or anywhere):
+
+    python3 tests/soak_bridge.py --rate 2000 --duration 30 --kill-every 10
+    python3 tests/soak_bridge.py --runtime asyncio --delay-ms 20 --jitter-ms 10
+
+The same harness runs as a short smoke test in test_bridge_soak.py.
+"""
+import argparse
+import asyncio
+import bisect
+import contextlib
+import importlib.util
+import json
+import logging
+import os
+import pathlib
+import random
+import socket
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+import mqtt_broker  # noqa: E402
+
+MODULE_PATH = (
+    pathlib.Path(__file__).resolve().parent.parent / "files" / "irrigation_tap_bridge.py"
+)
+TOPIC_PREFIX = "soak"
+PROBE_ZONE = "probe"   # not driven; tells when the bridge has applied what was sent
+
+
+def load_bridge_module():
+    if "irrigation_tap_bridge" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("irrigation_tap_bridge", MODULE_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules["irrigation_tap_bridge"] = module
+    return sys.modules["irrigation_tap_bridge"]
+
+
+bridge_mod = load_bridge_module()
+
+
+class RecordingValve(bridge_mod.StubValve):
+    """StubValve that records (monotonic time, is_open) per write, silently."""
+
+    def __init__(self):
+        self.events = []
+
+    def open(self):
+        self.events.append((time.monotonic(), True))
+
+    def close(self):
+        self.events.append((time.monotonic(), False))
+
+
+class DelayProxy:
+    """TCP proxy adding delay + jitter per chunk, order preserved.
+
+    Each accepted connection is one bridge session; `sessions` holds
+    [up, down] monotonic times (down None while live). When either side
+    closes, both are closed, so a dead broker is a dead bridge connection.
+    """
+
+    def __init__(self, upstream_host, upstream_port, delay_s=0.0, jitter_s=0.0, seed=0):
+        self.upstream = (upstream_host, upstream_port)
+        self.delay_s = delay_s
+        self.jitter_s = jitter_s
+        self.random = random.Random(seed)
+        self.port = mqtt_broker.free_port()
+        self.sessions = []
+        self.pumps = set()
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        threading.Thread(target=self.loop.run_forever, name="proxy", daemon=True).start()
+
+    async def _pump(self, reader, writer):
+        release = 0.0
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                if self.delay_s or self.jitter_s:
+                    due = time.monotonic() + self.delay_s + self.random.uniform(0, self.jitter_s)
+                    release = max(release, due)
+                    await asyncio.sleep(max(release - time.monotonic(), 0))
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            return
+
+    async def _client(self, reader, writer):
+        try:
+            up_reader, up_writer = await asyncio.open_connection(*self.upstream)
+        except OSError:
+            writer.close()
+            return
+        session = [time.monotonic(), None]
+        self.sessions.append(session)
+        pumps = [
+            asyncio.ensure_future(self._pump(reader, up_writer)),
+            asyncio.ensure_future(self._pump(up_reader, writer)),
+        ]
+        self.pumps.update(pumps)
+        await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+        session[1] = time.monotonic()
+        for task in pumps:
+            task.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+        self.pumps.difference_update(pumps)
+        writer.transport.abort()
+        up_writer.transport.abort()
+
+    def start(self):
+        async def start():
+            self.server = await asyncio.start_server(self._client, "127.0.0.1", self.port)
+
+        asyncio.run_coroutine_threadsafe(start(), self.loop).result()
+
+    def close(self):
+        async def stop():
+            self.server.close()
+            for task in list(self.pumps):
+                task.cancel()
+            while self.pumps:
+                await asyncio.sleep(0.01)
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def connected(self):
+        return any(down is None for _, down in self.sessions)
+
+
+@contextlib.contextmanager
+def environ(**values):
+    saved = {key: os.environ.get(key) for key in values}
+    os.environ.update({key: str(value) for key, value in values.items()})
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+class ThreadRuntime:
+    """Bridge on paho's network thread (RUNTIME=thread), minus signal.pause."""
+
+    def __init__(self, bridge):
+        self.bridge = bridge
+
+    def start(self):
+        b = self.bridge
+        b.client.connect_async(b.host, b.port, keepalive=b.keepalive)
+        b.client.loop_start()
+
+    def stop(self):
+        b = self.bridge
+        b.stopping = True
+        b.client.disconnect()
+        b.client.loop_stop()
+        b.scheduler.stop()
+
+
+class AsyncRuntime:
+    """AsyncBridge.serve() on an event loop thread (RUNTIME=asyncio)."""
+
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self._main(),),
+                                       name="bridge-loop", daemon=True)
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.ready.set()
+        await self.bridge.serve(self.stop_event)
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stop_event.set)
+        self.thread.join(timeout=15)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def match_latencies(commands, events, sessions=None):
+    """Seconds from each command to the valve write it caused (one zone).
+
+    A command can only be applied over the bridge session it reached, so a
+    write matches a command sent in the same live session (`sessions`: sorted
+    (up, down) pairs) -- the first unmatched one of the same state, since
+    commands are applied in order and earlier ones were applied or lost.
+    Writes outside a session (the fail-safe close after a disconnect) and
+    writes without a matching command (watchdog) are skipped.
+    """
+    sessions = sessions if sessions is not None else [(float("-inf"), float("inf"))]
+    starts = [up for up, _ in sessions]
+    sent = [t for t, _ in commands]
+    latencies, first = [], 0
+    for t_event, state in events:
+        k = bisect.bisect_right(starts, t_event) - 1
+        if k < 0 or t_event > sessions[k][1]:
+            continue
+        i = max(first, bisect.bisect_left(sent, starts[k]))
+        while i < len(commands) and commands[i][0] <= t_event and commands[i][1] != state:
+            i += 1
+        if i < len(commands) and commands[i][0] <= t_event:
+            latencies.append(t_event - commands[i][0])
+            first = i + 1
+    return latencies
+
+
+def open_intervals(events, end):
+    intervals, opened = [], None
+    for t, state in events:
+        if state and opened is None:
+            opened = t
+        elif not state and opened is not None:
+            intervals.append((opened, t))
+            opened = None
+    if opened is not None:
+        intervals.append((opened, end))
+    return intervals
+
+
+def uncovered(interval, covers):
+    """Parts of interval not covered by the (sorted, disjoint) covers."""
+    start, end = interval
+    gaps = []
+    for c_start, c_end in covers:
+        if c_end <= start:
+            continue
+        if c_start >= end:
+            break
+        if c_start > start:
+            gaps.append((start, c_start))
+        start = max(start, c_end)
+        if start >= end:
+            break
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+class Chaos(threading.Thread):
+    """Kill the broker every `every` seconds for `down_for` seconds."""
+
+    def __init__(self, broker, every, down_for, until):
+        super().__init__(name="chaos", daemon=True)
+        self.broker = broker
+        self.every = every
+        self.down_for = down_for
+        self.until = until
+        self.outages = []
+
+    def run(self):
+        next_kill = time.monotonic() + self.every
+        while next_kill + self.down_for < self.until:
+            time.sleep(max(next_kill - time.monotonic(), 0))
+            down = time.monotonic()
+            self.broker.stop()
+            time.sleep(self.down_for)
+            self.broker.start()
+            self.outages.append((down, time.monotonic()))
+            next_kill += self.every
+
+
+def drive(client, zones, rate, duration, qos):
+    """Publish alternating ON/OFF round-robin; returns {zone: [(t, on)]}."""
+    commands = {zone: [] for zone in zones}
+    state = dict.fromkeys(zones, False)
+    start = time.monotonic()
+    sent = 0
+    while True:
+        now = time.monotonic()
+        if now - start >= duration:
+            return commands
+        due = int((now - start) * rate)
+        while sent < due:
+            zone = zones[sent % len(zones)]
+            state[zone] = not state[zone]
+            # Stamped before publish(): on a loaded host the bridge can apply
+            # the command before publish() returns to this thread.
+            t_sent = time.monotonic()
+            info = client.publish(f"{TOPIC_PREFIX}/{zone}/set",
+                                  "ON" if state[zone] else "OFF", qos=qos)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                commands[zone].append((t_sent, state[zone]))
+            else:
+                state[zone] = not state[zone]   # not sent; resend this state
+            sent += 1
+        time.sleep(0.001)
+
+
+def make_driver(host, port):
+    try:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="soak-driver")
+    except (AttributeError, TypeError):
+        client = mqtt.Client(client_id="soak-driver")
+    client.max_queued_messages_set(1)
+    client.reconnect_delay_set(0.1, 0.2)   # the driver is back as soon as the broker is
+    # paho leaves Nagle on; a stream of small publishes would then wait for
+    # the broker's delayed ACKs (~40 ms) and skew the latencies.
+    client.on_connect = lambda c, *args: c.socket().setsockopt(
+        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client.connect_async(host, port, keepalive=5)
+    client.loop_start()
+    return client
+
+
+def wait_until(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def probe(client, valve, zone, on, timeout, qos=1):
+    """Command zone until its valve is written to `on`; False on timeout.
+
+    The bridge applies commands in the order they arrive, so once the probe
+    zone is written every command sent before the probe has been applied.
+    """
+    since = time.monotonic()
+    deadline = since + timeout
+    written = lambda: any(t >= since and is_open == on for t, is_open in valve.events)  # noqa: E731
+    while not written():
+        if time.monotonic() >= deadline:
+            return False
+        client.publish(f"{TOPIC_PREFIX}/{zone}/set", "ON" if on else "OFF", qos=qos)
+        wait_until(written, 0.2)   # not subscribed yet, or lost in an outage: resend
+    return True
+
+
+def run_soak(runtime="thread", broker="auto", zones=4, rate=1000, duration=10.0,
+             kill_every=0.0, down_for=1.0, delay_ms=0.0, jitter_ms=0.0,
+             keepalive=5, driver_qos=0, coalesce_ms=0.0, seed=0):
+    """Run one soak and return the report dict."""
+    names = [f"z{i}" for i in range(zones)]
+    server = mqtt_broker.make_broker(broker)
+    server.start()
+    proxy = DelayProxy(server.host, server.port, delay_ms / 1000, jitter_ms / 1000, seed)
+    proxy.start()
+    env = dict(
+        MQTT_HOST="127.0.0.1", MQTT_PORT=proxy.port, MQTT_KEEPALIVE=keepalive,
+        GPIO_BACKEND="stub", TOPIC_PREFIX=TOPIC_PREFIX, MAX_OPEN=zones + 1,
+        ZONES=",".join(f"{name}:{100 + i}" for i, name in enumerate(names + [PROBE_ZONE])),
+        MAX_ON_SECONDS=max(duration * 10, 60), METRICS_PORT=0, COALESCE_MS=coalesce_ms,
+    )
+    with environ(**env):
+        bridge = (bridge_mod.AsyncBridge if runtime == "asyncio" else bridge_mod.Bridge)()
+    valves = {}
+    for name, zone in bridge.zones.items():
+        zone.valve = valves[name] = RecordingValve()
+    runner = (AsyncRuntime if runtime == "asyncio" else ThreadRuntime)(bridge)
+    runner.start()
+    driver = make_driver(server.host, server.port)
+    chaos = None
+    try:
+        if not wait_until(lambda: bridge.metrics.connects and driver.is_connected(), 10):
+            raise RuntimeError("bridge or driver did not connect to the broker")
+        # Subscribed once a probe command is applied.
+        if not (probe(driver, valves[PROBE_ZONE], PROBE_ZONE, True, 10)
+                and probe(driver, valves[PROBE_ZONE], PROBE_ZONE, False, 10)):
+            raise RuntimeError("bridge does not apply commands")
+        started = time.monotonic()
+        if kill_every:
+            chaos = Chaos(server, kill_every, down_for, started + duration)
+            chaos.start()
+        commands = drive(driver, names, rate, duration, driver_qos)
+        if chaos:
+            chaos.join()
+        wait_until(proxy.connected, keepalive * 2)
+        # Drained: the commands still in flight are applied before the probe.
+        probe(driver, valves[PROBE_ZONE], PROBE_ZONE, True, keepalive * 2, driver_qos)
+        ended = time.monotonic()
+    finally:
+        driver.loop_stop()
+        driver.disconnect()
+        runner.stop()
+        proxy.close()
+        server.close()
+
+    live = sorted((up, down if down is not None else ended) for up, down in proxy.sessions)
+    latencies, unsafe, applied = [], [], 0
+    for name in names:
+        events = [e for e in valves[name].events if started <= e[0] <= ended]
+        zone_latencies = match_latencies(commands[name], events, live)
+        latencies += zone_latencies
+        applied += len(zone_latencies)
+        for interval in open_intervals(events, ended):
+            for gap_start, gap_end in uncovered(interval, live):
+                unsafe.append({"zone": name, "at_s": round(gap_start - started, 3),
+                               "open_s": round(gap_end - gap_start, 4)})
+    sent = sum(len(c) for c in commands.values())
+    ms = lambda v: None if v is None else round(v * 1000, 2)   # noqa: E731
+    # Broker back -> bridge connected again (paho's reconnect backoff).
+    lags = [min((up for up, _ in live if up >= back), default=ended) - back
+            for _, back in (chaos.outages if chaos else [])]
+    return {
+        "runtime": runtime,
+        "broker": server.name,
+        "zones": zones,
+        "rate": rate,
+        "duration_s": duration,
+        "delay_ms": delay_ms,
+        "jitter_ms": jitter_ms,
+        "coalesce_ms": coalesce_ms,
+        "outages": len(chaos.outages) if chaos else 0,
+        "sent": sent,
+        "applied": applied,
+        "sent_per_s": round(sent / duration, 1),
+        "applied_per_s": round(applied / duration, 1),
+        "latency_p50_ms": ms(percentile(latencies, 0.50)),
+        "latency_p99_ms": ms(percentile(latencies, 0.99)),
+        "latency_max_ms": ms(max(latencies) if latencies else None),
+        "reconnects": max(bridge.metrics.connects - 1, 0),
+        "reconnect_lag_max_ms": ms(max(lags) if lags else None),
+        "failsafe_closes": bridge.metrics.failsafe_closes,
+        "coalesced": sum(bridge.metrics.coalesced[name] for name in names),
+        "open_without_connection": unsafe,
+    }
+
+
+def print_report(report):
+    width = max(len(key) for key in report)
+    for key, value in report.items():
+        if key == "open_without_connection":
+            continue
+        print(f"{key:<{width}}  {value}")
+    unsafe = report["open_without_connection"]
+    worst = max((u["open_s"] for u in unsafe), default=0.0)
+    print(f"{'open_without_connection':<{width}}  {len(unsafe)} interval(s), "
+          f"longest {worst * 1000:.1f} ms")
+    for u in unsafe:
+        print(f"  {u['zone']} at {u['at_s']:.3f}s: open {u['open_s'] * 1000:.1f} ms "
+              "without a live connection")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load/soak test the irrigation tap bridge.")
+    parser.add_argument("--runtime", choices=("thread", "asyncio"), default="thread")
+    parser.add_argument("--broker", choices=("auto", "embedded", "mosquitto"), default="auto")
+    parser.add_argument("--zones", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=1000, help="commands per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--kill-every", type=float, default=0,
+                        help="kill the broker every N seconds (0 = never)")
+    parser.add_argument("--down-for", type=float, default=1.0,
+                        help="seconds the broker stays down per kill")
+    parser.add_argument("--delay-ms", type=float, default=0, help="added link delay")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="added random delay")
+    parser.add_argument("--keepalive", type=int, default=5)
+    parser.add_argument("--coalesce-ms", type=float, default=0,
+                        help="bridge COALESCE_MS (a burst applies its final state)")
+    parser.add_argument("--driver-qos", type=int, choices=(0, 1), default=0)
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    report = run_soak(
+        runtime=args.runtime, broker=args.broker, zones=args.zones, rate=args.rate,
+        duration=args.duration, kill_every=args.kill_every, down_for=args.down_for,
+        delay_ms=args.delay_ms, jitter_ms=args.jitter_ms, keepalive=args.keepalive,
+        driver_qos=args.driver_qos, coalesce_ms=args.coalesce_ms,
+    )
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["open_without_connection"] and max(
+        u["open_s"] for u in report["open_without_connection"]) > 1.0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,10 +10,16 @@ laptop/CI. They cover the safety-critical behaviour: command handling, the
 max-on watchdog, the disconnect fail-safe, and the active-high/-low GPIO level
 mapping (so a booting pin leaves the valve closed).
 """
+import asyncio
+import json
 import importlib.util
 import pathlib
 import sys
+import threading
+import time
 import types
+import urllib.error
+import urllib.request
 
 import pytest
 
@@ -34,6 +40,7 @@ class FakeClient:
 
     def publish(self, topic, payload, qos=0, retain=False):
         self.published.append((topic, payload, retain))
+        return types.SimpleNamespace(mid=len(self.published), rc=0)
 
     def subscribe(self, topic, qos=0):
         self.subscribed.append(topic)
@@ -138,10 +145,22 @@ class FakeTimer:
         self.cancelled = True
 
 
+class FakeScheduler:
+    """Stands in for DeadlineScheduler: every deadline is a FakeTimer."""
+
+    def call_later(self, delay, fn):
+        timer = FakeTimer(delay, fn)
+        timer.start()
+        return timer
+
+    def stop(self):
+        pass
+
+
 @pytest.fixture
 def fake_timer(monkeypatch):
     FakeTimer.instances.clear()
-    monkeypatch.setattr(mod.threading, "Timer", FakeTimer)
+    monkeypatch.setattr(mod, "DeadlineScheduler", FakeScheduler)
     return FakeTimer
 
 
@@ -177,6 +196,79 @@ def test_watchdog_disabled_when_zero(make_bridge, fake_timer):
     assert fake_timer.instances == []   # no timer armed
 
 
+def test_stale_watchdog_trip_is_ignored(make_bridge, fake_timer):
+    b = make_bridge(MAX_ON_SECONDS=2400)
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    b._on_message(None, None, msg(b.t_set, "OFF"))
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    fake_timer.instances[0].fn()    # fired just as the zone was re-opened
+    assert b.is_open is True
+    fake_timer.instances[-1].fn()
+    assert b.is_open is False
+
+
+# --- deadline scheduler ---------------------------------------------------
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return predicate()
+
+
+def test_scheduler_fires_in_deadline_order_on_one_thread():
+    s = mod.DeadlineScheduler()
+    fired = []
+    for name, delay in [("c", 0.06), ("a", 0.02), ("b", 0.04)]:
+        s.call_later(delay, lambda n=name: fired.append((n, threading.get_ident())))
+    assert wait_for(lambda: len(fired) == 3)
+    s.stop()
+    assert [n for n, _ in fired] == ["a", "b", "c"]
+    assert len({ident for _, ident in fired}) == 1
+
+
+def test_scheduler_cancel_and_rearm():
+    s = mod.DeadlineScheduler()
+    fired = []
+    first = s.call_later(0.02, lambda: fired.append("first"))
+    first.cancel()
+    first.cancel()                  # idempotent
+    s.call_later(0.03, lambda: fired.append("second"))
+    assert wait_for(lambda: fired == ["second"])
+    assert len(s) == 0
+    s.stop()
+
+
+def test_scheduler_compacts_cancelled_deadlines():
+    s = mod.DeadlineScheduler()
+    for _ in range(1000):
+        s.call_later(3600, lambda: None).cancel()
+    assert len(s._heap) < 100 and len(s) == 0
+    s.stop()
+
+
+def test_watchdog_closes_valve_with_real_scheduler(make_bridge):
+    b = make_bridge(MAX_ON_SECONDS=0.05)
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    assert b.is_open is True
+    assert wait_for(lambda: not b.is_open)
+    assert b.client.last(b.t_state) == ("OFF", True)
+    b.scheduler.stop()
+
+
+def test_toggling_starts_no_thread_per_command(make_bridge):
+    b = make_bridge(ZONES=ZONES, MAX_OPEN=3, MAX_ON_SECONDS=2400)
+    b._on_message(None, None, msg("irrigation/front/set", "ON"))
+    threads = threading.active_count()
+    for _ in range(500):
+        for name in b.zones:
+            b._on_message(None, None, msg(f"irrigation/{name}/set", "ON"))
+            b._on_message(None, None, msg(f"irrigation/{name}/set", "OFF"))
+    b._on_message(None, None, msg("irrigation/back/set", "ON"))
+    assert threading.active_count() == threads
+    assert len(b.scheduler) == 1
+    b.scheduler.stop()
+
+
 # --- disconnect fail-safe -------------------------------------------------
 def test_disconnect_closes_valve(bridge):
     bridge._on_message(None, None, msg(bridge.t_set, "ON"))
@@ -219,6 +311,12 @@ def _fake_lgpio(calls):
         gpio_claim_output=lambda h, pin, level: calls.append(("claim", pin, level)),
         gpio_write=lambda h, pin, level: calls.append(("write", pin, level)),
         gpiochip_close=lambda h: calls.append(("close",)),
+        RISING_EDGE=1,
+        SET_PULL_UP=32,
+        gpio_claim_alert=lambda h, pin, edge, flags: calls.append(("alert", pin, edge, flags)),
+        callback=lambda h, pin, edge, fn: calls.append(("callback", pin, fn)) or
+        types.SimpleNamespace(cancel=lambda: calls.append(("cancel", pin))),
+        gpio_free=lambda h, pin: calls.append(("free", pin)),
     )
 
 
@@ -251,3 +349,864 @@ def test_real_valve_cleanup_closes_and_releases(monkeypatch):
     v.cleanup()
     assert ("write", 17, 0) in calls   # closed during cleanup
     assert ("close",) in calls
+
+
+# --- multi-zone -----------------------------------------------------------
+ZONES = "front:17,back:27:600,herbs:22"
+
+
+@pytest.fixture
+def zones(make_bridge):
+    return make_bridge(ZONES=ZONES, MAX_OPEN=2, MAX_ON_SECONDS=2400)
+
+
+def test_zone_topics_and_wildcard_subscription(zones):
+    assert sorted(zones.zones) == ["back", "front", "herbs"]
+    assert zones.zones["back"].t_set == "irrigation/back/set"
+    assert zones.zones["back"].t_state == "irrigation/back/state"
+    zones._on_connect(zones.client, None, None, 0)
+    assert zones.client.subscribed == ["irrigation/+/set", "irrigation/plan/set"]
+    assert zones.client.last("irrigation/availability") == ("online", True)
+    for name in zones.zones:
+        assert zones.client.last(f"irrigation/{name}/availability") == ("online", True)
+        assert zones.client.last(f"irrigation/{name}/state") == ("OFF", True)
+
+
+def test_zone_commands_are_routed_per_zone(zones):
+    zones._on_message(None, None, msg("irrigation/back/set", "ON"))
+    assert zones.zones["back"].is_open is True
+    assert zones.zones["front"].is_open is False
+    assert zones.client.last("irrigation/back/state") == ("ON", True)
+    assert zones.client.last("irrigation/front/state") is None
+
+
+def test_unknown_zone_is_ignored(zones):
+    zones._on_message(None, None, msg("irrigation/pond/set", "ON"))
+    assert zones.is_open is False
+    assert zones.client.published == []
+
+
+def test_max_open_refuses_extra_zone(zones):
+    zones._on_message(None, None, msg("irrigation/front/set", "ON"))
+    zones._on_message(None, None, msg("irrigation/back/set", "ON"))
+    zones._on_message(None, None, msg("irrigation/herbs/set", "ON"))
+    assert [z.name for z in zones.open_zones()] == ["front", "back"]
+    assert zones.client.last("irrigation/herbs/state") == ("OFF", True)
+    # Re-sending ON to an open zone is not blocked by the cap.
+    zones._on_message(None, None, msg("irrigation/back/set", "ON"))
+    assert zones.zones["back"].is_open is True
+    zones._on_message(None, None, msg("irrigation/front/set", "OFF"))
+    zones._on_message(None, None, msg("irrigation/herbs/set", "ON"))
+    assert zones.zones["herbs"].is_open is True
+
+
+def test_per_zone_watchdog_limit(fake_timer, zones):
+    zones._on_message(None, None, msg("irrigation/back/set", "ON"))
+    zones._on_message(None, None, msg("irrigation/front/set", "ON"))
+    assert [t.interval for t in fake_timer.instances] == [600, 2400]
+    fake_timer.instances[0].fn()
+    assert zones.zones["back"].is_open is False
+    assert zones.zones["front"].is_open is True
+
+
+def test_disconnect_closes_all_zones(zones):
+    zones._on_message(None, None, msg("irrigation/front/set", "ON"))
+    zones._on_message(None, None, msg("irrigation/back/set", "ON"))
+    zones._on_disconnect()
+    assert zones.open_zones() == []
+
+
+@pytest.mark.parametrize("spec", ["front", "front:17,back:17", "a:1,a:2", "a/b:3", "", "plan:5"])
+def test_bad_zone_specs_rejected(spec):
+    with pytest.raises(ValueError):
+        mod.parse_zones(spec or ",", 2400)
+
+
+def test_real_zones_share_one_chip_handle(make_bridge, monkeypatch):
+    calls = []
+    fake = _fake_lgpio(calls)
+    opened = []
+    fake.gpiochip_open = lambda chip: opened.append(chip) or ("handle", chip)
+    monkeypatch.setitem(sys.modules, "lgpio", fake)
+    b = make_bridge(ZONES=ZONES, GPIO_BACKEND="real", GPIO_CHIP=0, ACTIVE_HIGH="false")
+    assert opened == [0]
+    assert [c for c in calls if c[0] == "claim"] == [
+        ("claim", 17, 1), ("claim", 27, 1), ("claim", 22, 1),
+    ]
+    for zone in b.zones.values():
+        zone.valve.cleanup()
+    assert ("close",) not in calls      # valves do not close the shared handle
+    b.chip.close()
+    assert calls[-1] == ("close",)
+
+
+# --- metrics --------------------------------------------------------------
+def sample(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[-1])
+    return None
+
+
+def test_metrics_command_latency_and_counters(make_bridge, fake_timer):
+    b = make_bridge(MAX_ON_SECONDS=2400)
+    b._on_connect(b.client, None, None, 0)
+    on = msg(b.t_set, "ON")
+    on.timestamp = time.monotonic() - 0.003   # paho's receipt stamp
+    b._on_message(None, None, on)
+    b.zones["tap"].opened_at -= 5             # pretend it has been open 5 s
+    fake_timer.instances[-1].fn()             # watchdog trip
+    b._on_message(None, None, msg(b.t_set, "GARBAGE"))
+    b._on_message(None, None, msg("irrigation/other/set", "ON"))
+    b._on_disconnect()
+    b._on_connect(b.client, None, None, 0)
+
+    text = b.metrics.render(b)
+    assert sample(text, 'irrigation_command_latency_seconds_count{zone="tap"}') == 1
+    assert sample(text, 'irrigation_command_latency_seconds_bucket{zone="tap",le="0.001"}') == 0
+    assert sample(text, 'irrigation_command_latency_seconds_bucket{zone="tap",le="+Inf"}') == 1
+    assert sample(text, 'irrigation_zone_open_seconds_total{zone="tap"}') >= 5
+    assert sample(text, 'irrigation_zone_open{zone="tap"}') == 0
+    assert sample(text, 'irrigation_watchdog_trips_total{zone="tap"}') == 1
+    assert sample(text, 'irrigation_unknown_commands_total{reason="payload"}') == 1
+    assert sample(text, 'irrigation_unknown_commands_total{reason="zone"}') == 1
+    assert sample(text, "irrigation_failsafe_closes_total") == 1
+    assert sample(text, "irrigation_mqtt_reconnects_total") == 1
+
+
+def test_metrics_publish_ack_round_trip(bridge):
+    info = bridge._publish(bridge.t_state, "OFF")
+    bridge._on_publish(bridge.client, None, info.mid)
+    bridge._on_publish(bridge.client, None, 999)   # unknown mid is ignored
+    assert sample(bridge.metrics.render(bridge), "irrigation_publish_ack_seconds_count") == 1
+
+
+def test_metrics_puback_before_publish_returns(bridge, monkeypatch):
+    publish = bridge.client.publish
+
+    def acked_at_once(*args, **kwargs):   # paho's network thread wins the race
+        info = publish(*args, **kwargs)
+        bridge._on_publish(bridge.client, None, info.mid)
+        return info
+
+    monkeypatch.setattr(bridge.client, "publish", acked_at_once)
+    bridge._publish(bridge.t_state, "OFF")
+    assert sample(bridge.metrics.render(bridge), "irrigation_publish_ack_seconds_count") == 1
+    assert bridge.metrics._sent == {} and bridge.metrics._early == {}
+
+
+def test_metrics_unacked_publishes_are_bounded(bridge, monkeypatch):
+    monkeypatch.setattr(mod, "UNACKED_MAX", 8)
+    for _ in range(20):
+        bridge._publish(bridge.t_state, "OFF")   # never acked
+    assert len(bridge.metrics._sent) == 8
+    bridge._on_disconnect(bridge.client, None, 0)
+    assert bridge.metrics._sent == {}
+
+
+def test_metrics_endpoint(bridge):
+    server = mod.start_metrics_server(bridge, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(url + "/metrics") as resp:
+            assert resp.headers["Content-Type"].startswith("text/plain")
+            text = resp.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other")
+    finally:
+        server.shutdown()
+    assert "# TYPE irrigation_command_latency_seconds histogram" in text
+    assert sample(text, 'irrigation_zone_open{zone="tap"}') == 0
+
+
+def test_metrics_bind_to_loopback_by_default(make_bridge):
+    assert make_bridge().metrics_host == "127.0.0.1"
+    assert make_bridge(METRICS_HOST="192.168.1.20").metrics_host == "192.168.1.20"
+
+
+# --- asyncio runtime ------------------------------------------------------
+class RecordingValve(mod.Valve):
+    """Records (action, thread) per write; `during_open` runs inside open()."""
+
+    def __init__(self):
+        self.writes = []
+        self.during_open = None
+
+    def open(self):
+        self.writes.append(("open", threading.get_ident()))
+        if self.during_open:
+            self.during_open()
+
+    def close(self):
+        self.writes.append(("close", threading.get_ident()))
+
+
+@pytest.fixture
+def make_async_bridge(monkeypatch):
+    def factory(**env):
+        env.setdefault("GPIO_BACKEND", "stub")
+        for key, value in env.items():
+            monkeypatch.setenv(key, str(value))
+        bridge = mod.AsyncBridge()
+        bridge.client = FakeClient()
+        for zone in bridge.zones.values():
+            zone.valve = RecordingValve()
+        return bridge
+
+    return factory
+
+
+def run_async(bridge, scenario):
+    async def main():
+        await bridge.start()
+        bridge._on_connect(bridge.client, None, None, 0)
+        try:
+            await scenario(bridge)
+        finally:
+            bridge.gpio.shutdown(wait=True)
+
+    asyncio.run(main())
+
+
+def test_async_commands_queued_and_written_off_loop(make_async_bridge):
+    async def scenario(b):
+        valve = b.zones["tap"].valve
+        b._on_message(None, None, msg(b.t_set, "ON"))
+        assert b.is_open is False             # queued, not applied in the callback
+        await b.queue.join()
+        assert b.is_open is True
+        assert valve.writes[-1][0] == "open"
+        assert valve.writes[-1][1] != threading.get_ident()
+        assert b.client.last(b.t_state) == ("ON", True)
+        mid = len(b.client.published)
+        ack = b._acks[mid]
+        b._on_publish(b.client, None, mid)   # PUBACK
+        assert ack.done()
+        await asyncio.sleep(0.01)
+        assert mid not in b._acks
+
+    run_async(make_async_bridge(), scenario)
+
+
+def test_async_missing_puback_is_logged(make_async_bridge, monkeypatch, caplog):
+    monkeypatch.setattr(mod, "PUBLISH_TIMEOUT_S", 0.02)
+
+    async def scenario(b):
+        assert await b._publish(b.t_state, "OFF") is None
+
+    run_async(make_async_bridge(), scenario)
+    assert "No PUBACK" in caplog.text
+
+
+def test_async_disconnect_closes_and_drops_queued_commands(make_async_bridge):
+    async def scenario(b):
+        b._on_message(None, None, msg("irrigation/front/set", "ON"))
+        await b.queue.join()
+        b._on_message(None, None, msg("irrigation/back/set", "ON"))
+        b._on_disconnect()
+        await b.queue.join()
+        await asyncio.get_running_loop().run_in_executor(b.gpio, lambda: None)
+        assert b.open_zones() == []
+        assert b.zones["front"].valve.writes[-1][0] == "close"
+        assert [w for w, _ in b.zones["back"].valve.writes] == ["close", "close"]
+
+    run_async(make_async_bridge(ZONES=ZONES, MAX_OPEN=2), scenario)
+
+
+def test_async_open_racing_disconnect_ends_closed(make_async_bridge):
+    async def scenario(b):
+        loop = asyncio.get_running_loop()
+        valve = b.zones["tap"].valve
+        valve.during_open = lambda: loop.call_soon_threadsafe(b._on_disconnect)
+        b._on_message(None, None, msg(b.t_set, "ON"))
+        await b.queue.join()
+        await asyncio.sleep(0.01)
+        await loop.run_in_executor(b.gpio, lambda: None)
+        assert b.is_open is False
+        assert valve.writes[-1][0] == "close"
+
+    run_async(make_async_bridge(), scenario)
+
+
+def test_async_watchdog_uses_loop_timer(make_async_bridge):
+    async def scenario(b):
+        b._on_message(None, None, msg(b.t_set, "ON"))
+        await b.queue.join()
+        assert b.is_open is True
+        assert isinstance(b.zones["tap"].timer, asyncio.TimerHandle)
+        await asyncio.sleep(0.1)
+        await b.queue.join()
+        assert b.is_open is False
+        assert b.client.last(b.t_state) == ("OFF", True)
+
+    run_async(make_async_bridge(MAX_ON_SECONDS=0.05), scenario)
+
+
+# --- idempotent writes + coalescing ---------------------------------------
+def states(bridge, topic):
+    return [p for t, p, _ in bridge.client.published if t == topic]
+
+
+def test_repeated_command_writes_and_publishes_nothing(make_bridge, fake_timer):
+    b = make_bridge(MAX_ON_SECONDS=2400)
+    valve = b.zones["tap"].valve = RecordingValve()
+    for payload in ("ON", "ON", "1", "OFF", "OFF"):
+        b._on_message(None, None, msg(b.t_set, payload))
+    assert [w for w, _ in valve.writes] == ["open", "close"]
+    assert states(b, b.t_state) == ["ON", "OFF"]
+    assert len(fake_timer.instances) == 1    # the repeated ON did not re-arm
+    text = b.metrics.render(b)
+    assert sample(text, 'irrigation_valve_transitions_total{zone="tap",state="open"}') == 1
+    assert sample(text, 'irrigation_valve_transitions_total{zone="tap",state="closed"}') == 1
+    assert sample(text, 'irrigation_commands_coalesced_total{zone="tap"}') == 3
+
+
+def test_coalescing_collapses_burst_to_final_state(make_bridge, fake_timer, caplog):
+    caplog.set_level("INFO", logger="irrigation-tap")
+    b = make_bridge(COALESCE_MS=50, MAX_ON_SECONDS=0)
+    valve = b.zones["tap"].valve = RecordingValve()
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    assert b.is_open is False and fake_timer.instances[-1].interval == 0.05
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    assert len(fake_timer.instances) == 1    # one window per burst
+    fake_timer.instances[-1].fn()
+    assert b.is_open is True
+    assert [w for w, _ in valve.writes] == ["open"]
+    assert states(b, b.t_state) == ["ON"]
+    assert "Valve tap open: command ON" in caplog.text
+
+
+def test_coalescing_off_is_immediate_and_drops_pending_on(make_bridge, fake_timer):
+    b = make_bridge(COALESCE_MS=50, MAX_ON_SECONDS=0)
+    valve = b.zones["tap"].valve = RecordingValve()
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    first = fake_timer.instances[-1]
+    b._on_message(None, None, msg(b.t_set, "OFF"))
+    assert first.cancelled is True
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    first.fn()                               # fired just as the OFF landed
+    assert b.is_open is False and valve.writes == []
+    fake_timer.instances[-1].fn()
+    assert [w for w, _ in valve.writes] == ["open"]
+
+
+def test_coalescing_pending_on_dropped_on_disconnect(make_bridge, fake_timer):
+    b = make_bridge(COALESCE_MS=50, MAX_ON_SECONDS=0)
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    b._on_disconnect()
+    fake_timer.instances[-1].fn()
+    assert b.is_open is False
+
+
+def test_async_coalescing_and_idempotent_writes(make_async_bridge):
+    async def scenario(b):
+        valve = b.zones["tap"].valve
+        for payload in ("ON", "OFF", "ON", "ON"):
+            b._on_message(None, None, msg(b.t_set, payload))
+        await asyncio.sleep(0.1)
+        await b.queue.join()
+        assert b.is_open is True
+        b._on_message(None, None, msg(b.t_set, "OFF"))
+        b._on_message(None, None, msg(b.t_set, "OFF"))
+        await b.queue.join()
+        assert [w for w, _ in valve.writes][1:] == ["open", "close"]   # [0]: start()
+        assert states(b, b.t_state) == ["OFF", "ON", "OFF"]             # [0]: connect
+
+    run_async(make_async_bridge(COALESCE_MS=20), scenario)
+
+
+# --- actuation journal ----------------------------------------------------
+def read_journal(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_journal_buffers_until_flush(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = mod.Journal(str(path), flush_s=3600)
+    journal.record("open", "tap", reason="command ON")
+    assert not path.exists()                 # record() never touches the disk
+    journal.flush()
+    assert [r["ev"] for r in read_journal(path)] == ["start", "open"]
+    journal.close()
+
+
+def test_journal_replay_gives_totals_and_last_run(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    clock = iter(range(1000, 2000)).__next__
+    journal = mod.Journal(str(path), flush_s=3600, clock=clock)
+    journal.record("open", "tap")
+    journal.record("close", "tap", s=60.0, reason="command OFF")
+    journal.record("open", "tap")
+    journal.record("close", "tap", s=30.5, reason="watchdog timeout")
+    journal.close()
+    with path.open("a") as f:
+        f.write('{"t": 99, "ev": "op')   # torn by a power cut
+
+    stats = mod.Journal(str(path), flush_s=3600).zone_stats("tap")
+    assert stats["runs"] == 2 and stats["seconds"] == 90.5
+    assert stats["last_run"] == {"start": 1003, "end": 1004, "seconds": 30.5,
+                                 "reason": "watchdog timeout"}
+
+
+def test_journal_counts_run_left_open_by_a_crash(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    path.write_text('{"t":100,"ev":"open","zone":"tap"}\n{"t":160,"ev":"failsafe"}\n')
+    journal = mod.Journal(str(path), flush_s=3600)
+    journal.close()
+    stats = mod.Journal(str(path), flush_s=3600).zone_stats("tap")
+    assert stats["runs"] == 1 and stats["seconds"] == 60
+    assert stats["last_run"]["reason"] == "bridge restart"
+
+
+def test_journal_rotates_with_totals_snapshot(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = mod.Journal(str(path), flush_s=3600, max_bytes=200, keep=2)
+    for _ in range(3):
+        for _ in range(5):
+            journal.record("open", "tap")
+            journal.record("close", "tap", s=1.0)
+        journal.flush()
+    journal.close()
+    assert (tmp_path / "journal.jsonl.1").exists()
+    assert (tmp_path / "journal.jsonl.2").exists()
+    assert not (tmp_path / "journal.jsonl.3").exists()
+    assert read_journal(path)[0]["ev"] == "totals"
+    assert mod.Journal(str(path), flush_s=3600).zone_stats("tap")["runs"] == 15
+
+
+def test_journal_rotation_keeps_a_run_in_progress(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    clock = iter(range(1000, 2000)).__next__
+    journal = mod.Journal(str(path), flush_s=3600, max_bytes=200, keep=2, clock=clock)
+    for _ in range(4):
+        journal.record("open", "tap")
+        journal.record("close", "tap", s=1.0)
+    journal.record("open", "tap")
+    journal.flush()                     # rotates while tap is open
+    assert (tmp_path / "journal.jsonl.1").exists()
+    assert [r["ev"] for r in read_journal(path)] == ["open", "totals"]
+    journal.record("close", "tap", s=45.0, l=9.0, reason="command OFF")
+    journal.close()
+
+    stats = mod.Journal(str(path), flush_s=3600).zone_stats("tap")
+    assert stats["runs"] == 5 and stats["seconds"] == 49.0 and stats["litres"] == 9.0
+    assert stats["last_run"]["start"] == 1009
+
+
+def test_journal_crash_after_rotation_counts_the_open_run(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    clock = iter(range(1000, 2000)).__next__
+    journal = mod.Journal(str(path), flush_s=3600, max_bytes=50, keep=2, clock=clock)
+    journal.record("open", "tap")
+    journal.flush()                     # rotates; the bridge then dies
+    journal.close()
+    assert [r["ev"] for r in read_journal(path)] == ["open"]
+
+    stats = mod.Journal(str(path), flush_s=3600).zone_stats("tap")
+    assert stats["runs"] == 1 and stats["last_run"]["reason"] == "bridge restart"
+
+
+def test_bridge_journals_actuations_and_publishes_stats(make_bridge, fake_timer, tmp_path):
+    path = tmp_path / "journal.jsonl"
+    b = make_bridge(JOURNAL_PATH=path, JOURNAL_FLUSH_S=3600, MAX_ON_SECONDS=2400)
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    b._on_message(None, None, msg(b.t_set, "OFF"))
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    fake_timer.instances[-1].fn()            # watchdog trip
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    b._on_disconnect()
+    b.journal.close()
+    events = [(r["ev"], r.get("reason")) for r in read_journal(path)]
+    assert events == [
+        ("start", None), ("open", "command ON"), ("close", "command OFF"),
+        ("open", "command ON"), ("watchdog", None), ("close", "watchdog timeout"),
+        ("open", "command ON"), ("failsafe", None), ("close", "fail-safe"),
+    ]
+
+    b2 = make_bridge(JOURNAL_PATH=path, JOURNAL_FLUSH_S=3600)
+    b2._on_connect(b2.client, None, None, 0)
+    stats = json.loads(b2.client.last("irrigation/tap/stats")[0])
+    assert stats["runs"] == 3
+    assert stats["last_run"]["reason"] == "fail-safe"
+    b2.journal.close()
+
+
+# --- cold start -----------------------------------------------------------
+def test_startup_timer_phases_count_once():
+    timer = mod.StartupTimer(started=10.0)
+    timer.mark("imports", 10.5)
+    timer.mark("gpio", 10.6)
+    timer.mark("gpio", 12.0)                 # a later reconnect does not count
+    timer.mark("publish", 10.75)
+    assert timer.phases == pytest.approx({"imports": 0.5, "gpio": 0.1, "publish": 0.15})
+    assert timer.done()
+    assert timer.summary() == "imports 500ms, gpio 100ms, publish 150ms; total 750ms"
+
+
+def test_broker_address_cache(tmp_path, monkeypatch):
+    lookups = []
+
+    def getaddrinfo(host, port, type=0):
+        lookups.append(host)
+        return [(None, None, None, "", (answer, port))]
+
+    monkeypatch.setattr(mod.socket, "getaddrinfo", getaddrinfo)
+    cache = tmp_path / "broker.json"
+    answer = "10.0.0.5"
+    assert mod.BrokerAddress("mars", 1883, str(cache)).lookup() == ("10.0.0.5", "dns")
+    assert mod.BrokerAddress("mars", 1883, str(cache)).lookup() == ("10.0.0.5", "cache")
+    assert mod.BrokerAddress("venus", 1883, str(cache)).cached() is None   # other host
+    answer = "10.0.0.9"                      # the broker moved
+    assert mod.BrokerAddress("mars", 1883, str(cache)).resolve() == "10.0.0.9"
+    assert mod.BrokerAddress("mars", 1883, str(cache)).cached() == "10.0.0.9"
+    assert lookups == ["mars", "mars"]   # the cache hit and the other host: no lookup
+
+
+def test_broker_address_lookup_failure_falls_back_to_name(monkeypatch):
+    def getaddrinfo(*args, **kwargs):
+        raise mod.socket.gaierror("no network yet")
+
+    monkeypatch.setattr(mod.socket, "getaddrinfo", getaddrinfo)
+    assert mod.BrokerAddress("mars", 1883).lookup() == ("mars", "none")
+
+
+def test_sd_notify(tmp_path, monkeypatch):
+    assert mod.sd_notify("READY=1") is False   # not under systemd
+    path = str(tmp_path / "notify")
+    with mod.socket.socket(mod.socket.AF_UNIX, mod.socket.SOCK_DGRAM) as server:
+        server.bind(path)
+        monkeypatch.setenv("NOTIFY_SOCKET", path)
+        assert mod.sd_notify("READY=1\nSTATUS=online") is True
+        assert server.recv(100) == b"READY=1\nSTATUS=online"
+
+
+def test_first_puback_marks_startup_and_reports_ready(bridge, monkeypatch):
+    notified = []
+    monkeypatch.setattr(mod, "sd_notify", notified.append)
+    with mod.socket.socket() as sock:
+        bridge._on_socket_open(bridge.client, None, sock)
+        assert sock.getsockopt(mod.socket.IPPROTO_TCP, mod.socket.TCP_NODELAY)
+    bridge._on_connect(bridge.client, None, None, 0)
+    bridge._on_publish(bridge.client, None, 1)
+    bridge._on_publish(bridge.client, None, 2)
+    assert list(bridge.startup.phases) == ["imports", "connect", "connack", "publish"]
+    assert notified == ["READY=1\nSTATUS=online"]
+    bridge._ready("waiting for broker")      # the fallback timer is a no-op now
+    assert len(notified) == 1
+    text = bridge.metrics.render(bridge)
+    assert sample(text, 'irrigation_startup_phase_seconds{phase="publish"}') >= 0
+
+
+def test_connect_failure_re_resolves_broker(bridge, monkeypatch):
+    targets = []
+    bridge.client.connect_async = lambda host, port, keepalive: targets.append(host)
+    bridge.address = "10.0.0.5"              # from the cache, now stale
+    monkeypatch.setattr(bridge.broker, "resolve", lambda: "10.0.0.9")
+    bridge._on_connect_fail(bridge.client, None)
+    bridge._on_connect_fail(bridge.client, None)
+    assert bridge.address == "10.0.0.9" and targets == ["10.0.0.9"]
+
+
+# --- flow meter -----------------------------------------------------------
+def test_stub_flow_meter_train_counts_every_pulse():
+    meter = mod.StubFlowMeter()
+    meter.train(2000, 0.25).join()   # a timed train ends on its own, every pulse sent
+    assert meter.pulses == 500
+    thread = meter.train(1000)
+    assert wait_for(lambda: meter.pulses > 500, timeout=10)
+    meter.cleanup()
+    thread.join(timeout=10)
+    assert not thread.is_alive()     # stopped: no further pulses can arrive
+
+
+def test_real_flow_meter_counts_rising_edges(monkeypatch):
+    calls = []
+    monkeypatch.setitem(sys.modules, "lgpio", _fake_lgpio(calls))
+    meter = mod.RealFlowMeter(chip=0, pin=23)
+    assert ("alert", 23, 1, 32) in calls   # rising edge, pull-up
+    pulse = next(c[2] for c in calls if c[0] == "callback")
+    for _ in range(3):
+        pulse(0, 23, 1, 0)                 # lgpio's (chip, gpio, level, tick)
+    assert meter.pulses == 3
+    meter.cleanup()
+    assert calls[-3:] == [("cancel", 23), ("free", 23), ("close",)]
+
+
+@pytest.fixture
+def flow_bridge(make_bridge, fake_timer):
+    return make_bridge(FLOW_PIN=23, FLOW_PULSES_PER_LITRE=100, FLOW_INTERVAL_S=10,
+                       FLOW_LEAK_LITRES=0.5, FLOW_LEAK_GRACE_S=10)
+
+
+def test_litres_command_opens_and_closes_after_volume(flow_bridge):
+    b, zone = flow_bridge, flow_bridge.zones["tap"]
+    b._on_connect(b.client, None, None, 0)
+    assert "irrigation/tap/litres/set" in b.client.subscribed
+    b._on_message(None, None, msg("irrigation/tap/litres/set", "2.5"))
+    assert b.is_open is True
+    b.flow.meter.pulses += 249
+    b._flow_tick(now=1.0)
+    assert b.is_open is True
+    b.flow.meter.pulses += 1
+    b._flow_tick(now=1.25)
+    assert b.is_open is False
+    assert b.client.last(b.t_state) == ("OFF", True)
+    assert b.metrics.volume_closes["tap"] == 1
+    assert zone.limit_pulses is None
+    b._on_message(None, None, msg(b.t_set, "ON"))    # a plain ON has no limit
+    b.flow.meter.pulses += 1000
+    b._flow_tick(now=1.5)
+    assert b.is_open is True
+
+
+def test_off_clears_litres_limit(flow_bridge):
+    b = flow_bridge
+    b._on_message(None, None, msg("irrigation/tap/litres/set", "1"))
+    b._on_message(None, None, msg(b.t_set, "OFF"))
+    assert b.zones["tap"].limit_pulses is None
+    before = b.metrics.unknown_commands["payload"]
+    b._on_message(None, None, msg("irrigation/tap/litres/set", "lots"))
+    assert b.metrics.unknown_commands["payload"] == before + 1
+    assert b.is_open is False
+
+
+def test_leak_alarm_after_grace_and_clear(flow_bridge):
+    b = flow_bridge
+    b.flow.sampled = (100.0, 0)
+    b._on_message(None, None, msg(b.t_set, "ON"))
+    b._flow_tick(now=100.0)
+    b._on_message(None, None, msg(b.t_set, "OFF"))
+    b.flow.meter.pulses += 80                # the line draining after close
+    b._flow_tick(now=105.0)
+    assert b.flow.leak is False
+    b._flow_tick(now=111.0)
+    b.flow.meter.pulses += 49
+    b._flow_tick(now=112.0)
+    assert b.flow.leak is False
+    b.flow.meter.pulses += 1                 # 0.5 L with every valve closed
+    b._flow_tick(now=113.0)
+    assert b.flow.leak is True
+    assert b.client.last("irrigation/tap/leak") == ("ON", True)
+    assert b.metrics.leak_alarms == 1
+    b._flow_tick(now=121.0)                  # publish interval with flow: stays
+    assert b.flow.leak is True
+    b._flow_tick(now=131.0)                  # an interval without a pulse
+    assert b.flow.leak is False
+    assert b.client.last("irrigation/tap/leak") == ("OFF", True)
+
+
+def test_flow_published_per_interval_and_skipped_when_idle(flow_bridge):
+    b = flow_bridge
+    b.flow.sampled = (0.0, 0)
+    b.flow.meter.pulses = 600
+    b._flow_tick(now=10.0)
+    assert json.loads(b.client.last("irrigation/tap/flow")[0]) == {
+        "rate_lpm": 36.0, "total_l": 6.0}
+    b._flow_tick(now=15.0)                   # inside the interval
+    b._flow_tick(now=20.0)                   # flow stopped: one rate-0 publish
+    assert json.loads(b.client.last("irrigation/tap/flow")[0])["rate_lpm"] == 0
+    published = len(b.client.published)
+    b._flow_tick(now=30.0)
+    assert len(b.client.published) == published
+    text = b.metrics.render(b)
+    assert sample(text, "irrigation_flow_litres_total") == 6.0
+
+
+def test_flow_inject_drives_stub_meter(flow_bridge):
+    b = flow_bridge
+    b._on_connect(b.client, None, None, 0)
+    assert b.flow.t_inject in b.client.subscribed
+    b._on_message(None, None, msg(b.flow.t_inject, "1000:0.1"))
+    assert wait_for(lambda: b.flow.meter.pulses == 100)
+    b.flow.meter.cleanup()
+
+
+def test_async_volume_close(make_async_bridge, monkeypatch):
+    monkeypatch.setenv("FLOW_PIN", "23")
+    monkeypatch.setenv("FLOW_PULSES_PER_LITRE", "100")
+
+    async def scenario(b):
+        b._on_message(None, None, msg("irrigation/tap/litres/set", "1"))
+        await b.queue.join()
+        assert b.is_open is True
+        b.flow.meter.pulses += 100
+        b._flow_tick()
+        await b.queue.join()
+        assert b.is_open is False
+        assert b.metrics.volume_closes["tap"] == 1
+        b.flow.timer.cancel()
+
+    run_async(make_async_bridge(), scenario)
+
+
+# --- run plans ------------------------------------------------------------
+PLAN = '{"id": "evening", "steps": [{"zone": "front", "minutes": 1}, {"zone": "back", "seconds": 30}]}'
+
+
+def progress(bridge):
+    return [event["ev"] for topic, payload, retain in bridge.client.published
+            if topic == "irrigation/plan/progress" for event in json.loads(payload)]
+
+
+def test_plan_runs_steps_in_order(fake_timer, zones):
+    zones._on_connect(zones.client, None, None, 0)
+    zones._on_message(None, None, msg("irrigation/plan/set", PLAN))
+    assert [z.name for z in zones.open_zones()] == ["front"]
+    assert zones.plan.timer.interval == 60
+    state = json.loads(zones.client.last("irrigation/plan/state")[0])
+    assert (state["status"], state["step"], state["zone"]) == ("running", 1, "front")
+    zones.plan.timer.fn()
+    assert [z.name for z in zones.open_zones()] == ["back"]
+    assert zones.plan.timer.interval == 30
+    zones.plan.timer.fn()
+    assert zones.open_zones() == [] and zones.plan is None
+    assert json.loads(zones.client.last("irrigation/plan/state")[0])["status"] == "done"
+    assert progress(zones) == ["start", "step", "step", "done"]
+    assert ("irrigation/plan/progress", False) in {(t, r) for t, _, r in zones.client.published}
+    assert zones.metrics.plans["done"] == 1
+
+
+def test_plan_survives_outage_and_reports_in_one_batch(fake_timer, zones):
+    zones._on_connect(zones.client, None, None, 0)
+    zones._on_message(None, None, msg("irrigation/herbs/set", "ON"))
+    zones._on_message(None, None, msg("irrigation/plan/set", PLAN))
+    assert {z.name for z in zones.open_zones()} == {"herbs", "front"}
+    zones._on_disconnect()
+    assert [z.name for z in zones.open_zones()] == ["front"]   # herbs fail-safe closed
+    published = len(zones.client.published)
+    zones.plan.timer.fn()                      # steps on without the broker
+    zones.plan.timer.fn()
+    assert zones.open_zones() == []
+    assert not any(t.startswith("irrigation/plan/")
+                   for t, _, _ in zones.client.published[published:])
+    zones._on_connect(zones.client, None, None, 0)
+    batches = [json.loads(p) for t, p, _ in zones.client.published[published:]
+               if t == "irrigation/plan/progress"]
+    assert [[e["ev"] for e in batch] for batch in batches] == [["step", "done"]]
+    assert json.loads(zones.client.last("irrigation/plan/state")[0])["status"] == "done"
+
+
+def test_off_cancels_plan_and_watchdog_aborts_it(fake_timer, zones):
+    zones._on_message(None, None, msg("irrigation/plan/set", PLAN))
+    zones._on_message(None, None, msg("irrigation/front/set", "OFF"))
+    assert zones.plan is None and zones.open_zones() == []
+    assert zones.metrics.plans["cancelled"] == 1
+    zones._on_message(None, None, msg("irrigation/plan/set", PLAN.replace("evening", "late")))
+    zones.zones["front"].timer.fn()            # watchdog backstop
+    assert zones.plan is None and zones.open_zones() == []
+    assert zones.metrics.plans["aborted"] == 1
+    zones._on_message(None, None, msg("irrigation/plan/set", PLAN.replace("late", "again")))
+    zones._on_message(None, None, msg("irrigation/plan/set", "CANCEL"))
+    assert zones.plan is None and zones.open_zones() == []
+
+
+def back_plan(plan_id, *minutes):
+    return json.dumps({"id": plan_id, "steps": [{"zone": "back", "minutes": m} for m in minutes]})
+
+
+def test_plan_step_on_an_open_zone_restarts_its_watchdog(fake_timer, zones):
+    # back's watchdog is 600 s: two 8-minute steps outlast one deadline.
+    zones._on_message(None, None, msg("irrigation/plan/set", back_plan("twice", 8, 8)))
+    back = zones.zones["back"]
+    first = back.timer
+    assert first.interval == 600
+    zones.plan.timer.fn()                     # step 2, same zone: stays open
+    assert back.is_open and back.timer is not first and first.cancelled
+    assert back.timer.interval == 600
+    first.fn()                                # the old deadline, fired late
+    assert back.is_open and zones.plan is not None
+    assert zones.metrics.watchdog_trips["back"] == 0
+    back.timer.fn()                           # the new one still applies
+    assert not back.is_open and zones.metrics.plans["aborted"] == 1
+
+
+@pytest.mark.parametrize("opener", ["plan", "manual"])
+def test_plan_taking_over_an_open_zone_restarts_its_watchdog(fake_timer, zones, opener):
+    if opener == "plan":
+        zones._on_message(None, None, msg("irrigation/plan/set", back_plan("first", 8)))
+    else:
+        zones._on_message(None, None, msg("irrigation/back/set", "ON"))
+    back = zones.zones["back"]
+    first = back.timer
+    zones._on_message(None, None, msg("irrigation/plan/set", back_plan("second", 9)))
+    assert back.is_open and zones.plan.id == "second"
+    assert back.timer is not first and first.cancelled
+    first.fn()
+    assert back.is_open and zones.metrics.watchdog_trips["back"] == 0
+    zones.plan.timer.fn()
+    assert not back.is_open and zones.metrics.plans["done"] == 1
+
+
+@pytest.mark.parametrize("payload", [
+    '{"steps": [{"zone": "lawn", "minutes": 1}]}',           # unknown zone
+    '{"steps": [{"zone": "back", "minutes": 11}]}',          # beyond back's 600 s watchdog
+    '{"steps": [{"zone": "front"}]}',                        # no duration
+    '{"steps": []}',
+    "front 10 min",
+])
+def test_bad_plans_rejected(zones, payload):
+    zones._on_message(None, None, msg("irrigation/plan/set", payload))
+    assert zones.plan is None and zones.open_zones() == []
+    assert json.loads(zones.client.last("irrigation/plan/state")[0])["status"] == "rejected"
+
+
+def test_rejected_plan_state_names_the_plan(zones):
+    zones._on_message(None, None, msg("irrigation/plan/set",
+                                      '{"id": "daily-1", "steps": [{"zone": "front"}]}'))
+    state = json.loads(zones.client.last("irrigation/plan/state")[0])
+    assert state["status"] == "rejected" and state["id"] == "daily-1"
+
+
+def test_retained_and_repeated_plans_are_ignored(fake_timer, zones):
+    retained = types.SimpleNamespace(topic="irrigation/plan/set", payload=PLAN.encode(),
+                                     retain=True)
+    zones._on_message(None, None, retained)
+    assert zones.plan is None
+    zones._on_message(None, None, msg("irrigation/plan/set", PLAN))
+    timer = zones.plan.timer
+    zones._on_message(None, None, msg("irrigation/plan/set", PLAN))   # QoS 1 redelivery
+    assert zones.plan.timer is timer and not timer.cancelled
+
+
+def test_async_plan_step_on_an_open_zone_restarts_its_watchdog(make_async_bridge,
+                                                               monkeypatch):
+    monkeypatch.setenv("ZONES", ZONES)
+
+    async def scenario(b):
+        b.scheduler = FakeScheduler()
+        b._on_message(None, None, msg("irrigation/plan/set", back_plan("twice", 8, 8)))
+        await b.queue.join()
+        back = b.zones["back"]
+        first = back.timer
+        b.plan.timer.fn()
+        first.fn()                  # trip of the old deadline queued behind the step
+        await b.queue.join()
+        assert back.is_open and b.plan is not None and first.cancelled
+        assert b.metrics.watchdog_trips["back"] == 0
+        b.plan.timer.fn()
+        await b.queue.join()
+        assert not back.is_open and b.metrics.plans["done"] == 1
+
+    run_async(make_async_bridge(), scenario)
+
+
+def test_async_plan_survives_outage(make_async_bridge, monkeypatch):
+    monkeypatch.setenv("ZONES", ZONES)
+
+    async def scenario(b):
+        b.scheduler = FakeScheduler()   # the steps end when the test says so
+        b._on_message(None, None, msg("irrigation/plan/set", json.dumps(
+            {"steps": [{"zone": "front", "seconds": 60}, {"zone": "back", "seconds": 60}]})))
+        await b.queue.join()
+        assert [z.name for z in b.open_zones()] == ["front"]
+        b._on_disconnect()
+        assert [z.name for z in b.open_zones()] == ["front"]
+        b.plan.timer.fn()               # step 1 ends during the outage
+        await b.queue.join()
+        assert [z.name for z in b.open_zones()] == ["back"]
+        b.plan.timer.fn()
+        await b.queue.join()
+        assert b.open_zones() == [] and b.plan is None
+        assert [e["ev"] for e in b.plan_events] == ["step", "done"]
+
+    run_async(make_async_bridge(), scenario)
@@ -2,6 +2,10 @@
 # Mars Home Assistant backup script for Scaleway Object Storage
 # Runs every 6 hours via systemd timer
 # Uses rclone sync for incremental backups
+#
+# The HA recorder database is not synced as a file: mars-db-snapshot first
+# takes a consistent online backup of it into a deduplicated chunk store, and
+# only the store (new chunks + a small manifest per snapshot) is uploaded.
 
 set -euo pipefail
 
@@ -14,6 +18,11 @@ BACKUP_DIRS="/opt/smartworkx/volumes"
 REMOTE="scaleway:com-smartworkx-mars-backup"
 LOG_FILE="/var/log/mars-backup.log"
 
+RECORDER_DB="$BACKUP_DIRS/home-assistant/config/home-assistant_v2.db"
+SNAPSHOT_STORE="/opt/snapshots/home-assistant"
+SNAPSHOT_KEEP=28
+STATUS=0
+
 # Function to log messages
 log() {
     echo "[$(date '+%Y-%m-%d %H:%M:%S')] $1" | tee -a "$LOG_FILE"
@@ -21,12 +30,44 @@ log() {
 
 log "Starting Mars Home Assistant incremental backup"
 
+# Snapshot the recorder database into the chunk store; a failure is logged
+# and reported at the end, the other volumes are still synced.
+if [ -f "$RECORDER_DB" ]; then
+    log "Snapshotting $RECORDER_DB to $SNAPSHOT_STORE"
+    if /usr/local/bin/mars-db-snapshot snapshot --db "$RECORDER_DB" --store "$SNAPSHOT_STORE" \
+            --keep "$SNAPSHOT_KEEP" 2>&1 | tee -a "$LOG_FILE"; then
+        log "Uploading new chunks from $SNAPSHOT_STORE"
+        # Chunks are immutable and named by their hash, so only new ones move.
+        if rclone sync "$SNAPSHOT_STORE" "$REMOTE$SNAPSHOT_STORE" \
+                --exclude "/tmp/**" \
+                --exclude "/lock" \
+                --exclude "*.tmp" \
+                --transfers 8 \
+                --checkers 16 \
+                --stats-one-line \
+                --log-level INFO \
+                2>&1 | tee -a "$LOG_FILE"; then
+            log "Successfully synced $SNAPSHOT_STORE"
+        else
+            log "ERROR: Failed to sync $SNAPSHOT_STORE"
+            STATUS=1
+        fi
+    else
+        log "ERROR: Failed to snapshot $RECORDER_DB"
+        STATUS=1
+    fi
+else
+    log "WARNING: $RECORDER_DB does not exist, no recorder snapshot"
+fi
+
 # Sync volumes directory to remote storage
 if [ -d "$BACKUP_DIRS" ]; then
     log "Syncing $BACKUP_DIRS to $REMOTE/opt/smartworkx/volumes"
 
-    # Use rclone sync to mirror the directory (only transfer changes)
+    # Use rclone sync to mirror the directory (only transfer changes); the
+    # live recorder files are covered by the snapshot above.
     rclone sync "$BACKUP_DIRS" "$REMOTE/opt/smartworkx/volumes" \
+        --exclude "/home-assistant/config/home-assistant_v2.db*" \
         --progress \
         --transfers 4 \
         --checkers 8 \
@@ -45,4 +86,9 @@ else
     exit 1
 fi
 
+if [ $STATUS -ne 0 ]; then
+    log "Backup completed with errors"
+    exit $STATUS
+fi
+
 log "Backup completed successfully"
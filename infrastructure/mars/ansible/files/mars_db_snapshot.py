@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""Deduplicated snapshots of the Home Assistant recorder database (Mars).
+
+rclone re-uploads the whole multi-GB home-assistant_v2.db whenever a single
+page changed, and can copy it halfway through a write. This takes a
+consistent copy with SQLite's online backup API (HA keeps writing; the copy
+restarts when it does, and after SNAPSHOT_MAX_RESTARTS the rest is copied in
+one step), splits it into content-defined chunks and keeps every chunk once
+in a content-addressed store:
+
+  <store>/chunks/ab/ab12...      zlib-compressed chunk, named by the sha256
+                                 of its uncompressed bytes; never modified
+  <store>/snapshots/<name>.json  size, sha256 and chunk list of one snapshot
+  <store>/tmp/                   the backup copy while it is being chunked;
+                                 not part of the store (leave out of uploads)
+
+A snapshot only writes the chunks the store does not have yet, so what
+mars-backup.sh uploads (and how long that takes) scales with what changed,
+not with the size of the database.
+
+Chunk boundaries fall on page boundaries (SQLite changes whole pages) and are
+chosen by the content of the page, not its offset: a page whose crc32 has its
+low bits clear ends a chunk (between MIN_CHUNK and MAX_CHUNK bytes, about
+AVG_CHUNK on average). Pages that move -- a VACUUM, a table that grew in the
+middle of the file -- therefore still cut into the same chunks around them,
+where fixed-size blocks would all shift.
+
+restore reassembles a snapshot, checks every chunk digest, the whole-file
+sha256 and PRAGMA quick_check, and only then moves it over the target (and
+removes a stale -wal/-shm next to it). verify does the same checks without
+writing a database; --deep also runs quick_check on a temporary restore.
+
+  mars-db-snapshot snapshot --db /opt/.../home-assistant_v2.db --store DIR [--keep N]
+  mars-db-snapshot restore --store DIR [--snapshot NAME] --output PATH
+  mars-db-snapshot verify --store DIR [--snapshot NAME] [--deep]
+  mars-db-snapshot list --store DIR
+
+Only the standard library; one process at a time per store (flock).
+"""
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+MIN_CHUNK = 64 * 1024
+AVG_CHUNK = 1024 * 1024
+MAX_CHUNK = 8 * 1024 * 1024
+
+ZLIB_LEVEL = 3
+READ_PAGES = 256  # pages per read() of the copy
+
+# Online backup: pages per step, pause between steps, restarts before the
+# rest is copied in one step (one short read transaction).
+SNAPSHOT_PAGES = 16384
+SNAPSHOT_SLEEP_S = 0.005
+SNAPSHOT_MAX_RESTARTS = 5
+BUSY_TIMEOUT_S = 10
+
+KEEP_SNAPSHOTS = 28  # 7 days at one snapshot per 6 hours
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class _Restarted(Exception):
+    pass
+
+
+def online_backup(db_path, dest_path, pages=SNAPSHOT_PAGES, sleep=SNAPSHOT_SLEEP_S,
+                  max_restarts=SNAPSHOT_MAX_RESTARTS):
+    """Consistent copy of a live database; returns the number of restarts."""
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _Restarted
+        last_remaining = remaining
+
+    uri = f"file:{quote(os.path.abspath(db_path))}?mode=ro"
+    src = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT_S)
+    dest = sqlite3.connect(dest_path)
+    try:
+        try:
+            src.backup(dest, pages=pages, progress=progress, sleep=sleep)
+        except _Restarted:
+            src.backup(dest, pages=-1)
+    finally:
+        dest.close()
+        src.close()
+    return restarts
+
+
+def page_size_of(path):
+    """Page size from the SQLite header (bytes 16-17; 1 means 65536)."""
+    with open(path, "rb") as f:
+        header = f.read(100)
+    if not header.startswith(b"SQLite format 3\0"):
+        raise SnapshotError(f"{path} is not an SQLite database")
+    size = int.from_bytes(header[16:18], "big")
+    return 65536 if size == 1 else size
+
+
+def chunks(f, page_size, min_chunk=MIN_CHUNK, avg_chunk=AVG_CHUNK, max_chunk=MAX_CHUNK):
+    """Yield the content-defined chunks (bytes) of a file of whole pages."""
+    min_pages = max(1, min_chunk // page_size)
+    max_pages = max(min_pages, max_chunk // page_size)
+    mask = max(1, avg_chunk // page_size) - 1  # ~1 in avg pages ends a chunk
+    chunk, pages = bytearray(), 0
+    while True:
+        block = f.read(page_size * READ_PAGES)
+        if not block:
+            break
+        for offset in range(0, len(block), page_size):
+            page = block[offset:offset + page_size]
+            chunk += page
+            pages += 1
+            if pages >= max_pages or (pages >= min_pages and zlib.crc32(page) & mask == 0):
+                yield bytes(chunk)
+                chunk, pages = bytearray(), 0
+    if chunk:
+        yield bytes(chunk)
+
+
+def _write_atomic(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ChunkStore:
+    def __init__(self, path):
+        self.path = path
+        self.chunk_dir = os.path.join(path, "chunks")
+        self.snapshot_dir = os.path.join(path, "snapshots")
+        self.tmp_dir = os.path.join(path, "tmp")
+        for directory in (self.chunk_dir, self.snapshot_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(os.path.join(self.path, "lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def clear_tmp(self):
+        """Remove what an interrupted run left in tmp/ (call under the lock)."""
+        for root, dirs, files in os.walk(self.tmp_dir, topdown=False):
+            for entry in files:
+                os.remove(os.path.join(root, entry))
+            for entry in dirs:
+                os.rmdir(os.path.join(root, entry))
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def put(self, data):
+        """Store a chunk unless present; returns (digest, compressed bytes written)."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        packed = zlib.compress(data, ZLIB_LEVEL)
+        _write_atomic(path, packed)
+        return digest, len(packed)
+
+    def get(self, digest):
+        """Chunk bytes, checked against their digest."""
+        try:
+            with open(self.chunk_path(digest), "rb") as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError:
+            raise SnapshotError(f"chunk {digest} missing") from None
+        except zlib.error as exc:
+            raise SnapshotError(f"chunk {digest} corrupt ({exc})") from None
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise SnapshotError(f"chunk {digest} corrupt (digest mismatch)")
+        return data
+
+    def names(self):
+        """Snapshot names, oldest first (names are UTC timestamps)."""
+        return sorted(n[:-5] for n in os.listdir(self.snapshot_dir) if n.endswith(".json"))
+
+    def resolve(self, name):
+        names = self.names()
+        if not names:
+            raise SnapshotError(f"no snapshots in {self.path}")
+        if name in (None, "latest"):
+            return names[-1]
+        if name not in names:
+            raise SnapshotError(f"snapshot {name} not found")
+        return name
+
+    def load(self, name):
+        with open(os.path.join(self.snapshot_dir, f"{name}.json")) as f:
+            return json.load(f)
+
+    def save(self, name, manifest):
+        data = json.dumps(manifest, indent=1).encode()
+        _write_atomic(os.path.join(self.snapshot_dir, f"{name}.json"), data)
+
+    def prune(self, keep):
+        """Drop all but the newest `keep` snapshots and the chunks only they used.
+
+        Returns (snapshots removed, chunks removed).
+        """
+        names = self.names()
+        old = names[:-keep] if keep > 0 else []
+        for name in old:
+            os.remove(os.path.join(self.snapshot_dir, f"{name}.json"))
+        if not old:
+            return 0, 0
+        referenced = set()
+        for name in self.names():
+            referenced.update(digest for digest, _ in self.load(name)["chunks"])
+        removed = 0
+        for sub in os.listdir(self.chunk_dir):
+            for digest in os.listdir(os.path.join(self.chunk_dir, sub)):
+                if digest not in referenced:
+                    os.remove(os.path.join(self.chunk_dir, sub, digest))
+                    removed += 1
+        return len(old), removed
+
+
+def snapshot(db_path, store, name=None):
+    """Back up db_path into the store; returns the manifest (plus stats)."""
+    name = name or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    started = time.monotonic()
+    store.clear_tmp()
+    tmp_dir = tempfile.mkdtemp(prefix="copy-", dir=store.tmp_dir)
+    copy = os.path.join(tmp_dir, "db")
+    try:
+        restarts = online_backup(db_path, copy)
+        page_size = page_size_of(copy)
+        whole = hashlib.sha256()
+        entries, new_chunks, new_bytes = [], 0, 0
+        with open(copy, "rb") as f:
+            for data in chunks(f, page_size):
+                whole.update(data)
+                digest, written = store.put(data)
+                entries.append([digest, len(data)])
+                new_chunks += written > 0
+                new_bytes += written
+        size = os.path.getsize(copy)
+    finally:
+        for entry in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, entry))
+        os.rmdir(tmp_dir)
+    manifest = {
+        "name": name,
+        "source": os.path.abspath(db_path),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "size": size,
+        "page_size": page_size,
+        "sha256": whole.hexdigest(),
+        "chunks": entries,
+    }
+    store.save(name, manifest)
+    manifest["stats"] = {
+        "restarts": restarts, "new_chunks": new_chunks, "new_bytes": new_bytes,
+        "seconds": time.monotonic() - started,
+    }
+    return manifest
+
+
+def assemble(store, manifest, f=None):
+    """Write (or with f=None only read) a snapshot; checks every digest."""
+    whole = hashlib.sha256()
+    size = 0
+    for digest, length in manifest["chunks"]:
+        data = store.get(digest)
+        if len(data) != length:
+            raise SnapshotError(f"chunk {digest} has {len(data)} bytes, expected {length}")
+        whole.update(data)
+        size += length
+        if f is not None:
+            f.write(data)
+    if size != manifest["size"] or whole.hexdigest() != manifest["sha256"]:
+        raise SnapshotError(f"snapshot {manifest['name']} does not reassemble to its sha256")
+
+
+def quick_check(path):
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True)
+    try:
+        result = [row[0] for row in conn.execute("PRAGMA quick_check")]
+    finally:
+        conn.close()
+    if result != ["ok"]:
+        raise SnapshotError(f"quick_check failed: {'; '.join(result[:5])}")
+
+
+def restore(store, name, output):
+    """Reassemble snapshot `name` to output once it passes every check."""
+    manifest = store.load(store.resolve(name))
+    out_dir = os.path.dirname(os.path.abspath(output))
+    fd, tmp = tempfile.mkstemp(prefix=".restore-", dir=out_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            assemble(store, manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        quick_check(tmp)
+        for suffix in ("-wal", "-shm", "-journal"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(output + suffix)  # would be replayed onto the restore
+        os.replace(tmp, output)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+    return manifest
+
+
+def verify(store, name=None, deep=False):
+    """Check snapshot `name` (None: all of them); returns the names checked."""
+    names = store.names() if name is None else [store.resolve(name)]
+    if not names:
+        raise SnapshotError(f"no snapshots in {store.path}")
+    for checked in names:
+        manifest = store.load(checked)
+        if not deep:
+            assemble(store, manifest)
+            continue
+        with tempfile.TemporaryDirectory(dir=store.tmp_dir) as tmp_dir:
+            path = os.path.join(tmp_dir, "db")
+            with open(path, "wb") as f:
+                assemble(store, manifest, f)
+            quick_check(path)
+    return names
+
+
+def _mib(n):
+    return f"{n / 1024 / 1024:.1f} MiB"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Deduplicated recorder db snapshots.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("snapshot", help="back up the database into the store")
+    p.add_argument("--db", required=True, help="live SQLite database")
+    p.add_argument("--keep", type=int, default=KEEP_SNAPSHOTS,
+                   help=f"snapshots to keep, 0 keeps all (default: {KEEP_SNAPSHOTS})")
+    p = sub.add_parser("restore", help="reassemble a snapshot into a database file")
+    p.add_argument("--snapshot", default="latest", help="name (default: latest)")
+    p.add_argument("--output", required=True, help="database file to (over)write")
+    p = sub.add_parser("verify", help="check chunks and digests of snapshots")
+    p.add_argument("--snapshot", help="name or latest (default: all)")
+    p.add_argument("--deep", action="store_true", help="also run PRAGMA quick_check")
+    sub.add_parser("list", help="list the snapshots")
+    for p in sub.choices.values():
+        p.add_argument("--store", required=True, help="chunk store directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    store = ChunkStore(args.store)
+    try:
+        with store.locked():
+            if args.command == "snapshot":
+                m = snapshot(args.db, store)
+                stats = m["stats"]
+                print(f"snapshot {m['name']}: {_mib(m['size'])} in {len(m['chunks'])} chunks,"
+                      f" {stats['new_chunks']} new ({_mib(stats['new_bytes'])} written),"
+                      f" {stats['restarts']} restarts, {stats['seconds']:.1f} s")
+                removed, chunks_removed = store.prune(args.keep)
+                if removed:
+                    print(f"pruned {removed} snapshots, {chunks_removed} chunks")
+            elif args.command == "restore":
+                m = restore(store, args.snapshot, args.output)
+                print(f"restored {m['name']} ({_mib(m['size'])}) to {args.output}")
+            elif args.command == "verify":
+                for name in verify(store, args.snapshot, args.deep):
+                    print(f"{name}: ok")
+            else:
+                for name in store.names():
+                    m = store.load(name)
+                    print(f"{name}  {_mib(m['size']):>12}  {len(m['chunks']):>6} chunks")
+    except (SnapshotError, sqlite3.Error, OSError) as exc:
+        print(f"ERROR: {exc}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
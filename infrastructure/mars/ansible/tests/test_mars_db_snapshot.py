@@ -0,0 +1,153 @@
+"""Tests for the deduplicated recorder db snapshots (files/mars_db_snapshot.py).
+
+    pytest infrastructure/mars/ansible/tests/
+
+Only the standard library is needed; the "recorder" is a ~16 MB SQLite file
+of random blobs, so chunks are written and shared like on Mars, just smaller.
+"""
+import importlib.util
+import io
+import os
+import pathlib
+import random
+import sqlite3
+
+import pytest
+
+MODULE_PATH = pathlib.Path(__file__).resolve().parent.parent / "files" / "mars_db_snapshot.py"
+_spec = importlib.util.spec_from_file_location("mars_db_snapshot", MODULE_PATH)
+mod = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(mod)
+
+ROWS = 4000
+
+
+def make_db(path, rows=ROWS, seed=1):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("CREATE TABLE statistics (id INTEGER PRIMARY KEY, data BLOB)")
+    conn.executemany("INSERT INTO statistics (data) VALUES (?)",
+                     ((rng.randbytes(3000),) for _ in range(rows)))
+    conn.commit()
+    return conn
+
+
+def rows_of(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT id, data FROM statistics ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+@pytest.fixture
+def live(tmp_path):
+    """Open connection to a WAL database (as HA keeps it) and its path."""
+    path = str(tmp_path / "home-assistant_v2.db")
+    conn = make_db(path)
+    yield conn, path
+    conn.close()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return mod.ChunkStore(str(tmp_path / "store"))
+
+
+def chunk_files(store):
+    return {name for _, _, files in os.walk(store.chunk_dir) for name in files}
+
+
+def test_snapshot_restores_to_the_same_database(live, store, tmp_path):
+    conn, path = live
+    manifest = mod.snapshot(path, store, name="a")
+    assert manifest["stats"]["new_chunks"] == len(set(d for d, _ in manifest["chunks"]))
+    assert sum(length for _, length in manifest["chunks"]) == manifest["size"]
+
+    out = str(tmp_path / "restored.db")
+    mod.restore(store, "latest", out)
+    assert rows_of(out) == rows_of(path)
+
+
+def test_second_snapshot_only_stores_changed_chunks(live, store):
+    conn, path = live
+    first = mod.snapshot(path, store, name="a")
+    conn.execute("UPDATE statistics SET data = ? WHERE id = 2000", (b"x" * 3000,))
+    conn.commit()  # stays in the WAL: the backup must still see it
+    second = mod.snapshot(path, store, name="b")
+
+    assert second["sha256"] != first["sha256"]
+    assert second["stats"]["new_chunks"] <= 3
+    assert second["stats"]["new_bytes"] < first["stats"]["new_bytes"] / 4
+    assert store.names() == ["a", "b"]
+
+
+def test_boundaries_follow_content_not_offset():
+    page = 1024
+    rng = random.Random(2)
+    data = rng.randbytes(page * 2000)
+    shifted = rng.randbytes(page) + data  # one page inserted at the front
+
+    def cut(blob):
+        return list(mod.chunks(io.BytesIO(blob), page, 4 * page, 16 * page, 64 * page))
+
+    before, after = cut(data), cut(shifted)
+    assert len(set(before) & set(after)) >= len(before) - 2
+    assert all(len(c) % page == 0 for c in before)
+
+
+def test_verify_and_restore_refuse_a_corrupt_chunk(live, store, tmp_path):
+    _, path = live
+    manifest = mod.snapshot(path, store, name="a")
+    assert mod.verify(store, deep=True) == ["a"]
+
+    digest = manifest["chunks"][len(manifest["chunks"]) // 2][0]
+    with open(store.chunk_path(digest), "r+b") as f:
+        f.seek(20)
+        f.write(b"\0\0\0\0")
+    with pytest.raises(mod.SnapshotError, match=digest):
+        mod.verify(store)
+
+    out = tmp_path / "restored.db"
+    out.write_bytes(b"keep me")
+    with pytest.raises(mod.SnapshotError):
+        mod.restore(store, "a", str(out))
+    assert out.read_bytes() == b"keep me"
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith(".restore-")] == []
+
+
+def test_restore_removes_stale_wal(live, store, tmp_path):
+    _, path = live
+    mod.snapshot(path, store, name="a")
+    out = tmp_path / "restored.db"
+    for suffix in ("-wal", "-shm"):
+        (tmp_path / f"restored.db{suffix}").write_bytes(b"stale")
+    assert mod.main(["restore", "--store", store.path, "--output", str(out)]) == 0
+    assert not (tmp_path / "restored.db-wal").exists()
+    assert rows_of(str(out)) == rows_of(path)
+
+
+def test_prune_drops_old_snapshots_and_unused_chunks(live, store):
+    conn, path = live
+    for name, row in (("a", 10), ("b", 2000), ("c", 3900)):
+        conn.execute("UPDATE statistics SET data = ? WHERE id = ?", (os.urandom(3000), row))
+        conn.commit()
+        mod.snapshot(path, store, name=name)
+    before = chunk_files(store)
+
+    removed, chunks_removed = store.prune(keep=2)
+    assert (removed, store.names()) == (1, ["b", "c"])
+    assert 0 < chunks_removed < len(before)
+    assert mod.verify(store) == ["b", "c"]
+
+
+def test_cli_snapshot_lists_and_fails_cleanly(live, store, capsys):
+    _, path = live
+    assert mod.main(["verify", "--store", store.path]) == 1
+    assert "no snapshots" in capsys.readouterr().err
+
+    assert mod.main(["snapshot", "--db", path, "--store", store.path]) == 0
+    assert " 0 restarts" in capsys.readouterr().out
+    assert mod.main(["list", "--store", store.path]) == 0
+    assert "chunks" in capsys.readouterr().out
+    assert os.listdir(store.tmp_dir) == []
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic Home Assistant recorder database for benchmarks/tests.
+
+Creates the recorder's statistics tables (statistics_meta, statistics with
+start_ts/sum/mean and the (metadata_id, start_ts) index) and fills them with
+hourly rows the way the recorder writes them: one row per sensor per hour,
+sensors interleaved. Contains everything the analysis scripts read:
+
+  * sensor.vb_{cap}kwh_energy_out  (sum, kWh) per battery size,
+  * the Zonneplan tariff          (mean, EUR/kWh, daily price curve),
+  * grid import/export power      (mean, W, day/night solar shape),
+  * optional unrelated sensors    (to make the tables realistically large).
+
+The last --fine-days (default 10, HA's purge_keep_days) also get the
+fine-grained tables: 5-minute statistics_short_term rows and raw states of the
+energy_out and tariff sensors. They are derived from the hourly rows (each
+hourly energy delta split over its twelve 5-minute periods, the tariff constant
+within the hour), so without --null-rate every resolution reports the same
+totals for that window. With it they differ: a NULL hourly sum and an
+"unavailable" state each move energy into a later period, which each
+resolution prices at a different tariff.
+
+Irregularities that the analysis must cope with:
+  --gap-rate     fraction of hours missing per sensor,
+  --null-rate    fraction of energy_out rows with a NULL sum,
+  --reset-rate   chance per hour that an energy_out sum restarts at 0.
+
+Usage: python3 make_recorder_db.py out.db --years 3 --extra-sensors 200
+"""
+
+import argparse
+import math
+import os
+import random
+import sqlite3
+import time
+
+from recalc_common import (
+    BATTERY_SIZES,
+    ENERGY_OUT_PATTERN,
+    GRID_EXPORT_ID,
+    GRID_IMPORT_ID,
+    TARIFF_ID,
+)
+
+HOUR = 3600
+SHORT_TERM = 300
+# 2024-01-01T00:00:00Z; hourly statistics start on the hour.
+DEFAULT_START_TS = 1704067200
+
+SCHEMA = """
+CREATE TABLE statistics_meta (
+    id INTEGER NOT NULL PRIMARY KEY,
+    statistic_id VARCHAR(255),
+    source VARCHAR(32),
+    unit_of_measurement VARCHAR(255),
+    unit_class VARCHAR(255),
+    has_mean BOOLEAN,
+    has_sum BOOLEAN,
+    name VARCHAR(255),
+    mean_type INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX ix_statistics_meta_statistic_id ON statistics_meta (statistic_id);
+CREATE TABLE statistics (
+    id INTEGER NOT NULL PRIMARY KEY,
+    created DATETIME,
+    created_ts FLOAT,
+    metadata_id INTEGER,
+    start DATETIME,
+    start_ts FLOAT,
+    mean FLOAT,
+    mean_weight FLOAT,
+    min FLOAT,
+    max FLOAT,
+    last_reset DATETIME,
+    last_reset_ts FLOAT,
+    state FLOAT,
+    sum FLOAT,
+    FOREIGN KEY(metadata_id) REFERENCES statistics_meta (id) ON DELETE CASCADE
+);
+CREATE UNIQUE INDEX ix_statistics_statistic_id_start_ts ON statistics (metadata_id, start_ts);
+CREATE INDEX ix_statistics_start_ts ON statistics (start_ts);
+CREATE TABLE statistics_short_term (
+    id INTEGER NOT NULL PRIMARY KEY,
+    created DATETIME,
+    created_ts FLOAT,
+    metadata_id INTEGER,
+    start DATETIME,
+    start_ts FLOAT,
+    mean FLOAT,
+    mean_weight FLOAT,
+    min FLOAT,
+    max FLOAT,
+    last_reset DATETIME,
+    last_reset_ts FLOAT,
+    state FLOAT,
+    sum FLOAT,
+    FOREIGN KEY(metadata_id) REFERENCES statistics_meta (id) ON DELETE CASCADE
+);
+CREATE UNIQUE INDEX ix_statistics_short_term_statistic_id_start_ts
+    ON statistics_short_term (metadata_id, start_ts);
+CREATE INDEX ix_statistics_short_term_start_ts ON statistics_short_term (start_ts);
+CREATE TABLE states_meta (
+    metadata_id INTEGER NOT NULL PRIMARY KEY,
+    entity_id VARCHAR(255)
+);
+CREATE UNIQUE INDEX ix_states_meta_entity_id ON states_meta (entity_id);
+CREATE TABLE states (
+    state_id INTEGER NOT NULL PRIMARY KEY,
+    entity_id CHAR(0),
+    state VARCHAR(255),
+    attributes CHAR(0),
+    event_id SMALLINT,
+    last_changed CHAR(0),
+    last_changed_ts FLOAT,
+    last_reported_ts FLOAT,
+    last_updated CHAR(0),
+    last_updated_ts FLOAT,
+    old_state_id INTEGER,
+    attributes_id INTEGER,
+    origin_idx SMALLINT,
+    metadata_id INTEGER
+);
+CREATE INDEX ix_states_metadata_id_last_updated_ts ON states (metadata_id, last_updated_ts);
+CREATE INDEX ix_states_last_updated_ts ON states (last_updated_ts);
+"""
+
+
+def tariff_at(ts, rng):
+    """Day-ahead style price: cheap at night and midday, peaks morning/evening."""
+    hour = (ts // HOUR) % 24
+    curve = 0.22 + 0.08 * math.cos((hour - 19) / 24 * 2 * math.pi) \
+        - 0.06 * math.exp(-((hour - 12) ** 2) / 8)
+    return round(max(curve + rng.gauss(0, 0.04), -0.05), 5)
+
+
+def grid_at(ts, rng):
+    """(import W, export W) hourly means."""
+    hour = (ts // HOUR) % 24
+    day = ts / 86400 / 365.25 * 2 * math.pi
+    sun = max(0.0, math.sin((hour - 6) / 12 * math.pi)) * (2500 + 1500 * math.cos(day))
+    load = 350 + 900 * rng.random() + (600 if 17 <= hour <= 21 else 0)
+    net = load - sun * rng.random()
+    return round(max(net, 0.0), 1), round(max(-net, 0.0), 1)
+
+
+def _meta_rows(batteries, extra_sensors):
+    rows = [(ENERGY_OUT_PATTERN.format(cap=cap), "kWh", 0, 1) for cap in batteries]
+    rows.append((TARIFF_ID, "EUR/kWh", 1, 0))
+    rows.append((GRID_IMPORT_ID, "W", 1, 0))
+    rows.append((GRID_EXPORT_ID, "W", 1, 0))
+    rows += [(f"sensor.synthetic_{i:04d}", "W", 1, 0) for i in range(extra_sensors)]
+    return rows
+
+
+def _statistics_rows(meta, hours, start_ts, gap_rate, null_rate, reset_rate, rng):
+    sums = {}
+    for h in range(hours):
+        ts = float(start_ts + h * HOUR)
+        created = ts + HOUR + 10
+        imp, exp = grid_at(int(ts), rng)
+        for meta_id, statistic_id in meta:
+            if gap_rate and rng.random() < gap_rate:
+                continue
+            mean = total = None
+            if statistic_id.endswith("_energy_out"):
+                if reset_rate and rng.random() < reset_rate:
+                    sums[meta_id] = 0.0
+                # Idle most hours, up to ~1 kWh per hour when discharging.
+                total = sums[meta_id] = sums.get(meta_id, 0.0) + max(
+                    0.0, rng.uniform(-1.0, 1.0)
+                )
+                if null_rate and rng.random() < null_rate:
+                    total = None
+            elif statistic_id == TARIFF_ID:
+                mean = tariff_at(int(ts), rng)
+            elif statistic_id == GRID_IMPORT_ID:
+                mean = imp
+            elif statistic_id == GRID_EXPORT_ID:
+                mean = exp
+            else:
+                mean = round(rng.uniform(0, 1000), 1)
+            yield (created, meta_id, ts, mean, mean, mean, total, total)
+
+
+def _fine_rows(conn, since_ts, null_rate, rng):
+    """statistics_short_term rows and energy/tariff states from since_ts on.
+
+    Yields ("short_term", row) and ("state", (entity_id, state, ts)) items.
+    """
+    energy_ids = {
+        meta_id for meta_id, statistic_id in conn.execute(
+            "SELECT id, statistic_id FROM statistics_meta"
+        ) if statistic_id.endswith("_energy_out")
+    }
+    hourly = conn.execute(
+        "SELECT s.metadata_id, m.statistic_id, s.start_ts, s.mean, s.sum"
+        " FROM statistics s JOIN statistics_meta m ON m.id = s.metadata_id"
+        " WHERE s.start_ts >= ? ORDER BY s.metadata_id, s.start_ts",
+        (since_ts - HOUR,),
+    ).fetchall()
+    prev = {}
+    for meta_id, statistic_id, start_ts, mean, total in hourly:
+        if meta_id not in energy_ids:
+            if start_ts < since_ts:
+                continue
+            for k in range(HOUR // SHORT_TERM):
+                ts = start_ts + k * SHORT_TERM
+                yield "short_term", (ts + SHORT_TERM + 10, meta_id, ts, mean, mean, mean, None, None)
+            if statistic_id == TARIFF_ID:
+                yield "state", (statistic_id, str(mean), start_ts)
+            continue
+        if total is None:
+            continue
+        base = prev.get(meta_id)
+        prev[meta_id] = total
+        if start_ts < since_ts or base is None:
+            continue
+        if total < base:  # sum restarted at 0 within this hour
+            base = 0.0
+        weights = [rng.random() for _ in range(HOUR // SHORT_TERM)]
+        scale = (total - base) / (sum(weights) or 1.0)
+        value = base
+        for k, weight in enumerate(weights):
+            ts = start_ts + k * SHORT_TERM
+            value = total if k == len(weights) - 1 else value + weight * scale
+            yield "short_term", (ts + SHORT_TERM + 10, meta_id, ts, None, None, None, value, value)
+            end = ts + SHORT_TERM
+            state = "unavailable" if null_rate and rng.random() < null_rate else str(value)
+            yield "state", (statistic_id, state, end)
+
+
+def generate(path, years=1.0, batteries=BATTERY_SIZES, extra_sensors=0,
+             gap_rate=0.0, null_rate=0.0, reset_rate=0.0, seed=0,
+             start_ts=DEFAULT_START_TS, fine_days=10):
+    """Write a fresh recorder database to path; returns the number of rows."""
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    hours = int(years * 365.25 * 24)
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executescript(SCHEMA)
+    conn.executemany(
+        "INSERT INTO statistics_meta (statistic_id, source, unit_of_measurement,"
+        " has_mean, has_sum, name) VALUES (?, 'recorder', ?, ?, ?, NULL)",
+        _meta_rows(batteries, extra_sensors),
+    )
+    meta = conn.execute("SELECT id, statistic_id FROM statistics_meta ORDER BY id").fetchall()
+    conn.executemany(
+        "INSERT INTO statistics (created_ts, metadata_id, start_ts, mean, min, max,"
+        " state, sum) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        _statistics_rows(meta, hours, start_ts, gap_rate, null_rate, reset_rate, rng),
+    )
+
+    if fine_days and hours:
+        since_ts = start_ts + max(hours - int(fine_days * 24), 0) * HOUR
+        short_term, states = [], []
+        for table, row in _fine_rows(conn, since_ts, null_rate, rng):
+            (short_term if table == "short_term" else states).append(row)
+        conn.executemany(
+            "INSERT INTO statistics_short_term (created_ts, metadata_id, start_ts,"
+            " mean, min, max, state, sum) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            short_term,
+        )
+        entity_ids = sorted({entity_id for entity_id, _, _ in states})
+        conn.executemany("INSERT INTO states_meta (entity_id) VALUES (?)",
+                         [(e,) for e in entity_ids])
+        states_meta = dict(conn.execute("SELECT entity_id, metadata_id FROM states_meta"))
+        # The recorder writes states as they happen, i.e. ordered by time.
+        states.sort(key=lambda row: row[2])
+        conn.executemany(
+            "INSERT INTO states (metadata_id, state, last_changed_ts, last_updated_ts)"
+            " VALUES (?, ?, ?, ?)",
+            ((states_meta[entity_id], state, ts, ts) for entity_id, state, ts in states),
+        )
+    conn.commit()
+    rows = conn.execute("SELECT COUNT(*) FROM statistics").fetchone()[0]
+    conn.close()
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic HA recorder db.")
+    parser.add_argument("db", help="output file (overwritten)")
+    parser.add_argument("--years", type=float, default=1.0)
+    parser.add_argument("--batteries", type=int, nargs="+", default=BATTERY_SIZES)
+    parser.add_argument("--extra-sensors", type=int, default=0)
+    parser.add_argument("--gap-rate", type=float, default=0.0)
+    parser.add_argument("--null-rate", type=float, default=0.0)
+    parser.add_argument("--reset-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fine-days", type=float, default=10,
+                        help="days with short-term statistics and states (default: 10)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.perf_counter()
+    rows = generate(args.db, args.years, args.batteries, args.extra_sensors,
+                    args.gap_rate, args.null_rate, args.reset_rate, args.seed,
+                    fine_days=args.fine_days)
+    print(f"{args.db}: {rows} statistics rows in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
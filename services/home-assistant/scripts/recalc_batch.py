@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Self-consumption totals across many recorder database snapshots.
+
+Runs the report of recalc_self_consumption.py (the grouped SQL aggregation)
+over every database in a directory or glob -- e.g. the rotating backups of
+home-assistant_v2.db from Mars -- and merges the totals into one table with a
+row per snapshot, oldest data first, so a jump in sensor.vb_*_energy_out
+(a template bug, a reset) shows up between two snapshots.
+
+Every snapshot is opened read-only and the work is spread over a bounded
+process pool in two passes:
+
+  1. fingerprint: row count and last start_ts of each energy_out sensor and
+     the tariff (one COUNT/MAX walk of the statistics index),
+  2. aggregate: only snapshots with a fingerprint not seen before; a snapshot
+     whose relevant statistics are unchanged reuses the totals of the one it
+     matches ("gelijk").
+
+With --results PATH the totals are also kept per fingerprint in a JSON file,
+so a later run over a grown backup directory only aggregates the new ones
+("bewaard"). The fingerprint is cheap, not a checksum: history rewritten
+without changing the number of rows or the last hour is not detected (use a
+fresh --results file for that). The inputs are expected to be static copies;
+a file that changes between the passes is reported with the totals it had
+when aggregated.
+
+Run on Mars:
+  python3 recalc_batch.py /backups/ha/ [--workers 4] [--results batch.json]
+  python3 recalc_batch.py '/backups/ha/home-assistant_v2.db.*' --format csv --output trend.csv
+Directories are searched (not recursively) for SQLite files.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from recalc_self_consumption import (
+    BATTERY_SIZES,
+    ENERGY_OUT_PATTERN,
+    PRICE_THRESHOLD,
+    TARIFF_ID,
+    aggregate_sql,
+    check_query_plan,
+    connect_readonly,
+    get_metadata_id,
+    result_rows,
+    write_rows,
+)
+
+RELEVANT_IDS = [ENERGY_OUT_PATTERN.format(cap=cap) for cap in BATTERY_SIZES] + [TARIFF_ID]
+
+MAX_WORKERS = 4  # the snapshots compete for one disk
+
+SQLITE_HEADER = b"SQLite format 3\0"
+
+FINGERPRINT_SQL = """
+SELECT m.statistic_id, COUNT(s.start_ts), MAX(s.start_ts)
+FROM statistics_meta m LEFT JOIN statistics s ON s.metadata_id = m.id
+WHERE m.statistic_id IN ({placeholders})
+GROUP BY m.statistic_id
+"""
+
+STATUSES = {
+    "new": "nieuw",       # aggregated in this run
+    "same": "gelijk",     # same fingerprint as a snapshot aggregated in this run
+    "stored": "bewaard",  # totals from the --results file
+    "error": "fout",
+}
+
+FORMATS = ("text", "json", "csv")
+
+
+def is_sqlite(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+
+def find_databases(patterns):
+    """SQLite files in the given directories and/or matching the globs."""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            candidates = (os.path.join(pattern, n) for n in os.listdir(pattern))
+        else:
+            candidates = glob.glob(pattern)
+        paths.update(os.path.abspath(p) for p in candidates
+                     if os.path.isfile(p) and is_sqlite(p))
+    return sorted(paths)
+
+
+def fingerprint(cur, statistic_ids=RELEVANT_IDS):
+    """{statistic_id: [rows, last start_ts]} of the statistics the report reads."""
+    sql = FINGERPRINT_SQL.format(placeholders=", ".join("?" * len(statistic_ids)))
+    check_query_plan(cur, sql, statistic_ids, aliases=("s",))
+    cur.execute(sql, statistic_ids)
+    return {statistic_id: [rows, last] for statistic_id, rows, last in cur.fetchall()}
+
+
+def fingerprint_key(fp, threshold=PRICE_THRESHOLD):
+    data = json.dumps([threshold, sorted(fp.items())])
+    return hashlib.sha256(data.encode()).hexdigest()[:20]
+
+
+def _fingerprint_job(path):
+    try:
+        conn = connect_readonly(path)
+        try:
+            return fingerprint(conn.cursor()), None
+        finally:
+            conn.close()
+    except sqlite3.Error as exc:
+        return None, str(exc)
+
+
+def _aggregate_job(path, threshold):
+    try:
+        conn = connect_readonly(path)
+        try:
+            cur = conn.cursor()
+            tariff_meta = get_metadata_id(cur, TARIFF_ID)
+            if not tariff_meta:
+                return None, f"tariff sensor '{TARIFF_ID}' not found"
+            return aggregate_sql(cur, tariff_meta, threshold), None
+        finally:
+            conn.close()
+    except sqlite3.Error as exc:
+        return None, str(exc)
+
+
+def load_results(path):
+    """{fingerprint key: {cap: totals}} from a --results file ({} if absent)."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        stored = json.load(f)
+    return {key: {int(cap): t for cap, t in results.items()} for key, results in stored.items()}
+
+
+def save_results(path, results):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def run_batch(paths, workers=None, threshold=PRICE_THRESHOLD, stored=None):
+    """One entry per snapshot, oldest data first (unreadable ones last).
+
+    stored ({key: results}, e.g. load_results()) is used and extended.
+    """
+    stored = {} if stored is None else stored
+    workers = max(1, min(workers or min(os.cpu_count() or 1, MAX_WORKERS), len(paths) or 1))
+    entries = [{"path": path, "fingerprint": None, "key": None, "as_of": None,
+                "status": "error", "results": None, "error": None} for path in paths]
+    with ProcessPoolExecutor(workers) as pool:
+        for entry, (fp, error) in zip(entries, pool.map(_fingerprint_job, paths)):
+            entry["fingerprint"], entry["error"] = fp, error
+            if fp is not None:
+                entry["key"] = fingerprint_key(fp, threshold)
+                entry["as_of"] = max((last for _, last in fp.values() if last is not None),
+                                     default=None)
+
+        todo = {}
+        for entry in entries:
+            if entry["key"] is None:
+                continue
+            if entry["key"] in stored:
+                entry["status"] = "stored"
+            elif entry["key"] in todo:
+                entry["status"] = "same"
+            else:
+                todo[entry["key"]] = entry
+                entry["status"] = "new"
+        jobs = list(todo.values())
+        outcomes = pool.map(_aggregate_job, [e["path"] for e in jobs], [threshold] * len(jobs))
+        for entry, (results, error) in zip(jobs, outcomes):
+            if results is None:
+                entry["status"], entry["error"] = "error", error
+            else:
+                stored[entry["key"]] = results
+
+    for entry in entries:
+        if entry["status"] != "error":
+            if entry["key"] not in stored:  # matched a snapshot that failed
+                entry["status"], entry["error"] = "error", todo[entry["key"]]["error"]
+            else:
+                entry["results"] = stored[entry["key"]]
+    entries.sort(key=lambda e: (e["as_of"] is None, e["as_of"] or 0, e["path"]))
+    return entries
+
+
+def _when(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d %H:%M") if ts else "-"
+
+
+def print_comparison(entries):
+    name_width = max([len(os.path.basename(e["path"])) for e in entries] + [8])
+    header = f"{'snapshot':<{name_width}}  {'data t/m':<16}  {'status':<8}"
+    print(header + "".join(f"{f'{cap} kWh EUR':>20}" for cap in BATTERY_SIZES))
+    previous = {}
+    for e in entries:
+        line = f"{os.path.basename(e['path']):<{name_width}}  {_when(e['as_of']):<16}  "
+        line += f"{STATUSES[e['status']]:<8}"
+        if e["results"] is None:
+            print(f"{line}  {e['error']}")
+            continue
+        for cap in BATTERY_SIZES:
+            totals = e["results"].get(cap)
+            if totals is None:
+                line += f"{'-':>20}"
+                continue
+            eur = totals["total_eur"]
+            delta = f"({eur - previous[cap]:+.2f})" if cap in previous else ""
+            line += f"{eur:>10.2f} {delta:>9}"
+            previous[cap] = eur
+        print(line)
+
+
+def batch_rows(entries, threshold=PRICE_THRESHOLD):
+    """One flat row per snapshot and battery, for json/csv."""
+    rows = []
+    for e in entries:
+        if e["results"] is None:
+            continue
+        for row in result_rows(e["results"], threshold):
+            rows.append({"snapshot": e["path"], "data_until": _when(e["as_of"]),
+                         "status": e["status"], **row})
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Self-consumption totals across many recorder db snapshots."
+    )
+    parser.add_argument("snapshots", nargs="+", metavar="DIR_OR_GLOB",
+                        help="directories with recorder db copies and/or glob patterns")
+    parser.add_argument("--workers", type=int,
+                        help=f"processes (default: cores, at most {MAX_WORKERS})")
+    parser.add_argument("--results", metavar="PATH",
+                        help="keep totals per fingerprint in this JSON file")
+    parser.add_argument("--format", choices=FORMATS, default="text",
+                        help="comparison table (default) or one row per snapshot and battery")
+    parser.add_argument("--output", metavar="PATH", help="write json/csv here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = find_databases(args.snapshots)
+    if not paths:
+        print("ERROR: no SQLite databases found.", file=sys.stderr)
+        sys.exit(1)
+
+    stored = load_results(args.results)
+    started = time.perf_counter()
+    entries = run_batch(paths, args.workers, stored=stored)
+    elapsed = time.perf_counter() - started
+    if args.results:
+        save_results(args.results, stored)
+
+    counts = {status: sum(e["status"] == status for e in entries) for status in STATUSES}
+    summary = (f"{len(entries)} snapshots in {elapsed:.1f} s: {counts['new']} berekend, "
+               f"{counts['same'] + counts['stored']} ongewijzigd overgeslagen, "
+               f"{counts['error']} fout")
+    if args.format == "text":
+        print(summary + "\n")
+        print_comparison(entries)
+    else:
+        print(summary, file=sys.stderr)
+        write_rows(batch_rows(entries), args.format, args.output)
+    if counts["error"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
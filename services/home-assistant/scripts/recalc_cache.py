@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped column cache of the recorder statistics the analyses read.
+
+Walking years of `statistics` rows as sqlite3 row tuples is the slowest and
+most memory-hungry part of every analysis run. This keeps the hourly rows of
+the sensors the scripts use (sensor.vb_*, the Zonneplan tariff, the grid
+meter and optionally solar) as plain arrays on disk, one contiguous file per
+sensor and column, so a later run maps them read-only instead of reading the
+recorder: the pages are shared with the OS page cache and cost (almost) no
+private memory, and opening years of history takes milliseconds.
+
+Layout of the cache directory (default <db>.recalc-cache):
+  manifest.json                 per statistic_id: metadata_id, number of rows,
+                                first/last start_ts and the last sum/mean
+  <statistic_id>.start_ts       little-endian float64, one value per hourly
+  <statistic_id>.sum            row in start_ts order; NULL is stored as NaN
+  <statistic_id>.mean
+
+update() appends the hours added since the last cached row. The row count in
+the manifest is authoritative: data is appended first and the manifest is then
+replaced atomically, so a run that dies halfway leaves at most a tail that
+the next update cuts off, and readers that mapped the arrays earlier keep a
+consistent view. Like recalc_checkpoint.py, a sensor is rebuilt from its
+first row when the recorder no longer matches the cache (statistic recreated,
+history purged or imported before the first row, last cached hour removed or
+rewritten); rows inserted in between are not detected, use --rebuild after
+importing history. One writer at a time.
+
+Run on Mars: python3 recalc_cache.py [path_to_db] [--cache PATH] [--solar-id ID]
+                                     [--rebuild]
+The analyses use the cache with --cache [PATH] (recalc_self_consumption.py,
+vb_simulate.py, vb_sweep.py, vb_optimal.py).
+Needs numpy (shipped with Home Assistant).
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from recalc_checkpoint import first_row
+from recalc_common import (
+    BATTERY_SIZES,
+    DEFAULT_DB_PATH,
+    ENERGY_OUT_PATTERN,
+    GRID_EXPORT_ID,
+    GRID_IMPORT_ID,
+    HOURLY_ROWS_SQL,
+    PRICE_THRESHOLD,
+    TARIFF_ID,
+    TOTAL_KEYS,
+    check_query_plan,
+    connect_readonly,
+    get_metadata_ids,
+    list_statistic_ids,
+)
+
+CACHE_PREFIXES = ("sensor.vb_",)
+
+COLUMNS = ("start_ts", "sum", "mean")
+DTYPE = np.dtype("<f8")
+MANIFEST = "manifest.json"
+FETCH_ROWS = 65536
+
+Columns = namedtuple("Columns", COLUMNS)
+
+
+def default_path(db_path):
+    return f"{db_path}.recalc-cache"
+
+
+def cached_ids(cur, solar_id=None):
+    """statistic_ids the analyses read: sensor.vb_*, tariff, grid (+ solar)."""
+    ids = list_statistic_ids(cur, CACHE_PREFIXES)
+    ids += [TARIFF_ID, GRID_IMPORT_ID, GRID_EXPORT_ID] + ([solar_id] if solar_id else [])
+    return sorted(set(ids))
+
+
+def _same(a, b):
+    """Equal stored values; NULL (None) only equals NULL."""
+    return a == b or (a is None and b is None)
+
+
+def _stored(value):
+    return None if math.isnan(value) else float(value)
+
+
+def last_row(cur, metadata_id, start_ts):
+    """(sum, mean) of the row at exactly start_ts, or None."""
+    cur.execute(
+        "SELECT sum, mean FROM statistics WHERE metadata_id = ? AND start_ts = ?",
+        (metadata_id, start_ts),
+    )
+    return cur.fetchone()
+
+
+class StatisticsCache:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(os.path.join(path, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def _file(self, statistic_id, column):
+        return os.path.join(self.path, f"{statistic_id}.{column}")
+
+    def _save_manifest(self):
+        tmp = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def columns(self, statistic_id):
+        """Read-only memory-mapped Columns of a cached sensor, or None."""
+        entry = self.manifest.get(statistic_id)
+        if entry is None:
+            return None
+        if entry["rows"] == 0:
+            return Columns(*(np.empty(0, DTYPE) for _ in COLUMNS))
+        return Columns(*(
+            np.memmap(self._file(statistic_id, column), dtype=DTYPE, mode="r",
+                      shape=(entry["rows"],))
+            for column in COLUMNS
+        ))
+
+    def hourly(self, statistic_ids):
+        """{statistic_id: (start_ts, mean) arrays or None}, as vb_simulate._hourly."""
+        data = {}
+        for statistic_id in statistic_ids:
+            columns = self.columns(statistic_id)
+            data[statistic_id] = None if columns is None else (columns.start_ts, columns.mean)
+        return data
+
+    def invalid_reason(self, cur, statistic_id, metadata_id):
+        """Why the cached sensor no longer matches the recorder, or None."""
+        entry = self.manifest[statistic_id]
+        if entry["metadata_id"] != metadata_id:
+            return "statistic recreated"
+        if entry["rows"] == 0:
+            return None
+        for column in COLUMNS:
+            path = self._file(statistic_id, column)
+            if not os.path.exists(path) or os.path.getsize(path) < entry["rows"] * DTYPE.itemsize:
+                return "cache file truncated"
+        first = first_row(cur, metadata_id)
+        if first is None or first[0] != entry["first_ts"]:
+            return "history purged or imported"
+        last = last_row(cur, metadata_id, entry["last_ts"])
+        if last is None:
+            return "cached hour removed"
+        if not (_same(last[0], entry["last_sum"]) and _same(last[1], entry["last_mean"])):
+            return "history rewritten"
+        return None
+
+    def _drop(self, statistic_id):
+        # Unlink instead of truncating: arrays mapped by earlier readers keep
+        # the old file, a truncated mapping would fault on access.
+        for column in COLUMNS:
+            path = self._file(statistic_id, column)
+            if os.path.exists(path):
+                os.remove(path)
+        self.manifest.pop(statistic_id, None)
+
+    def _append(self, statistic_id, rows):
+        """Append (start_ts, sum, mean) rows after the committed ones."""
+        entry = self.manifest[statistic_id]
+        end = entry["rows"] * DTYPE.itemsize
+        for i, column in enumerate(COLUMNS):
+            path = self._file(statistic_id, column)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.truncate(end)  # an uncommitted tail of an interrupted update
+                f.seek(end)
+                f.write(np.ascontiguousarray(rows[:, i], dtype=DTYPE).tobytes())
+        if entry["rows"] == 0:
+            entry["first_ts"] = float(rows[0, 0])
+        entry["rows"] += len(rows)
+        entry["last_ts"] = float(rows[-1, 0])
+        entry["last_sum"] = _stored(rows[-1, 1])
+        entry["last_mean"] = _stored(rows[-1, 2])
+
+    def update(self, cur, statistic_ids, rebuild=False):
+        """Append the new hours of statistic_ids; returns {statistic_id: rows added}.
+
+        Ids missing from the recorder are dropped from the cache.
+        """
+        meta_ids = get_metadata_ids(cur, statistic_ids)
+        added = {}
+        for statistic_id in statistic_ids:
+            metadata_id = meta_ids.get(statistic_id)
+            if statistic_id in self.manifest:
+                reason = "rebuild" if rebuild else None
+                if metadata_id is not None and reason is None:
+                    reason = self.invalid_reason(cur, statistic_id, metadata_id)
+                if metadata_id is None or reason:
+                    if reason and not rebuild:
+                        print(f"Cache {statistic_id} invalid ({reason}), rebuilding",
+                              file=sys.stderr)
+                    self._drop(statistic_id)
+            if metadata_id is None:
+                self._save_manifest()
+                continue
+            entry = self.manifest.setdefault(statistic_id, {
+                "metadata_id": metadata_id, "rows": 0, "first_ts": None,
+                "last_ts": None, "last_sum": None, "last_mean": None,
+            })
+            since_ts = 0 if entry["last_ts"] is None else math.nextafter(entry["last_ts"], math.inf)
+            before = entry["rows"]
+            for rows in self._fetch(cur, metadata_id, since_ts):
+                self._append(statistic_id, rows)
+            added[statistic_id] = entry["rows"] - before
+            self._save_manifest()
+        return added
+
+    def _fetch(self, cur, metadata_id, since_ts):
+        """(start_ts, sum, mean) float arrays of up to FETCH_ROWS rows."""
+        sql = HOURLY_ROWS_SQL.format(placeholders="?")
+        params = (metadata_id, since_ts, float("inf"))
+        check_query_plan(cur, sql, params)
+        cur.execute(sql, params)
+        for batch in iter(lambda: cur.fetchmany(FETCH_ROWS), []):
+            yield np.array([row[1:] for row in batch], dtype=DTYPE)
+
+
+def open_cache(db_path, path):
+    """StatisticsCache for a --cache [PATH] option value (None: no cache)."""
+    if path is None:
+        return None
+    return StatisticsCache(path or default_path(db_path))
+
+
+def aggregate_cached(cache, threshold=PRICE_THRESHOLD, since=None):
+    """Same totals as aggregate_python(), computed over the cached arrays."""
+    since = since or {}
+    tariff = cache.columns(TARIFF_ID)
+    results = {}
+    for cap in BATTERY_SIZES:
+        energy = cache.columns(ENERGY_OUT_PATTERN.format(cap=cap))
+        if energy is None:
+            continue
+        start = np.searchsorted(energy.start_ts, since.get(cap, 0))
+        ts = energy.start_ts[start:]
+        t = dict.fromkeys(TOTAL_KEYS, 0)
+        t["n_rows"] = len(ts)
+        t["ts_first"] = float(ts[0]) if len(ts) else None
+        t["ts_last"] = float(ts[-1]) if len(ts) else None
+
+        delta = np.diff(np.nan_to_num(energy.sum[start:]))
+        positive = delta > 0
+        price = np.full(len(delta), np.nan)
+        if tariff is not None and len(tariff.start_ts):
+            idx = np.minimum(np.searchsorted(tariff.start_ts, ts[1:]), len(tariff.start_ts) - 1)
+            hit = tariff.start_ts[idx] == ts[1:]
+            price[hit] = tariff.mean[idx[hit]]
+        matched = positive & ~np.isnan(price)
+        high = matched & (price >= threshold)
+        low = matched & (price < threshold)
+        eur = np.where(matched, delta * price, 0.0)
+
+        t["hours_matched"] = int(matched.sum())
+        t["hours_unmatched"] = int((positive & ~matched).sum())
+        t["total_kwh"] = float(delta[matched].sum())
+        t["total_eur"] = float(eur.sum())
+        t["total_kwh_high"] = float(delta[high].sum())
+        t["total_eur_high"] = float(eur[high].sum())
+        t["total_kwh_low"] = float(delta[low].sum())
+        t["total_eur_low"] = float(eur[low].sum())
+        results[cap] = t
+    return results
+
+
+def aggregator(cache):
+    """aggregate_cached() with the (cur, tariff_meta, threshold, since)
+    signature of recalc_self_consumption.AGGREGATORS."""
+    def aggregate(cur, tariff_meta, threshold=PRICE_THRESHOLD, since=None):
+        return aggregate_cached(cache, threshold, since)
+    return aggregate
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build or update the memory-mapped statistics cache."
+    )
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH,
+                        help=f"recorder database (default: {DEFAULT_DB_PATH})")
+    parser.add_argument("--cache", metavar="PATH",
+                        help="cache directory (default: <db>.recalc-cache)")
+    parser.add_argument("--solar-id", help="also cache this solar production statistic_id")
+    parser.add_argument("--rebuild", action="store_true", help="drop the cache and start over")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cache = StatisticsCache(args.cache or default_path(args.db))
+    conn = connect_readonly(args.db)
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        started = time.perf_counter()
+        added = cache.update(cur, cached_ids(cur, args.solar_id), rebuild=args.rebuild)
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+    if not added:
+        print("ERROR: none of the statistics were found in the recorder.")
+        sys.exit(1)
+
+    print(f"Cache {cache.path}: {sum(added.values())} uren toegevoegd in {elapsed:.2f} s\n")
+    for statistic_id in sorted(cache.manifest):
+        entry = cache.manifest[statistic_id]
+        print(f"  {statistic_id:<56} {entry['rows']:>8} uren  (+{added.get(statistic_id, 0)})")
+
+
+if __name__ == "__main__":
+    main()
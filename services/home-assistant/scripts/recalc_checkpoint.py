@@ -0,0 +1,200 @@
+"""
+Checkpointed running totals for recalc_self_consumption.py.
+
+A small sidecar SQLite file keeps, per energy_out sensor, tariff sensor and
+price threshold, the totals computed so far plus the last processed row
+(start_ts, sum). A later run only aggregates rows from that row on and adds
+them to the stored totals.
+
+A checkpoint is dropped (and that sensor rebuilt from the first row) when the
+recorder no longer matches it:
+  * the statistic was recreated (different metadata_id),
+  * the first row moved (history purged or older history imported),
+  * the checkpointed row is gone or its sum changed (history rewritten, e.g.
+    a reset sum or a sum adjusted in Developer tools > Statistics),
+  * the tariff statistic was recreated, or its number of rows up to the
+    checkpointed hour changed (prices backfilled or purged).
+Rows inserted *before* the checkpoint without touching it are not detected,
+nor are tariff prices changed in place; use --rebuild after importing history.
+
+The caller passes the sensors, tariff and total keys in: this module is
+imported by recalc_self_consumption.py and must not import it back (run as a
+script, that would load it a second time).
+"""
+
+import sqlite3
+import sys
+
+COUNT_KEYS = ("n_rows", "hours_matched", "hours_unmatched")
+
+# Checkpoint bookkeeping next to the totals.
+STATE_COLUMNS = (
+    ("metadata_id", "INTEGER NOT NULL"),
+    ("last_sum", "REAL"),
+    ("tariff_metadata_id", "INTEGER NOT NULL"),
+    ("tariff_rows", "INTEGER NOT NULL"),
+)
+
+
+def default_path(db_path):
+    return f"{db_path}.recalc-checkpoint.sqlite"
+
+
+def first_row(cur, metadata_id):
+    cur.execute(
+        "SELECT start_ts, sum FROM statistics WHERE metadata_id = ?"
+        " ORDER BY start_ts LIMIT 1",
+        (metadata_id,),
+    )
+    return cur.fetchone()
+
+
+def row_sum_at(cur, metadata_id, start_ts):
+    """(found, sum) of the row at exactly start_ts."""
+    cur.execute(
+        "SELECT sum FROM statistics WHERE metadata_id = ? AND start_ts = ?",
+        (metadata_id, start_ts),
+    )
+    row = cur.fetchone()
+    return (True, row[0]) if row else (False, None)
+
+
+def tariff_rows_until(cur, tariff_meta, start_ts):
+    """Number of tariff rows up to and including start_ts."""
+    cur.execute(
+        "SELECT COUNT(*) FROM statistics WHERE metadata_id = ? AND start_ts <= ?",
+        (tariff_meta, start_ts),
+    )
+    return cur.fetchone()[0]
+
+
+def merge_totals(base, increment):
+    """Add an increment that starts at base's last row (counted in both)."""
+    merged = {key: base[key] + increment[key]
+              for key in increment if key not in ("ts_first", "ts_last")}
+    merged["n_rows"] -= 1
+    merged["ts_first"] = base["ts_first"]
+    merged["ts_last"] = increment["ts_last"]
+    return merged
+
+
+class CheckpointStore:
+    """Checkpoints of the totals `keys` (recalc_self_consumption.TOTAL_KEYS)."""
+
+    def __init__(self, path, keys):
+        self.path = path
+        self.keys = tuple(keys)
+        self.conn = sqlite3.connect(path)
+        columns = [*STATE_COLUMNS, *(
+            (key, "INTEGER" if key in COUNT_KEYS else "REAL") for key in self.keys
+        )]
+        self.columns = [name for name, _ in columns]
+        existing = [row[1] for row in self.conn.execute("PRAGMA table_info(checkpoint)")]
+        if existing and existing[3:] != self.columns:
+            # Written by an older version: start over.
+            self.conn.execute("DROP TABLE checkpoint")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint ("
+            " statistic_id TEXT NOT NULL, tariff_id TEXT NOT NULL,"
+            " threshold REAL NOT NULL,"
+            f" {', '.join(f'{name} {kind}' for name, kind in columns)},"
+            " PRIMARY KEY (statistic_id, tariff_id, threshold))"
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def load(self, statistic_id, tariff_id, threshold):
+        cur = self.conn.execute(
+            f"SELECT {', '.join(self.columns)} FROM checkpoint"
+            " WHERE statistic_id = ? AND tariff_id = ? AND threshold = ?",
+            (statistic_id, tariff_id, threshold),
+        )
+        row = cur.fetchone()
+        return None if row is None else dict(zip(self.columns, row))
+
+    def save(self, statistic_id, tariff_id, threshold, state, totals):
+        """Store totals; state holds the STATE_COLUMNS values."""
+        values = {**state, **{key: totals[key] for key in self.keys}}
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO checkpoint (statistic_id, tariff_id, threshold,"
+            f" {', '.join(self.columns)})"
+            f" VALUES ({', '.join('?' * (3 + len(self.columns)))})",
+            (statistic_id, tariff_id, threshold, *(values[c] for c in self.columns)),
+        )
+        self.conn.commit()
+
+    def discard(self, statistic_id, tariff_id, threshold):
+        self.conn.execute(
+            "DELETE FROM checkpoint"
+            " WHERE statistic_id = ? AND tariff_id = ? AND threshold = ?",
+            (statistic_id, tariff_id, threshold),
+        )
+        self.conn.commit()
+
+
+def invalid_reason(cur, checkpoint, metadata_id):
+    """Why the checkpoint no longer matches the recorder, or None if it does."""
+    if checkpoint["metadata_id"] != metadata_id:
+        return "statistic recreated"
+    first = first_row(cur, metadata_id)
+    if first is None or first[0] != checkpoint["ts_first"]:
+        return "history purged or imported"
+    found, last_sum = row_sum_at(cur, metadata_id, checkpoint["ts_last"])
+    if not found:
+        return "checkpointed hour removed"
+    if last_sum != checkpoint["last_sum"]:
+        return "sum rewritten"
+    return None
+
+
+def tariff_invalid_reason(cur, checkpoint, tariff_meta):
+    """Why the tariff no longer matches the checkpoint, or None if it does."""
+    if checkpoint["tariff_metadata_id"] != tariff_meta:
+        return "tariff recreated"
+    if tariff_rows_until(cur, tariff_meta, checkpoint["ts_last"]) != checkpoint["tariff_rows"]:
+        return "tariff history changed"
+    return None
+
+
+def aggregate_incremental(cur, aggregate, store, sensors, tariff, threshold,
+                          rebuild=False):
+    """Run `aggregate` from the stored checkpoints on and return merged totals.
+
+    sensors is {cap: (statistic_id, metadata_id)} of the energy_out sensors
+    found, tariff is (statistic_id, metadata_id). Checkpoints are updated with
+    the new totals afterwards.
+    """
+    tariff_id, tariff_meta = tariff
+    checkpoints = {}
+    for cap, (statistic_id, metadata_id) in sensors.items():
+        if rebuild:
+            continue
+        checkpoint = store.load(statistic_id, tariff_id, threshold)
+        if checkpoint is None:
+            continue
+        reason = (invalid_reason(cur, checkpoint, metadata_id)
+                  or tariff_invalid_reason(cur, checkpoint, tariff_meta))
+        if reason:
+            print(f"Checkpoint {cap} kWh invalid ({reason}), rebuilding", file=sys.stderr)
+            store.discard(statistic_id, tariff_id, threshold)
+            continue
+        checkpoints[cap] = checkpoint
+
+    since = {cap: c["ts_last"] for cap, c in checkpoints.items()}
+    results = aggregate(cur, tariff_meta, threshold, since=since)
+
+    for cap, totals in results.items():
+        if cap in checkpoints:
+            totals = results[cap] = merge_totals(checkpoints[cap], totals)
+        if totals["n_rows"] == 0:
+            continue
+        statistic_id, metadata_id = sensors[cap]
+        _, last_sum = row_sum_at(cur, metadata_id, totals["ts_last"])
+        store.save(statistic_id, tariff_id, threshold, {
+            "metadata_id": metadata_id,
+            "last_sum": last_sum,
+            "tariff_metadata_id": tariff_meta,
+            "tariff_rows": tariff_rows_until(cur, tariff_meta, totals["ts_last"]),
+        }, totals)
+    return results
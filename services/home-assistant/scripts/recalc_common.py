@@ -0,0 +1,171 @@
+"""
+Recorder access and constants shared by the recalc_* and vb_* scripts.
+
+recalc_self_consumption.py imports modules that need these too (recalc_cache,
+recalc_subhourly, recalc_checkpoint); they take them from here and never
+import the report script back: run as a script it would load a second time,
+with its own globals.
+"""
+
+import itertools
+import os
+import sqlite3
+import sys
+from operator import itemgetter
+from urllib.parse import quote
+
+DEFAULT_DB_PATH = "/config/home-assistant_v2.db"
+
+BATTERY_SIZES = [10, 20, 30, 40]
+
+# Sensor statistic_ids (template sensors with unique_id)
+ENERGY_OUT_PATTERN = "sensor.vb_{cap}kwh_energy_out"
+TARIFF_ID = "sensor.zonneplan_current_electricity_tariff"
+
+# Slimmelezer grid power (W); hourly mean W == Wh in that hour.
+GRID_IMPORT_ID = "sensor.connect_energiemeter_elektriciteitsverbruik"
+GRID_EXPORT_ID = "sensor.connect_energiemeter_elektriciteitsproductie"
+
+PRICE_THRESHOLD = 0.30  # EUR/kWh
+
+TIMEZONE = "Europe/Amsterdam"  # local days for date ranges
+
+# Debug listing: statistic_id prefixes of the sensors the scripts work with.
+RELEVANT_PREFIXES = ("sensor.vb_", "sensor.virtual_battery", "sensor.zonneplan")
+
+# The recorder's unique (metadata_id, start_ts) index; every statistics read
+# here should be a seek on metadata_id followed by an in-order range walk.
+STATISTICS_INDEX = "ix_statistics_statistic_id_start_ts"
+
+HOURLY_ROWS_SQL = (
+    "SELECT metadata_id, start_ts, sum, mean FROM statistics"
+    " WHERE metadata_id IN ({placeholders}) AND start_ts >= ? AND start_ts < ?"
+    " ORDER BY metadata_id, start_ts"
+)
+
+# Read-only tuning for scanning years of statistics.
+CACHE_SIZE_KIB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+BUSY_TIMEOUT_S = 10
+
+TOTAL_KEYS = (
+    "n_rows", "ts_first", "ts_last", "hours_matched", "hours_unmatched",
+    "total_kwh", "total_eur", "total_kwh_high", "total_eur_high",
+    "total_kwh_low", "total_eur_low",
+)
+
+
+def connect_readonly(db_path):
+    """Open the recorder read-only without getting in the recorder's way.
+
+    mode=ro never takes a write lock; in WAL mode (the HA default) readers and
+    the writer do not block each other. Autocommit, so the caller decides how
+    long a read transaction (= snapshot) lives.
+    """
+    uri = f"file:{quote(os.path.abspath(db_path))}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT_S, isolation_level=None)
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def get_metadata_id(cur, statistic_id):
+    cur.execute(
+        "SELECT id FROM statistics_meta WHERE statistic_id = ?", (statistic_id,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def get_metadata_ids(cur, statistic_ids):
+    """{statistic_id: metadata_id} in one query; missing ids are left out."""
+    statistic_ids = list(statistic_ids)
+    cur.execute(
+        "SELECT statistic_id, id FROM statistics_meta"
+        f" WHERE statistic_id IN ({', '.join('?' * len(statistic_ids))})",
+        statistic_ids,
+    )
+    return dict(cur.fetchall())
+
+
+def energy_out_sensors(cur):
+    """{cap: (statistic_id, metadata_id)} of the energy_out sensors found."""
+    ids = {cap: ENERGY_OUT_PATTERN.format(cap=cap) for cap in BATTERY_SIZES}
+    found = get_metadata_ids(cur, ids.values())
+    return {cap: (sid, found[sid]) for cap, sid in ids.items() if sid in found}
+
+
+def list_statistic_ids(cur, prefixes=RELEVANT_PREFIXES):
+    """statistic_ids starting with any of prefixes, as range seeks on the
+    unique statistic_id index (LIKE '%...%' scans the whole table)."""
+    params = []
+    for prefix in prefixes:
+        params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+    cur.execute(
+        "SELECT statistic_id FROM statistics_meta WHERE "
+        + " OR ".join("(statistic_id >= ? AND statistic_id < ?)" for _ in prefixes),
+        params,
+    )
+    return sorted(r[0] for r in cur.fetchall())
+
+
+def plan_warnings(cur, sql, params=(), aliases=("statistics",), index=STATISTICS_INDEX):
+    """Query plan steps that read a table (under any of aliases) without a
+    metadata_id seek on index."""
+    cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+    warnings = []
+    for row in cur.fetchall():
+        detail = row[-1]
+        words = detail.split()
+        if len(words) < 2 or words[0] not in ("SCAN", "SEARCH") or words[1] not in aliases:
+            continue
+        if index not in detail or "metadata_id=" not in detail:
+            warnings.append(detail)
+    return warnings
+
+
+def check_query_plan(cur, sql, params=(), aliases=("statistics",), index=STATISTICS_INDEX):
+    """Warn on stderr when a scan would not use the (metadata_id, ts) index."""
+    for detail in plan_warnings(cur, sql, params, aliases, index):
+        print(f"WARNING: query plan does not use {index}: {detail}", file=sys.stderr)
+
+
+def get_hourly_rows(cur, metadata_ids, since_ts=0, until_ts=float("inf")):
+    """Hourly (start_ts, sum, mean) of several statistics in [since_ts, until_ts).
+
+    One ordered walk of the (metadata_id, start_ts) index for all ids instead
+    of a query per sensor. Returns {metadata_id: rows}; every id is present.
+    """
+    metadata_ids = sorted(set(metadata_ids))
+    sql = HOURLY_ROWS_SQL.format(placeholders=", ".join("?" * len(metadata_ids)))
+    params = (*metadata_ids, since_ts, until_ts)
+    check_query_plan(cur, sql, params)
+    cur.execute(sql, params)
+    rows = {meta_id: [] for meta_id in metadata_ids}
+    for meta_id, group in itertools.groupby(cur, key=itemgetter(0)):
+        rows[meta_id] = [row[1:] for row in group]
+    return rows
+
+
+def add_delta(t, delta_kwh, tariff, threshold=PRICE_THRESHOLD):
+    """Add one energy delta at the given tariff (None: no tariff) to totals t."""
+    if delta_kwh <= 0:
+        return
+
+    if tariff is None:
+        t["hours_unmatched"] += 1
+        return
+
+    t["hours_matched"] += 1
+    eur = delta_kwh * tariff
+    t["total_kwh"] += delta_kwh
+    t["total_eur"] += eur
+
+    if tariff >= threshold:
+        t["total_eur_high"] += eur
+        t["total_kwh_high"] += delta_kwh
+    else:
+        t["total_eur_low"] += eur
+        t["total_kwh_low"] += delta_kwh
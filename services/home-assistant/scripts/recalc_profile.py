@@ -0,0 +1,195 @@
+"""
+Stage profiling for recalc_self_consumption.py (--profile).
+
+The report wraps its phases in stage(name) blocks: opening the db (and the
+snapshot copy), the statistic_id listing, the tariff lookups, the cache
+update and the aggregation, and for --aggregate python the row fetch, the
+tariff dict build and the accumulation loop inside it. Without --profile a
+stage is a no-op. With it every stage records wall and CPU time and the
+tracemalloc peak above what was allocated when the stage started, and a
+ProfilingCursor counts the rows each query fetched.
+
+The result is printed as a table (to stderr, so json/csv output stays clean)
+and appended as one JSON object per run to a JSON-lines file, together with
+the size of the db, so runs against a growing database can be compared. With
+--profile-dump the run is also recorded with cProfile; the stats file opens
+in snakeviz, flameprof or gprof2dot.
+
+tracemalloc slows allocation-heavy code down (the Python loop most), so
+compare profiled runs with profiled runs.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import sqlite3
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+ACTIVE = None  # the Profiler of the running report, if any
+
+QUERY_LABEL_CHARS = 72
+
+
+def stage(name):
+    """Context manager timing one stage of the active profiler (or nothing)."""
+    if ACTIVE is None:
+        return contextlib.nullcontext()
+    return ACTIVE.stage(name)
+
+
+def query_label(sql):
+    """One-line, shortened form of a query for the table."""
+    label = " ".join(sql.split())
+    if len(label) > QUERY_LABEL_CHARS:
+        label = label[:QUERY_LABEL_CHARS - 3] + "..."
+    return label
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """sqlite3 cursor that counts executions and fetched rows per query."""
+
+    _query = None
+
+    def execute(self, sql, parameters=()):
+        self._query = ACTIVE.query(sql) if ACTIVE is not None else None
+        return super().execute(sql, parameters)
+
+    def _fetched(self, n):
+        if self._query is not None:
+            self._query["rows"] += n
+
+    def fetchone(self):
+        row = super().fetchone()
+        self._fetched(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._fetched(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self._fetched(1)
+        return row
+
+
+class Profiler:
+    def __init__(self, dump_path=None):
+        self.dump_path = dump_path
+        self.stages = []    # finished stage records, in start order
+        self.queries = {}   # (stage path, label) -> record
+        self._stack = []
+        self._profile = cProfile.Profile() if dump_path else None
+
+    def start(self):
+        global ACTIVE
+        ACTIVE = self
+        tracemalloc.start()
+        if self._profile:
+            self._profile.enable()
+        self._total = self.stage("total")
+        self._total.__enter__()
+
+    def stop(self):
+        global ACTIVE
+        self._total.__exit__(None, None, None)
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(self.dump_path)
+        tracemalloc.stop()
+        ACTIVE = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # tracemalloc has a single peak: keep the parent's peak so far before
+        # resetting it for this stage, and merge it back afterwards.
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            self._stack[-1]["_peak"] = max(self._stack[-1]["_peak"], peak)
+        tracemalloc.reset_peak()
+        # Stages are named by their path below "total" ("aggregate/fetch").
+        parent = self._stack[-1]["stage"] if len(self._stack) > 1 else None
+        record = {"stage": f"{parent}/{name}" if parent else name,
+                  "_start_mem": current, "_peak": current}
+        self.stages.append(record)
+        self._stack.append(record)
+        started, cpu_started = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record["wall_s"] = time.perf_counter() - started
+            record["cpu_s"] = time.process_time() - cpu_started
+            peak = max(record.pop("_peak"), tracemalloc.get_traced_memory()[1])
+            record["peak_kib"] = round((peak - record.pop("_start_mem")) / 1024, 1)
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1]["_peak"] = max(self._stack[-1]["_peak"], peak)
+
+    def query(self, sql):
+        stage_name = self._stack[-1]["stage"] if self._stack else ""
+        key = (stage_name, query_label(sql))
+        record = self.queries.setdefault(
+            key, {"stage": stage_name, "query": key[1], "calls": 0, "rows": 0}
+        )
+        record["calls"] += 1
+        return record
+
+    def stage_rows(self, name):
+        """Rows fetched by the queries of a stage and its sub-stages."""
+        return sum(q["rows"] for q in self.queries.values()
+                   if q["stage"] == name or q["stage"].startswith(name + "/"))
+
+    def result(self, **info):
+        stages = [dict(s, rows=self.stage_rows(s["stage"])) for s in self.stages]
+        for s in stages:
+            if s["stage"] == "total":
+                s["rows"] = sum(q["rows"] for q in self.queries.values())
+        return {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            **info,
+            "stages": stages,
+            "queries": list(self.queries.values()),
+        }
+
+
+def default_path(db_path):
+    return f"{db_path}.recalc-profile.jsonl"
+
+
+def append_json(path, result):
+    with open(path, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+def print_table(result, file=None):
+    file = file or sys.stderr
+    print(f"{'stage':<34}{'wall s':>9}{'cpu s':>9}{'peak MiB':>10}{'rows':>10}", file=file)
+    for s in result["stages"]:
+        depth = 0 if s["stage"] == "total" else s["stage"].count("/") + 1
+        name = "  " * depth + s["stage"].rsplit("/", 1)[-1]
+        print(f"{name:<34}{s['wall_s']:>9.3f}{s['cpu_s']:>9.3f}"
+              f"{s['peak_kib'] / 1024:>10.1f}{s['rows']:>10}", file=file)
+    print(file=file)
+    print(f"{'query':<{QUERY_LABEL_CHARS + 2}}{'stage':<22}{'calls':>6}{'rows':>10}", file=file)
+    for q in result["queries"]:
+        print(f"{q['query']:<{QUERY_LABEL_CHARS + 2}}{q['stage']:<22}"
+              f"{q['calls']:>6}{q['rows']:>10}", file=file)
+
+
+def db_info(db_path):
+    """Size of the recorder files, for comparing runs on a growing db."""
+    info = {"db": os.path.abspath(db_path)}
+    for suffix in ("", "-wal"):
+        with contextlib.suppress(OSError):
+            info[f"db{suffix.replace('-', '_')}_bytes"] = os.path.getsize(db_path + suffix)
+    return info
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Daily and monthly rollups of virtual battery savings, with range queries.
+
+A sidecar SQLite file (default <db>.recalc-rollup.sqlite) keeps, per
+energy_out sensor and set of price buckets, kWh / EUR / hours per local day
+and per local month and price bucket. Every run first adds the hours recorded
+since the previous run (same bookkeeping and invalidation as
+recalc_checkpoint.py, the tariff included), then answers the range from the
+rollups:
+
+  whole months from the monthly table, the remaining whole days from the
+  daily table, and only the partial hours at the edges from the recorder.
+
+Price buckets are given by their edges: --price-buckets 0.20 0.30 gives
+< 0.20, 0.20-0.30 and >= 0.30 EUR/kWh (default: PRICE_THRESHOLD only, i.e.
+the low/high split of recalc_self_consumption.py). Hours with an energy delta
+but no tariff are kept in a separate "no tariff" bucket.
+
+Run on Mars:
+  python3 recalc_rollup.py [path_to_db] --battery 30 --from 2025-07-01 --to 2025-07-31
+  python3 recalc_rollup.py [path_to_db] --price-buckets 0.20 0.30 --from 2025-07-01T06:00
+--from/--to are local dates (inclusive) or date-times (--to exclusive).
+"""
+
+import argparse
+import bisect
+import json
+import sqlite3
+import sys
+from collections import defaultdict
+from datetime import date, datetime, time as dt_time, timedelta
+from zoneinfo import ZoneInfo
+
+import recalc_checkpoint
+from recalc_common import (
+    BATTERY_SIZES,
+    DEFAULT_DB_PATH,
+    ENERGY_OUT_PATTERN,
+    PRICE_THRESHOLD,
+    TARIFF_ID,
+    TIMEZONE,
+    connect_readonly,
+    get_hourly_rows,
+    get_metadata_id,
+    get_metadata_ids,
+)
+
+NO_TARIFF = -1  # bucket of hours with energy but no recorded tariff
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_state (
+    statistic_id TEXT NOT NULL,
+    tariff_id TEXT NOT NULL,
+    edges TEXT NOT NULL,
+    metadata_id INTEGER NOT NULL,
+    ts_first REAL,
+    ts_last REAL,
+    last_sum REAL,
+    tariff_metadata_id INTEGER NOT NULL,
+    tariff_rows INTEGER NOT NULL,
+    PRIMARY KEY (statistic_id, tariff_id, edges)
+);
+CREATE TABLE IF NOT EXISTS rollup_day (
+    statistic_id TEXT NOT NULL,
+    tariff_id TEXT NOT NULL,
+    edges TEXT NOT NULL,
+    day TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    hours INTEGER NOT NULL,
+    kwh REAL NOT NULL,
+    eur REAL NOT NULL,
+    PRIMARY KEY (statistic_id, tariff_id, edges, day, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_month (
+    statistic_id TEXT NOT NULL,
+    tariff_id TEXT NOT NULL,
+    edges TEXT NOT NULL,
+    month TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    hours INTEGER NOT NULL,
+    kwh REAL NOT NULL,
+    eur REAL NOT NULL,
+    PRIMARY KEY (statistic_id, tariff_id, edges, month, bucket)
+) WITHOUT ROWID;
+"""
+
+# Rollup table -> its period column.
+PERIODS = {"rollup_day": "day", "rollup_month": "month"}
+
+STATE_KEYS = ("metadata_id", "ts_first", "ts_last", "last_sum",
+              "tariff_metadata_id", "tariff_rows")
+
+
+def default_path(db_path):
+    return f"{db_path}.recalc-rollup.sqlite"
+
+
+def edges_key(edges):
+    return ",".join(f"{edge:g}" for edge in edges)
+
+
+def bucket_of(edges, tariff):
+    return NO_TARIFF if tariff is None else bisect.bisect_right(edges, tariff)
+
+
+def bucket_label(edges, bucket):
+    if bucket == NO_TARIFF:
+        return "geen tarief"
+    if bucket == 0:
+        return f"< {edges[0]:.2f} EUR/kWh"
+    if bucket == len(edges):
+        return f">= {edges[-1]:.2f} EUR/kWh"
+    return f"{edges[bucket - 1]:.2f}-{edges[bucket]:.2f} EUR/kWh"
+
+
+class RollupStore:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        existing = [row[1] for row in self.conn.execute("PRAGMA table_info(rollup_state)")]
+        if existing and existing[3:] != list(STATE_KEYS):
+            # Written by an older version: start over.
+            for table in ("rollup_state", *PERIODS):
+                self.conn.execute(f"DROP TABLE {table}")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def load_state(self, statistic_id, tariff_id, edges):
+        cur = self.conn.execute(
+            f"SELECT {', '.join(STATE_KEYS)} FROM rollup_state"
+            " WHERE statistic_id = ? AND tariff_id = ? AND edges = ?",
+            (statistic_id, tariff_id, edges),
+        )
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(STATE_KEYS, row))
+
+    def clear(self, statistic_id, tariff_id, edges):
+        for table in ("rollup_state", *PERIODS):
+            self.conn.execute(
+                f"DELETE FROM {table} WHERE statistic_id = ? AND tariff_id = ? AND edges = ?",
+                (statistic_id, tariff_id, edges),
+            )
+
+    def add(self, statistic_id, tariff_id, edges, table, sums):
+        """Add {(period, bucket): [hours, kwh, eur]} to a rollup table."""
+        self.conn.executemany(
+            f"INSERT INTO {table} (statistic_id, tariff_id, edges, {PERIODS[table]},"
+            " bucket, hours, kwh, eur) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            f" ON CONFLICT DO UPDATE SET hours = hours + excluded.hours,"
+            " kwh = kwh + excluded.kwh, eur = eur + excluded.eur",
+            [(statistic_id, tariff_id, edges, period, bucket, *values)
+             for (period, bucket), values in sums.items()],
+        )
+
+    def save_state(self, statistic_id, tariff_id, edges, metadata_id, ts_first,
+                   ts_last, last_sum, tariff_metadata_id, tariff_rows):
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO rollup_state (statistic_id, tariff_id, edges,"
+            f" {', '.join(STATE_KEYS)}) VALUES ({', '.join('?' * (3 + len(STATE_KEYS)))})",
+            (statistic_id, tariff_id, edges, metadata_id, ts_first, ts_last, last_sum,
+             tariff_metadata_id, tariff_rows),
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def sums(self, statistic_id, tariff_id, edges, table, first, end):
+        """{bucket: [hours, kwh, eur]} over periods first <= period < end."""
+        column = PERIODS[table]
+        cur = self.conn.execute(
+            f"SELECT bucket, SUM(hours), SUM(kwh), SUM(eur) FROM {table}"
+            " WHERE statistic_id = ? AND tariff_id = ? AND edges = ?"
+            f" AND {column} >= ? AND {column} < ? GROUP BY bucket",
+            (statistic_id, tariff_id, edges, first, end),
+        )
+        return {bucket: list(values) for bucket, *values in cur.fetchall()}
+
+
+def priced_deltas(rows, tariff_by_ts):
+    """(start_ts, delta_kwh, tariff) for every positive hourly delta."""
+    for i in range(1, len(rows)):
+        delta_kwh = (rows[i][1] or 0) - (rows[i - 1][1] or 0)
+        if delta_kwh > 0:
+            yield rows[i][0], delta_kwh, tariff_by_ts.get(rows[i][0])
+
+
+def _add(sums, key, delta_kwh, tariff):
+    values = sums[key]
+    values[0] += 1
+    values[1] += delta_kwh
+    values[2] += delta_kwh * tariff if tariff is not None else 0.0
+
+
+def update(cur, store, edges, tariff_meta, rebuild=False, tz=TIMEZONE):
+    """Add the hours recorded since the last run to the rollups.
+
+    Returns {cap: (statistic_id, metadata_id)} of the sensors found.
+    """
+    key = edges_key(edges)
+    zone = ZoneInfo(tz)
+    found = get_metadata_ids(
+        cur, [ENERGY_OUT_PATTERN.format(cap=cap) for cap in BATTERY_SIZES]
+    )
+    sensors = {}
+    since = {}
+    for cap in BATTERY_SIZES:
+        statistic_id = ENERGY_OUT_PATTERN.format(cap=cap)
+        if statistic_id not in found:
+            continue
+        sensors[cap] = (statistic_id, found[statistic_id])
+        state = None if rebuild else store.load_state(statistic_id, TARIFF_ID, key)
+        if state is not None:
+            reason = (recalc_checkpoint.invalid_reason(cur, state, found[statistic_id])
+                      or recalc_checkpoint.tariff_invalid_reason(cur, state, tariff_meta))
+            if reason:
+                print(f"Rollup {cap} kWh invalid ({reason}), rebuilding", file=sys.stderr)
+                state = None
+        if state is None:
+            store.clear(statistic_id, TARIFF_ID, key)
+        else:
+            since[cap] = state
+    if not sensors:
+        return sensors
+
+    min_since = min((since[cap]["ts_last"] if cap in since else 0) for cap in sensors)
+    rows = get_hourly_rows(cur, [tariff_meta, *(m for _, m in sensors.values())], min_since)
+    tariff_by_ts = {ts: mean for ts, _, mean in rows[tariff_meta]}
+
+    for cap, (statistic_id, meta_id) in sensors.items():
+        state = since.get(cap)
+        resume = state["ts_last"] if state else 0
+        stats = [(ts, total) for ts, total, _ in rows[meta_id] if ts >= resume]
+        if len(stats) < (2 if state else 1):
+            continue
+        days = defaultdict(lambda: [0, 0.0, 0.0])
+        months = defaultdict(lambda: [0, 0.0, 0.0])
+        for ts, delta_kwh, tariff in priced_deltas(stats, tariff_by_ts):
+            local = datetime.fromtimestamp(ts, tz=zone)
+            bucket = bucket_of(edges, tariff)
+            _add(days, (f"{local:%Y-%m-%d}", bucket), delta_kwh, tariff)
+            _add(months, (f"{local:%Y-%m}", bucket), delta_kwh, tariff)
+        store.add(statistic_id, TARIFF_ID, key, "rollup_day", days)
+        store.add(statistic_id, TARIFF_ID, key, "rollup_month", months)
+        store.save_state(statistic_id, TARIFF_ID, key, meta_id,
+                         state["ts_first"] if state else stats[0][0],
+                         stats[-1][0], stats[-1][1], tariff_meta,
+                         recalc_checkpoint.tariff_rows_until(cur, tariff_meta, stats[-1][0]))
+    store.commit()
+    return sensors
+
+
+def _midnight(day, zone):
+    return datetime.combine(day, dt_time(), tzinfo=zone).timestamp()
+
+
+def split_range(start_ts, end_ts, tz=TIMEZONE):
+    """Pieces covering [start_ts, end_ts): ("hours", ts, ts), ("rollup_day",
+    "YYYY-MM-DD", "YYYY-MM-DD") and ("rollup_month", "YYYY-MM", "YYYY-MM"),
+    each [first, end). Whole months come from the monthly table."""
+    zone = ZoneInfo(tz)
+    start = datetime.fromtimestamp(start_ts, tz=zone)
+    end = datetime.fromtimestamp(end_ts, tz=zone)
+    first_day = start.date() if start_ts == _midnight(start.date(), zone) else start.date() + timedelta(1)
+    end_day = end.date()
+    if first_day >= end_day:
+        return [("hours", start_ts, end_ts)] if end_ts > start_ts else []
+
+    pieces = []
+    if start_ts < _midnight(first_day, zone):
+        pieces.append(("hours", start_ts, _midnight(first_day, zone)))
+    first_month = first_day if first_day.day == 1 else \
+        (first_day.replace(day=1) + timedelta(32)).replace(day=1)
+    end_month = end_day.replace(day=1)
+    if first_month < end_month:
+        if first_day < first_month:
+            pieces.append(("rollup_day", f"{first_day}", f"{first_month}"))
+        pieces.append(("rollup_month", f"{first_month:%Y-%m}", f"{end_month:%Y-%m}"))
+        if end_month < end_day:
+            pieces.append(("rollup_day", f"{end_month}", f"{end_day}"))
+    else:
+        pieces.append(("rollup_day", f"{first_day}", f"{end_day}"))
+    if _midnight(end_day, zone) < end_ts:
+        pieces.append(("hours", _midnight(end_day, zone), end_ts))
+    return pieces
+
+
+def hour_sums(cur, metadata_id, tariff_meta, edges, start_ts, end_ts):
+    """{bucket: [hours, kwh, eur]} straight from the recorder for the hours
+    in [start_ts, end_ts) (plus the row before, for the first delta)."""
+    cur.execute(
+        "SELECT COALESCE(MAX(start_ts), ?) FROM statistics"
+        " WHERE metadata_id = ? AND start_ts < ?",
+        (start_ts, metadata_id, start_ts),
+    )
+    (anchor,) = cur.fetchone()
+    rows = get_hourly_rows(cur, [metadata_id, tariff_meta], anchor, end_ts)
+    stats = [(ts, total) for ts, total, _ in rows[metadata_id]]
+    tariff_by_ts = {ts: mean for ts, _, mean in rows[tariff_meta]}
+    sums = defaultdict(lambda: [0, 0.0, 0.0])
+    for ts, delta_kwh, tariff in priced_deltas(stats, tariff_by_ts):
+        if ts >= start_ts:
+            _add(sums, bucket_of(edges, tariff), delta_kwh, tariff)
+    return sums
+
+
+def range_sums(cur, store, edges, statistic_id, metadata_id, tariff_meta,
+               start_ts, end_ts, tz=TIMEZONE):
+    """{bucket: [hours, kwh, eur]} for [start_ts, end_ts); the rollups must
+    be up to date (update())."""
+    key = edges_key(edges)
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    pieces = split_range(start_ts, end_ts, tz)
+    for kind, first, end in pieces:
+        if kind == "hours":
+            sums = hour_sums(cur, metadata_id, tariff_meta, edges, first, end)
+        else:
+            sums = store.sums(statistic_id, TARIFF_ID, key, kind, first, end)
+        for bucket, values in sums.items():
+            for i, value in enumerate(values):
+                totals[bucket][i] += value
+    return dict(totals), pieces
+
+
+def parse_time(text, end=False, tz=TIMEZONE):
+    """Local ISO date or date-time -> epoch seconds; an --to date is inclusive."""
+    zone = ZoneInfo(tz)
+    if "T" in text or " " in text:
+        moment = datetime.fromisoformat(text)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=zone)
+        return moment.timestamp()
+    day = date.fromisoformat(text) + timedelta(1 if end else 0)
+    return _midnight(day, zone)
+
+
+def print_range(cap, edges, sums, start_ts, end_ts, tz=TIMEZONE):
+    zone = ZoneInfo(tz)
+    first = datetime.fromtimestamp(start_ts, tz=zone)
+    last = datetime.fromtimestamp(end_ts, tz=zone)
+    print(f"=== {cap} kWh Batterij: {first:%Y-%m-%d %H:%M} tot {last:%Y-%m-%d %H:%M} ===")
+    total_kwh = total_eur = 0.0
+    for bucket in [*range(len(edges) + 1), NO_TARIFF]:
+        hours, kwh, eur = sums.get(bucket, (0, 0.0, 0.0))
+        if bucket == NO_TARIFF and not hours:
+            continue
+        avg = eur / kwh if kwh > 0 and bucket != NO_TARIFF else 0
+        print(f"  {bucket_label(edges, bucket):<22} {kwh:>8.2f} kWh = {eur:>8.2f} EUR"
+              f"  ({hours} uren, gem. {avg:.4f} EUR/kWh)")
+        if bucket != NO_TARIFF:
+            total_kwh += kwh
+            total_eur += eur
+    print(f"  {'Totaal':<22} {total_kwh:>8.2f} kWh = {total_eur:>8.2f} EUR")
+    print()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Daily/monthly virtual battery savings rollups and range queries."
+    )
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH,
+                        help=f"recorder database (default: {DEFAULT_DB_PATH})")
+    parser.add_argument("--store", help="rollup file (default: <db>.recalc-rollup.sqlite)")
+    parser.add_argument("--price-buckets", type=float, nargs="+", default=[PRICE_THRESHOLD],
+                        metavar="EDGE", help=f"bucket edges in EUR/kWh (default: {PRICE_THRESHOLD})")
+    parser.add_argument("--battery", type=int, nargs="+", choices=BATTERY_SIZES,
+                        help="battery sizes (default: all)")
+    parser.add_argument("--from", dest="start", help="local date or date-time (default: first hour)")
+    parser.add_argument("--to", dest="end", help="local date (inclusive) or date-time (default: now)")
+    parser.add_argument("--rebuild", action="store_true", help="drop the rollups and start over")
+    parser.add_argument("--json", action="store_true", help="print the sums as JSON")
+    args = parser.parse_args(argv)
+    args.price_buckets = sorted(set(args.price_buckets))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    edges = args.price_buckets
+    conn = connect_readonly(args.db)
+    store = RollupStore(args.store or default_path(args.db))
+    output = {}
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        tariff_meta = get_metadata_id(cur, TARIFF_ID)
+        if not tariff_meta:
+            print(f"ERROR: Tariff sensor '{TARIFF_ID}' not found in statistics_meta.")
+            sys.exit(1)
+        sensors = update(cur, store, edges, tariff_meta, rebuild=args.rebuild)
+        for cap in args.battery or BATTERY_SIZES:
+            if cap not in sensors:
+                print(f"--- {cap} kWh: sensor '{ENERGY_OUT_PATTERN.format(cap=cap)}' not found ---\n")
+                continue
+            statistic_id, meta_id = sensors[cap]
+            state = store.load_state(statistic_id, TARIFF_ID, edges_key(edges))
+            if state is None:
+                print(f"--- {cap} kWh: not enough data ---\n")
+                continue
+            start_ts = parse_time(args.start) if args.start else state["ts_first"]
+            end_ts = parse_time(args.end, end=True) if args.end else state["ts_last"] + 3600
+            sums, _ = range_sums(cur, store, edges, statistic_id, meta_id, tariff_meta,
+                                 start_ts, end_ts)
+            if args.json:
+                output[cap] = {bucket_label(edges, b): dict(zip(("hours", "kwh", "eur"), v))
+                               for b, v in sorted(sums.items())}
+            else:
+                print_range(cap, edges, sums, start_ts, end_ts)
+    finally:
+        store.close()
+        conn.close()
+    if args.json:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
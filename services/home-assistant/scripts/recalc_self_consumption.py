@@ -5,142 +5,536 @@ Recalculate virtual battery self-consumption from HA long-term statistics.
 Uses hourly energy_out deltas × electricity tariff at that hour.
 No opportunity cost subtracted — pure savings from avoided grid import.
 
-Run on Mars: python3 recalc_self_consumption.py [path_to_db]
+Run on Mars: python3 recalc_self_consumption.py [path_to_db] [--aggregate sql|python]
+                                                [--checkpoint [PATH]] [--cache [PATH]]
+                                                [--rebuild] [--profile [PATH]]
+                                                [--profile-dump PATH]
+                                                [--resolution hour|5min|state]
+                                                [--format text|json|csv|parquet]
+                                                [--output PATH]
 Default db path: /config/home-assistant_v2.db
+
+Aggregation modes:
+  sql     (default) deltas, tariff join and high/low split are computed inside
+          SQLite in one grouped query for all battery sizes; only the totals
+          are returned to Python.
+  python  fetch every row and walk it in a Python loop (reference version).
+
+--resolution 5min/state use the 5-minute short-term statistics or the raw
+states instead of the hourly statistics (only the last purge_keep_days are
+kept by HA); see recalc_subhourly.py.
+
+--format json/csv/parquet writes one row of totals per battery (to --output,
+or stdout for json/csv) for dashboards; the diagnostics then go to stderr.
+Parquet needs pyarrow. For repeated queries over date ranges, see
+recalc_serve.py.
+
+With --checkpoint the totals are kept in a sidecar SQLite file (default
+<db>.recalc-checkpoint.sqlite) and later runs only read the hours added since
+the previous run; see recalc_checkpoint.py for when a checkpoint is rebuilt.
+
+With --cache the energy_out and tariff statistics are first appended to a
+memory-mapped column cache (default <db>.recalc-cache) and the totals are
+computed over its arrays with NumPy instead of reading every row from the
+recorder; see recalc_cache.py.
+
+The recorder is opened read-only (mode=ro, query_only) and all queries run in
+one read transaction, i.e. one consistent WAL snapshot; HA keeps writing
+meanwhile. For long analyses use --snapshot [PATH]: the live db is first
+copied with the backup API in chunks and the analysis runs on the copy, so no
+read transaction stays open on the live file.
+
+--profile prints wall/CPU time, peak memory (tracemalloc) and rows fetched
+per stage and per query to stderr and appends them as a JSON line to PATH
+(default <db>.recalc-profile.jsonl); --profile-dump also writes cProfile
+stats. See recalc_profile.py.
+
+Statistics are read through the recorder's (metadata_id, start_ts) index;
+each statistics query is checked with EXPLAIN QUERY PLAN first and a warning
+is printed to stderr when SQLite would scan the table some other way (e.g. a
+missing or renamed index after a recorder migration).
 """
 
+import argparse
+import contextlib
+import csv
+import json
+import os
 import sqlite3
 import sys
+import tempfile
+import time
 from datetime import datetime, timezone
 
-DB_PATH = sys.argv[1] if len(sys.argv) > 1 else "/config/home-assistant_v2.db"
-
-BATTERY_SIZES = [10, 20, 30, 40]
-
-# Sensor statistic_ids (template sensors with unique_id)
-ENERGY_OUT_PATTERN = "sensor.vb_{cap}kwh_energy_out"
-TARIFF_ID = "sensor.zonneplan_current_electricity_tariff"
-
-PRICE_THRESHOLD = 0.30  # EUR/kWh
+import recalc_profile
+from recalc_common import (
+    BATTERY_SIZES,
+    DEFAULT_DB_PATH,
+    ENERGY_OUT_PATTERN,
+    PRICE_THRESHOLD,
+    TARIFF_ID,
+    TOTAL_KEYS,
+    add_delta,
+    check_query_plan,
+    connect_readonly,
+    energy_out_sensors,
+    get_hourly_rows,
+    get_metadata_id,
+    get_metadata_ids,
+    list_statistic_ids,
+)
+from recalc_profile import stage
+
+# Snapshot copy: pages per backup step, pause between steps, and how often the
+# chunked copy may restart (because HA wrote to the db) before it falls back
+# to copying everything in one step.
+SNAPSHOT_PAGES = 16384
+SNAPSHOT_SLEEP_S = 0.005
+SNAPSHOT_MAX_RESTARTS = 5
+
+# One pass over all energy_out sensors: LAG() gives the hourly delta per
+# sensor, the tariff is joined on start_ts (only for positive deltas, like the
+# Python loop) and everything is folded into one row of totals per battery.
+# Uses the recorder's (metadata_id, start_ts) index for both sides of the join;
+# the IN (...) filter walks that index in order, so the window needs no sort,
+# and :min_since lets a checkpointed run seek straight to the new hours.
+AGGREGATE_SQL = """
+WITH sensors(cap, statistic_id, since_ts) AS (VALUES {sensor_values}),
+meta AS (
+    SELECT sensors.cap, sensors.since_ts, m.id AS metadata_id
+    FROM sensors JOIN statistics_meta m ON m.statistic_id = sensors.statistic_id
+),
+deltas AS (
+    SELECT s.metadata_id, s.start_ts,
+           COALESCE(s.sum, 0) - LAG(COALESCE(s.sum, 0)) OVER (
+               PARTITION BY s.metadata_id ORDER BY s.start_ts
+           ) AS delta_kwh
+    FROM statistics s
+    WHERE s.metadata_id IN (SELECT metadata_id FROM meta)
+        AND s.start_ts >= :min_since
+        AND s.start_ts >= (
+            SELECT since_ts FROM meta WHERE meta.metadata_id = s.metadata_id
+        )
+),
+priced AS (
+    SELECT d.metadata_id, d.start_ts, d.delta_kwh, t.mean AS tariff
+    FROM deltas d
+    LEFT JOIN statistics t
+        ON t.metadata_id = :tariff_meta
+        AND t.start_ts = d.start_ts
+        AND d.delta_kwh > 0
+),
+totals AS (
+    SELECT metadata_id,
+           COUNT(*) AS n_rows,
+           MIN(start_ts) AS ts_first,
+           MAX(start_ts) AS ts_last,
+           COUNT(tariff) AS hours_matched,
+           SUM(delta_kwh > 0 AND tariff IS NULL) AS hours_unmatched,
+           TOTAL(CASE WHEN tariff IS NOT NULL THEN delta_kwh END) AS total_kwh,
+           TOTAL(delta_kwh * tariff) AS total_eur,
+           TOTAL(CASE WHEN tariff >= :threshold THEN delta_kwh END) AS total_kwh_high,
+           TOTAL(CASE WHEN tariff >= :threshold THEN delta_kwh * tariff END) AS total_eur_high,
+           TOTAL(CASE WHEN tariff < :threshold THEN delta_kwh END) AS total_kwh_low,
+           TOTAL(CASE WHEN tariff < :threshold THEN delta_kwh * tariff END) AS total_eur_low
+    FROM priced
+    GROUP BY metadata_id
+)
+SELECT meta.cap,
+       COALESCE(n_rows, 0), ts_first, ts_last,
+       COALESCE(hours_matched, 0), COALESCE(hours_unmatched, 0),
+       COALESCE(total_kwh, 0.0), COALESCE(total_eur, 0.0),
+       COALESCE(total_kwh_high, 0.0), COALESCE(total_eur_high, 0.0),
+       COALESCE(total_kwh_low, 0.0), COALESCE(total_eur_low, 0.0)
+FROM meta LEFT JOIN totals ON totals.metadata_id = meta.metadata_id
+"""
 
 
-def get_metadata_id(cur, statistic_id):
+class _SnapshotRestarted(Exception):
+    pass
+
+
+def snapshot_copy(db_path, dest_path, pages=SNAPSHOT_PAGES, sleep=SNAPSHOT_SLEEP_S,
+                  max_restarts=SNAPSHOT_MAX_RESTARTS):
+    """Copy the live recorder to dest_path with the online backup API.
+
+    Copies `pages` pages per step and releases the source between steps. When
+    HA commits in between, SQLite restarts the copy; after max_restarts the
+    rest is copied in a single step (one short read transaction). Returns the
+    number of restarts.
+    """
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _SnapshotRestarted
+        last_remaining = remaining
+
+    src = connect_readonly(db_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        try:
+            src.backup(dest, pages=pages, progress=progress, sleep=sleep)
+        except _SnapshotRestarted:
+            src.backup(dest, pages=-1)
+    finally:
+        dest.close()
+        src.close()
+    return restarts
+
+
+def count_rows(cur, metadata_id):
     cur.execute(
-        "SELECT id FROM statistics_meta WHERE statistic_id = ?", (statistic_id,)
+        "SELECT COUNT(*) FROM statistics WHERE metadata_id = ?", (metadata_id,)
     )
-    row = cur.fetchone()
-    return row[0] if row else None
+    return cur.fetchone()[0]
 
 
-def get_hourly_stats(cur, metadata_id):
-    """Get hourly (start_ts, sum) from statistics table."""
-    cur.execute(
-        "SELECT start_ts, sum FROM statistics WHERE metadata_id = ? ORDER BY start_ts",
-        (metadata_id,),
-    )
-    return cur.fetchall()
-
+def aggregate_python(cur, tariff_meta, threshold=PRICE_THRESHOLD, since=None):
+    """Totals per battery size, computed by walking every row in Python.
 
-def get_hourly_mean(cur, metadata_id):
-    """Get hourly (start_ts, mean) from statistics table."""
-    cur.execute(
-        "SELECT start_ts, mean FROM statistics WHERE metadata_id = ? ORDER BY start_ts",
-        (metadata_id,),
+    Returns {cap: totals}; caps whose sensor is missing are left out.
+    `since` maps cap -> start_ts to resume from: that row is only used as the
+    previous sum of the next hour (it is still counted in n_rows).
+    """
+    since = since or {}
+    energy_ids = get_metadata_ids(
+        cur, [ENERGY_OUT_PATTERN.format(cap=cap) for cap in BATTERY_SIZES]
     )
-    return cur.fetchall()
-
-
-def main():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    # List available statistic_ids for debugging
-    cur.execute("SELECT statistic_id FROM statistics_meta WHERE statistic_id LIKE '%virtual_battery%' OR statistic_id LIKE '%zonneplan%' OR statistic_id LIKE '%vb_%'")
-    available = [r[0] for r in cur.fetchall()]
-    print("Available relevant statistics:")
-    for s in sorted(available):
-        print(f"  {s}")
+    meta_ids = {
+        cap: energy_ids[ENERGY_OUT_PATTERN.format(cap=cap)]
+        for cap in BATTERY_SIZES
+        if ENERGY_OUT_PATTERN.format(cap=cap) in energy_ids
+    }
+    # Tariff hours before the earliest resume point are never looked up.
+    min_since = min((since.get(cap, 0) for cap in meta_ids), default=0)
+    with stage("fetch"):
+        rows = get_hourly_rows(cur, [tariff_meta, *meta_ids.values()], min_since)
+    with stage("tariff_dict"):
+        tariff_by_ts = {ts: mean for ts, _, mean in rows[tariff_meta]}
+
+    results = {}
+    for cap, meta_id in meta_ids.items():
+        with stage(f"accumulate_{cap}kwh"):
+            cap_since = since.get(cap, 0)
+            stats = [(ts, total) for ts, total, _ in rows[meta_id] if ts >= cap_since]
+            t = dict.fromkeys(TOTAL_KEYS, 0)
+            t["n_rows"] = len(stats)
+            t["ts_first"] = stats[0][0] if stats else None
+            t["ts_last"] = stats[-1][0] if stats else None
+
+            for i in range(1, len(stats)):
+                ts = stats[i][0]
+                prev_sum = stats[i - 1][1] or 0
+                curr_sum = stats[i][1] or 0
+                add_delta(t, curr_sum - prev_sum, tariff_by_ts.get(ts), threshold)
+
+        results[cap] = t
+    return results
+
+
+def aggregate_sql(cur, tariff_meta, threshold=PRICE_THRESHOLD, since=None):
+    """Same totals as aggregate_python(), computed in one grouped SQL query."""
+    since = since or {}
+    params = {"tariff_meta": tariff_meta, "threshold": threshold}
+    values = []
+    for i, cap in enumerate(BATTERY_SIZES):
+        values.append(f"(:cap{i}, :sid{i}, :since{i})")
+        params[f"cap{i}"] = cap
+        params[f"sid{i}"] = ENERGY_OUT_PATTERN.format(cap=cap)
+        params[f"since{i}"] = since.get(cap, 0)
+
+    params["min_since"] = min(params[f"since{i}"] for i in range(len(BATTERY_SIZES)))
+
+    sql = AGGREGATE_SQL.format(sensor_values=", ".join(values))
+    check_query_plan(cur, sql, params, aliases=("s", "t"))
+    cur.execute(sql, params)
+    return {row[0]: dict(zip(TOTAL_KEYS, row[1:])) for row in cur.fetchall()}
+
+
+AGGREGATORS = {
+    "sql": aggregate_sql,
+    "python": aggregate_python,
+}
+
+FORMATS = ("text", "json", "csv", "parquet")
+
+# Resolution -> what a matched/unmatched delta is called in the report.
+RESOLUTIONS = {
+    "hour": "uren",
+    "5min": "intervallen",
+    "state": "metingen",
+}
+
+
+def print_report(cap, t, threshold=PRICE_THRESHOLD, unit="uren"):
+    total_kwh, total_eur = t["total_kwh"], t["total_eur"]
+    total_kwh_high, total_eur_high = t["total_kwh_high"], t["total_eur_high"]
+    total_kwh_low, total_eur_low = t["total_kwh_low"], t["total_eur_low"]
+
+    avg_price = total_eur / total_kwh if total_kwh > 0 else 0
+    avg_high = total_eur_high / total_kwh_high if total_kwh_high > 0 else 0
+    avg_low = total_eur_low / total_kwh_low if total_kwh_low > 0 else 0
+
+    ts_first = datetime.fromtimestamp(t["ts_first"], tz=timezone.utc)
+    ts_last = datetime.fromtimestamp(t["ts_last"], tz=timezone.utc)
+
+    print(f"=== {cap} kWh Batterij ===")
+    print(f"Periode: {ts_first:%Y-%m-%d} t/m {ts_last:%Y-%m-%d}")
+    print(f"Data: {t['hours_matched']} {unit} matched, {t['hours_unmatched']} {unit} zonder tarief")
+    print()
+    print(f"Totaal ontladen:        {total_kwh:>8.2f} kWh")
+    print(f"Bruto zelfconsumptie:   {total_eur:>8.2f} EUR  (gem. {avg_price:.4f} EUR/kWh)")
+    print()
+    print(f"  >= {threshold} EUR/kWh:      {total_kwh_high:>8.2f} kWh = {total_eur_high:>8.2f} EUR  (gem. {avg_high:.4f} EUR/kWh)")
+    print(f"  <  {threshold} EUR/kWh:      {total_kwh_low:>8.2f} kWh = {total_eur_low:>8.2f} EUR  (gem. {avg_low:.4f} EUR/kWh)")
     print()
 
-    # Get tariff data
-    tariff_meta = get_metadata_id(cur, TARIFF_ID)
-    if not tariff_meta:
-        print(f"ERROR: Tariff sensor '{TARIFF_ID}' not found in statistics_meta.")
-        print("Check the available statistics above and adjust TARIFF_ID.")
-        conn.close()
-        sys.exit(1)
-
-    tariff_data = get_hourly_mean(cur, tariff_meta)
-    tariff_by_ts = {ts: mean for ts, mean in tariff_data}
-    print(f"Tariff data: {len(tariff_data)} hourly records\n")
 
+def print_results(results, resolution="hour"):
     for cap in BATTERY_SIZES:
-        sensor_id = ENERGY_OUT_PATTERN.format(cap=cap)
-        meta_id = get_metadata_id(cur, sensor_id)
-
-        if not meta_id:
+        totals = results.get(cap)
+        if totals is None:
+            sensor_id = ENERGY_OUT_PATTERN.format(cap=cap)
             print(f"--- {cap} kWh: sensor '{sensor_id}' not found, skipping ---\n")
-            continue
+        elif totals["n_rows"] < 2:
+            print(f"--- {cap} kWh: not enough data ({totals['n_rows']} records) ---\n")
+        else:
+            print_report(cap, totals, unit=RESOLUTIONS[resolution])
 
-        stats = get_hourly_stats(cur, meta_id)
-        if len(stats) < 2:
-            print(f"--- {cap} kWh: not enough data ({len(stats)} records) ---\n")
-            continue
 
-        total_kwh = 0.0
-        total_eur = 0.0
-        total_eur_high = 0.0  # price >= threshold
-        total_eur_low = 0.0   # price < threshold
-        total_kwh_high = 0.0
-        total_kwh_low = 0.0
-        hours_matched = 0
-        hours_unmatched = 0
-
-        for i in range(1, len(stats)):
-            ts = stats[i][0]
-            prev_sum = stats[i - 1][1] or 0
-            curr_sum = stats[i][1] or 0
-            delta_kwh = curr_sum - prev_sum
-
-            if delta_kwh <= 0:
-                continue
-
-            tariff = tariff_by_ts.get(ts)
-            if tariff is None:
-                hours_unmatched += 1
-                continue
-
-            hours_matched += 1
-            eur = delta_kwh * tariff
-            total_kwh += delta_kwh
-            total_eur += eur
-
-            if tariff >= PRICE_THRESHOLD:
-                total_eur_high += eur
-                total_kwh_high += delta_kwh
-            else:
-                total_eur_low += eur
-                total_kwh_low += delta_kwh
+def _iso(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat() if ts is not None else None
 
-        avg_price = total_eur / total_kwh if total_kwh > 0 else 0
-        avg_high = total_eur_high / total_kwh_high if total_kwh_high > 0 else 0
-        avg_low = total_eur_low / total_kwh_low if total_kwh_low > 0 else 0
 
-        ts_first = datetime.fromtimestamp(stats[0][0], tz=timezone.utc)
-        ts_last = datetime.fromtimestamp(stats[-1][0], tz=timezone.utc)
+def result_rows(results, threshold=PRICE_THRESHOLD, resolution="hour"):
+    """One flat dict per battery (sensors that were not found are left out)."""
+    rows = []
+    for cap in BATTERY_SIZES:
+        if cap not in results:
+            continue
+        totals = results[cap]
+        row = {"battery_kwh": cap, "resolution": resolution, "threshold": threshold}
+        row.update({key: totals[key] for key in TOTAL_KEYS})
+        row["period_first"] = _iso(totals["ts_first"])
+        row["period_last"] = _iso(totals["ts_last"])
+        rows.append(row)
+    return rows
+
+
+def write_rows(rows, fmt, path=None):
+    """Write result rows as json, csv or parquet to path (None: stdout)."""
+    if fmt == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), path)
+        return
+    with open(path, "w", newline="") if path else contextlib.nullcontext(sys.stdout) as f:
+        if fmt == "json":
+            json.dump(rows, f, indent=2)
+            f.write("\n")
+        else:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ["battery_kwh"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Recalculate virtual battery self-consumption from HA statistics."
+    )
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH,
+                        help=f"recorder database (default: {DEFAULT_DB_PATH})")
+    parser.add_argument("--aggregate", choices=sorted(AGGREGATORS), default="sql",
+                        help="where the per-hour totals are computed (default: sql)")
+    parser.add_argument("--resolution", choices=RESOLUTIONS, default="hour",
+                        help="hourly statistics (default), 5-minute short-term "
+                             "statistics or raw states")
+    parser.add_argument("--checkpoint", nargs="?", const="", metavar="PATH",
+                        help="keep running totals in a sidecar file and only "
+                             "process new hours (default: <db>.recalc-checkpoint.sqlite)")
+    parser.add_argument("--cache", nargs="?", const="", metavar="PATH",
+                        help="read the statistics from a memory-mapped cache that "
+                             "only gets the new hours (default: <db>.recalc-cache)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="with --checkpoint/--cache: ignore stored totals and "
+                             "cached rows and start over")
+    parser.add_argument("--snapshot", nargs="?", const="", metavar="PATH",
+                        help="analyse a backup-API copy instead of the live db "
+                             "(kept at PATH if given, else a temp file)")
+    parser.add_argument("--profile", nargs="?", const="", metavar="PATH",
+                        help="time each stage and append the profile as a JSON "
+                             "line to PATH (default: <db>.recalc-profile.jsonl)")
+    parser.add_argument("--profile-dump", metavar="PATH",
+                        help="with --profile: also write cProfile stats to PATH")
+    parser.add_argument("--format", choices=FORMATS, default="text",
+                        help="text report (default) or one row per battery")
+    parser.add_argument("--output", metavar="PATH",
+                        help="write json/csv/parquet here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.checkpoint is not None and args.resolution != "hour":
+        parser.error("--checkpoint only works with --resolution hour")
+    if args.cache is not None and args.resolution != "hour":
+        parser.error("--cache only works with --resolution hour")
+    if args.profile_dump and args.profile is None:
+        parser.error("--profile-dump needs --profile")
+    if args.format == "parquet":
+        if not args.output:
+            parser.error("--format parquet needs --output")
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("--format parquet needs pyarrow (pip install pyarrow)")
+    return args
+
+
+def open_db(args):
+    """Read-only connection for the run; with --snapshot on a fresh copy."""
+    if args.snapshot is None:
+        return connect_readonly(args.db), None
+    path = args.snapshot
+    temp_dir = None
+    if not path:
+        temp_dir = tempfile.mkdtemp(prefix="recalc-snapshot-")
+        path = os.path.join(temp_dir, os.path.basename(args.db))
+    try:
+        started = time.perf_counter()
+        restarts = snapshot_copy(args.db, path)
+        print(f"Snapshot {path} in {time.perf_counter() - started:.1f}s ({restarts} restarts)\n")
+        return connect_readonly(path), temp_dir
+    except BaseException:
+        _remove_temp_dir(temp_dir)
+        raise
+
+
+def _remove_temp_dir(temp_dir):
+    if temp_dir:
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+
+
+def close_db(conn, temp_dir):
+    conn.close()
+    _remove_temp_dir(temp_dir)
 
-        print(f"=== {cap} kWh Batterij ===")
-        print(f"Periode: {ts_first:%Y-%m-%d} t/m {ts_last:%Y-%m-%d}")
-        print(f"Data: {hours_matched} uren matched, {hours_unmatched} uren zonder tarief")
-        print()
-        print(f"Totaal ontladen:        {total_kwh:>8.2f} kWh")
-        print(f"Bruto zelfconsumptie:   {total_eur:>8.2f} EUR  (gem. {avg_price:.4f} EUR/kWh)")
-        print()
-        print(f"  >= {PRICE_THRESHOLD} EUR/kWh:      {total_kwh_high:>8.2f} kWh = {total_eur_high:>8.2f} EUR  (gem. {avg_high:.4f} EUR/kWh)")
-        print(f"  <  {PRICE_THRESHOLD} EUR/kWh:      {total_kwh_low:>8.2f} kWh = {total_eur_low:>8.2f} EUR  (gem. {avg_low:.4f} EUR/kWh)")
+
+def report(cur, args):
+    # List available statistic_ids for debugging
+    with stage("list_statistic_ids"):
+        print("Available relevant statistics:")
+        for s in list_statistic_ids(cur):
+            print(f"  {s}")
         print()
 
-    conn.close()
+    # Get tariff data
+    with stage("tariff_metadata"):
+        tariff_meta = get_metadata_id(cur, TARIFF_ID)
+    if not tariff_meta:
+        print(f"ERROR: Tariff sensor '{TARIFF_ID}' not found in statistics_meta.")
+        print("Check the available statistics above and adjust TARIFF_ID.")
+        return 1, None
+
+    with stage("tariff_count"):
+        print(f"Tariff data: {count_rows(cur, tariff_meta)} hourly records\n")
+
+    aggregate = AGGREGATORS[args.aggregate]
+    if args.resolution != "hour":
+        import recalc_subhourly
+
+        aggregate = recalc_subhourly.AGGREGATORS[args.resolution]
+
+    if args.cache is not None:
+        import recalc_cache
+
+        cache = recalc_cache.open_cache(args.db, args.cache)
+        ids = [ENERGY_OUT_PATTERN.format(cap=cap) for cap in BATTERY_SIZES] + [TARIFF_ID]
+        with stage("cache_update"):
+            added = cache.update(cur, ids, rebuild=args.rebuild)
+        print(f"Cache {cache.path}: {sum(added.values())} new hourly records\n")
+        aggregate = recalc_cache.aggregator(cache)
+
+    with stage("aggregate"):
+        if args.checkpoint is None:
+            results = aggregate(cur, tariff_meta)
+        else:
+            import recalc_checkpoint
+
+            store = recalc_checkpoint.CheckpointStore(
+                args.checkpoint or recalc_checkpoint.default_path(args.db), TOTAL_KEYS
+            )
+            results = recalc_checkpoint.aggregate_incremental(
+                cur, aggregate, store, energy_out_sensors(cur), (TARIFF_ID, tariff_meta),
+                PRICE_THRESHOLD, rebuild=args.rebuild
+            )
+            store.close()
+
+    return 0, results
+
+
+def run(args):
+    # With machine-readable output stdout only carries the data.
+    log = contextlib.nullcontext()
+    if args.format != "text":
+        log = contextlib.redirect_stdout(sys.stderr)
+    with log:
+        with stage("open"):
+            conn, temp_dir = open_db(args)
+        try:
+            if recalc_profile.ACTIVE:
+                cur = conn.cursor(recalc_profile.ProfilingCursor)
+            else:
+                cur = conn.cursor()
+            # One read transaction for the whole report: every query sees the
+            # same snapshot even though HA keeps committing new hours.
+            cur.execute("BEGIN")
+            status, results = report(cur, args)
+        finally:
+            close_db(conn, temp_dir)
+    if status:
+        return status
+    with stage("output"):
+        if args.format == "text":
+            print_results(results, args.resolution)
+        else:
+            write_rows(result_rows(results, resolution=args.resolution), args.format,
+                       args.output)
+    return 0
+
+
+def write_profile(profiler, args):
+    result = profiler.result(
+        **recalc_profile.db_info(args.db), aggregate=args.aggregate,
+        resolution=args.resolution, checkpoint=args.checkpoint is not None,
+        cache=args.cache is not None, snapshot=args.snapshot is not None,
+    )
+    path = args.profile or recalc_profile.default_path(args.db)
+    recalc_profile.print_table(result)
+    recalc_profile.append_json(path, result)
+    print(f"\nProfile appended to {path}", file=sys.stderr)
+    if args.profile_dump:
+        print(f"cProfile stats in {args.profile_dump}", file=sys.stderr)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile is None:
+        status = run(args)
+    else:
+        profiler = recalc_profile.Profiler(args.profile_dump)
+        profiler.start()
+        try:
+            status = run(args)
+        finally:
+            profiler.stop()
+        write_profile(profiler, args)
+    if status:
+        sys.exit(status)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Local HTTP query service for the virtual battery self-consumption totals.
+
+Loads the hourly energy_out sums and the tariff once (one index scan, see
+recalc_self_consumption.get_hourly_rows) into NumPy arrays per battery with
+prefix sums, so the totals for any date range are two binary searches and a
+subtraction. Other price thresholds are a vectorised pass over the range.
+
+Endpoints (JSON):
+  GET /totals?battery=30&from=2025-07-01&to=2025-07-31&threshold=0.30
+      every parameter is optional (default: all batteries, all history,
+      PRICE_THRESHOLD); from/to are local days, both inclusive.
+  GET /status
+      loaded hours per battery, last hourly row, number of reloads.
+
+The arrays are reloaded when the recorder has a newer hourly row: before a
+query, at most every --check-interval seconds, one indexed MAX(start_ts)
+lookup. Nothing keeps a read transaction open on the recorder in between.
+
+Run on Mars: python3 recalc_serve.py [path_to_db] [--port 8765]
+Binds to 127.0.0.1 by default. Needs numpy (shipped with Home Assistant).
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from recalc_common import (
+    BATTERY_SIZES,
+    DEFAULT_DB_PATH,
+    ENERGY_OUT_PATTERN,
+    PRICE_THRESHOLD,
+    TARIFF_ID,
+    TIMEZONE,
+    TOTAL_KEYS,
+    connect_readonly,
+    get_hourly_rows,
+    get_metadata_ids,
+)
+
+DEFAULT_PORT = 8765
+CHECK_INTERVAL_S = 10.0
+
+# Per-hour columns that are summed over a range (prefix sums).
+PREFIX_KEYS = (
+    "hours_matched", "hours_unmatched", "total_kwh", "total_eur",
+    "total_kwh_high", "total_eur_high",
+)
+
+
+class BatterySeries:
+    """Hourly deltas of one energy_out sensor, priced, with prefix sums."""
+
+    def __init__(self, rows, tariff_ts, tariff_mean, threshold=PRICE_THRESHOLD):
+        data = np.array([(ts, total if total is not None else 0.0)
+                         for ts, total, _ in rows], dtype=float).reshape(-1, 2)
+        self.ts = data[:, 0]
+        self.threshold = threshold
+        delta = np.diff(data[:, 1], prepend=data[:1, 1])
+        # Tariff of the same hour (exact start_ts match), NaN when missing.
+        idx = np.clip(np.searchsorted(tariff_ts, self.ts), 0, max(len(tariff_ts) - 1, 0))
+        found = (tariff_ts[idx] == self.ts) if len(tariff_ts) else np.zeros(len(self.ts), bool)
+        positive = delta > 0
+        self.matched = positive & found
+        self.tariff = np.where(self.matched, tariff_mean[idx] if len(tariff_ts) else 0.0, np.nan)
+        self.kwh = np.where(self.matched, delta, 0.0)
+        self.eur = np.where(self.matched, delta * np.nan_to_num(self.tariff), 0.0)
+        high = self.matched & (self.tariff >= threshold)
+        columns = {
+            "hours_matched": self.matched,
+            "hours_unmatched": positive & ~found,
+            "total_kwh": self.kwh,
+            "total_eur": self.eur,
+            "total_kwh_high": np.where(high, self.kwh, 0.0),
+            "total_eur_high": np.where(high, self.eur, 0.0),
+        }
+        self.prefix = {
+            key: np.concatenate(([0.0], np.cumsum(column, dtype=float)))
+            for key, column in columns.items()
+        }
+
+    def __len__(self):
+        return len(self.ts)
+
+    def totals(self, start_ts=None, end_ts=None, threshold=None):
+        """Totals for the hours in [start_ts, end_ts), like aggregate_python()."""
+        lo = 0 if start_ts is None else int(np.searchsorted(self.ts, start_ts, "left"))
+        hi = len(self.ts) if end_ts is None else int(np.searchsorted(self.ts, end_ts, "left"))
+        hi = max(hi, lo)
+        t = {key: float(self.prefix[key][hi] - self.prefix[key][lo]) for key in PREFIX_KEYS}
+        if threshold is not None and threshold != self.threshold:
+            high = self.matched[lo:hi] & (self.tariff[lo:hi] >= threshold)
+            t["total_kwh_high"] = float(self.kwh[lo:hi][high].sum())
+            t["total_eur_high"] = float(self.eur[lo:hi][high].sum())
+        t["total_kwh_low"] = t["total_kwh"] - t["total_kwh_high"]
+        t["total_eur_low"] = t["total_eur"] - t["total_eur_high"]
+        t["hours_matched"] = int(t["hours_matched"])
+        t["hours_unmatched"] = int(t["hours_unmatched"])
+        t["n_rows"] = hi - lo
+        t["ts_first"] = float(self.ts[lo]) if hi > lo else None
+        t["ts_last"] = float(self.ts[hi - 1]) if hi > lo else None
+        return {key: t[key] for key in TOTAL_KEYS}
+
+
+class TotalsCache:
+    """Warm per-battery series, reloaded when new hourly rows appear."""
+
+    def __init__(self, db_path, check_interval=CHECK_INTERVAL_S):
+        self.db_path = db_path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.batteries = {}
+        self.last_ts = None
+        self.checked = None
+        self.loads = 0
+
+    def _latest_ts(self, cur):
+        cur.execute("SELECT MAX(start_ts) FROM statistics")
+        return cur.fetchone()[0]
+
+    def refresh(self, force=False):
+        """Reload if the recorder has a newer hourly row; True if reloaded.
+
+        A failed reload raises and is retried on the next query.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.checked is not None and now - self.checked < self.check_interval:
+                return False
+            reloaded = self._reload(force)
+            self.checked = now
+            return reloaded
+
+    def _reload(self, force):
+        conn = connect_readonly(self.db_path)
+        try:
+            cur = conn.cursor()
+            cur.execute("BEGIN")
+            latest = self._latest_ts(cur)
+            if not force and self.loads and latest == self.last_ts:
+                return False
+            self.batteries = self._load(cur)
+            self.last_ts = latest
+            self.loads += 1
+            return True
+        finally:
+            conn.close()
+
+    def _load(self, cur):
+        ids = {cap: ENERGY_OUT_PATTERN.format(cap=cap) for cap in BATTERY_SIZES}
+        meta_ids = get_metadata_ids(cur, [TARIFF_ID, *ids.values()])
+        if TARIFF_ID not in meta_ids:
+            raise LookupError(f"no statistics for '{TARIFF_ID}'")
+        rows = get_hourly_rows(cur, meta_ids.values())
+        tariff = np.array([(ts, mean if mean is not None else np.nan)
+                           for ts, _, mean in rows[meta_ids[TARIFF_ID]]],
+                          dtype=float).reshape(-1, 2)
+        tariff = tariff[~np.isnan(tariff[:, 1])]
+        return {
+            cap: BatterySeries(rows[meta_ids[sid]], tariff[:, 0], tariff[:, 1])
+            for cap, sid in ids.items()
+            if sid in meta_ids
+        }
+
+    def totals(self, caps=None, start_ts=None, end_ts=None, threshold=None):
+        self.refresh()
+        batteries = self.batteries
+        caps = batteries if caps is None else caps
+        return {cap: batteries[cap].totals(start_ts, end_ts, threshold)
+                for cap in caps if cap in batteries}
+
+    def status(self):
+        self.refresh()
+        return {
+            "db": self.db_path,
+            "last_hour_ts": self.last_ts,
+            "loads": self.loads,
+            "hours": {cap: len(series) for cap, series in self.batteries.items()},
+        }
+
+
+def local_day_start(text, tz=TIMEZONE, days=0):
+    """Epoch seconds of local midnight of an ISO date (plus days)."""
+    day = date.fromisoformat(text) + timedelta(days=days)
+    return datetime(day.year, day.month, day.day, tzinfo=ZoneInfo(tz)).timestamp()
+
+
+def parse_query(query):
+    """(caps, start_ts, end_ts, threshold) from /totals query parameters."""
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    caps = None
+    if params.get("battery"):
+        caps = [int(float(v)) for v in params["battery"].split(",")]
+    start_ts = local_day_start(params["from"]) if params.get("from") else None
+    end_ts = local_day_start(params["to"], days=1) if params.get("to") else None
+    threshold = float(params["threshold"]) if params.get("threshold") else None
+    return caps, start_ts, end_ts, threshold
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "recalc-serve/1"
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        cache = self.server.cache
+        if url.path == "/status":
+            try:
+                self._send(200, cache.status())
+            except (LookupError, sqlite3.Error) as exc:
+                self._send(503, {"error": str(exc)})
+            return
+        if url.path != "/totals":
+            self._send(404, {"error": f"unknown path {url.path}"})
+            return
+        try:
+            caps, start_ts, end_ts, threshold = parse_query(url.query)
+        except ValueError as exc:
+            self._send(400, {"error": str(exc)})
+            return
+        started = time.perf_counter()
+        try:
+            batteries = cache.totals(caps, start_ts, end_ts, threshold)
+        except (LookupError, sqlite3.Error) as exc:
+            # Tariff or battery sensor gone after a purge, database unreadable.
+            self._send(503, {"error": str(exc)})
+            return
+        self._send(200, {
+            "from_ts": start_ts,
+            "to_ts": end_ts,
+            "threshold": PRICE_THRESHOLD if threshold is None else threshold,
+            "batteries": {str(cap): t for cap, t in batteries.items()},
+            "query_ms": round((time.perf_counter() - started) * 1000, 3),
+        })
+
+
+def make_server(cache, host="127.0.0.1", port=DEFAULT_PORT):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.cache = cache
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve virtual battery self-consumption totals over HTTP."
+    )
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH,
+                        help=f"recorder database (default: {DEFAULT_DB_PATH})")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--check-interval", type=float, default=CHECK_INTERVAL_S,
+                        help="seconds between checks for new hourly rows "
+                             f"(default: {CHECK_INTERVAL_S:g})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cache = TotalsCache(args.db, args.check_interval)
+    started = time.perf_counter()
+    try:
+        cache.refresh(force=True)
+    except (LookupError, sqlite3.Error) as exc:
+        print(f"ERROR: {exc}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Loaded {sum(map(len, cache.batteries.values()))} hours in "
+          f"{time.perf_counter() - started:.2f}s; serving on http://{args.host}:{args.port}")
+    server = make_server(cache, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
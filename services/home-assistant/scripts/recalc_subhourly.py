@@ -0,0 +1,197 @@
+"""
+Sub-hourly self-consumption totals for recalc_self_consumption.py.
+
+The hourly statistics hide changes within the hour (battery discharge, and
+quarter-hourly prices). HA keeps finer data for the last purge_keep_days
+(default 10):
+
+  5min   statistics_short_term: 5-minute rows with the same sum/mean columns
+         as the hourly statistics,
+  state  states (via states_meta): every recorded state of the energy_out and
+         tariff sensors.
+
+Both are streamed through a generator pipeline, so memory stays flat however
+many rows there are:
+
+  stream()   rows of one sensor, ordered by time, fetched in batches on a
+             cursor of its own (index walk on (metadata_id, ts), no sort),
+  numeric()  skip NULL / 'unavailable' / 'unknown' samples,
+  deltas()   energy delta per sample, dated at the start of the interval it
+             covers (the row's own period for statistics, the previous
+             sample for states),
+  merge      all energy_out sensors merged by time (heapq.merge),
+  price()    as-of join with the tariff stream: the tariff valid at that time,
+  fold()     the same totals (and report) as the hourly aggregation.
+
+The tariff of a 5-minute row must be recorded for that same period; a tariff
+state stays valid until the next one (HA only records changes).
+"""
+
+import heapq
+from operator import itemgetter
+
+from recalc_common import (
+    BATTERY_SIZES,
+    ENERGY_OUT_PATTERN,
+    PRICE_THRESHOLD,
+    TARIFF_ID,
+    TOTAL_KEYS,
+    add_delta,
+    check_query_plan,
+    get_metadata_ids,
+)
+
+# Rows fetched per batch and stream; bounds the memory of the pipeline.
+FETCH_ROWS = 1000
+
+SHORT_TERM_INDEX = "ix_statistics_short_term_statistic_id_start_ts"
+STATES_INDEX = "ix_states_metadata_id_last_updated_ts"
+
+SHORT_TERM_SQL = (
+    "SELECT start_ts, {column} FROM statistics_short_term"
+    " WHERE metadata_id = ? AND start_ts >= ? ORDER BY start_ts"
+)
+STATES_SQL = (
+    "SELECT last_updated_ts, state FROM states"
+    " WHERE metadata_id = ? AND last_updated_ts >= ? ORDER BY last_updated_ts"
+)
+
+
+def get_states_metadata_ids(cur, entity_ids):
+    """{entity_id: states_meta id} in one query; missing ids are left out."""
+    entity_ids = list(entity_ids)
+    cur.execute(
+        "SELECT entity_id, metadata_id FROM states_meta"
+        f" WHERE entity_id IN ({', '.join('?' * len(entity_ids))})",
+        entity_ids,
+    )
+    return dict(cur.fetchall())
+
+
+def stream(conn, sql, params, index, size=None):
+    """Rows of sql, fetched `size` (FETCH_ROWS) at a time on a cursor of its own."""
+    size = size or FETCH_ROWS
+    cur = conn.cursor()
+    check_query_plan(cur, sql, params, aliases=("statistics_short_term", "states"),
+                     index=index)
+    cur.execute(sql, params)
+    try:
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cur.close()
+
+
+def numeric(rows):
+    """(ts, float) samples; rows without a numeric value are skipped."""
+    for ts, value in rows:
+        try:
+            yield ts, float(value)
+        except (TypeError, ValueError):
+            continue
+
+
+def deltas(samples, key, at_previous=False):
+    """(at, key, ts, delta) per sample; delta is None for the first one.
+
+    `at` is the start of the interval the delta covers: the sample's own ts
+    for statistics rows, the previous sample's ts for states (at_previous).
+    """
+    prev_ts = prev = None
+    for ts, value in samples:
+        if prev is None:
+            yield ts, key, ts, None
+        else:
+            yield (prev_ts if at_previous else ts), key, ts, value - prev
+        prev_ts, prev = ts, value
+
+
+def price(events, tariffs, max_age=None):
+    """Append the tariff valid at each event's time (None if unknown).
+
+    That is the last tariff sample at or before it, and at most max_age
+    seconds older when max_age is given. Both inputs are ordered by time.
+    """
+    tariffs = iter(tariffs)
+    current = None
+    upcoming = next(tariffs, None)
+    for event in events:
+        at = event[0]
+        while upcoming is not None and upcoming[0] <= at:
+            current = upcoming
+            upcoming = next(tariffs, None)
+        valid = current is not None and (max_age is None or at - current[0] <= max_age)
+        yield (*event, current[1] if valid else None)
+
+
+def fold(priced, keys, threshold=PRICE_THRESHOLD):
+    """Totals per key from (at, key, ts, delta, tariff) events."""
+    results = {key: dict.fromkeys(TOTAL_KEYS, 0) for key in keys}
+    for t in results.values():
+        t["ts_first"] = t["ts_last"] = None
+    for _, key, ts, delta, tariff in priced:
+        t = results[key]
+        t["n_rows"] += 1
+        if t["ts_first"] is None:
+            t["ts_first"] = ts
+        t["ts_last"] = ts
+        if delta is not None:
+            add_delta(t, delta, tariff, threshold)
+    return results
+
+
+def _energy_ids():
+    return {cap: ENERGY_OUT_PATTERN.format(cap=cap) for cap in BATTERY_SIZES}
+
+
+def aggregate_short_term(cur, tariff_meta, threshold=PRICE_THRESHOLD, since=None):
+    """Totals per battery size from the 5-minute statistics_short_term."""
+    since = since or {}
+    conn = cur.connection
+    found = get_metadata_ids(cur, _energy_ids().values())
+    caps = {cap: found[sid] for cap, sid in _energy_ids().items() if sid in found}
+    sums = SHORT_TERM_SQL.format(column="sum")
+    events = heapq.merge(
+        *(
+            deltas(numeric(stream(conn, sums, (meta_id, since.get(cap, 0)),
+                                  SHORT_TERM_INDEX)), cap)
+            for cap, meta_id in caps.items()
+        ),
+        key=itemgetter(0),
+    )
+    tariffs = numeric(stream(conn, SHORT_TERM_SQL.format(column="mean"),
+                             (tariff_meta, 0), SHORT_TERM_INDEX))
+    return fold(price(events, tariffs, max_age=0), caps, threshold)
+
+
+def aggregate_states(cur, tariff_meta, threshold=PRICE_THRESHOLD, since=None):
+    """Totals per battery size from every recorded state.
+
+    tariff_meta (a statistics_meta id) is not used; the tariff entity is
+    looked up in states_meta with the energy_out entities.
+    """
+    since = since or {}
+    conn = cur.connection
+    found = get_states_metadata_ids(cur, [TARIFF_ID, *_energy_ids().values()])
+    caps = {cap: found[eid] for cap, eid in _energy_ids().items() if eid in found}
+    events = heapq.merge(
+        *(
+            deltas(numeric(stream(conn, STATES_SQL, (meta_id, since.get(cap, 0)),
+                                  STATES_INDEX)), cap, at_previous=True)
+            for cap, meta_id in caps.items()
+        ),
+        key=itemgetter(0),
+    )
+    tariffs = ()
+    if TARIFF_ID in found:
+        tariffs = numeric(stream(conn, STATES_SQL, (found[TARIFF_ID], 0), STATES_INDEX))
+    return fold(price(events, tariffs), caps, threshold)
+
+
+AGGREGATORS = {
+    "5min": aggregate_short_term,
+    "state": aggregate_states,
+}
@@ -0,0 +1,78 @@
+"""Shared fixtures for the recorder analysis script tests and benchmarks.
+
+The scripts are standalone files that import each other as siblings, so the
+scripts directory is put on sys.path here.
+
+Benchmark knobs (environment variables):
+  RECALC_BENCH_YEARS      history in the synthetic recorder db (default 0.25)
+  RECALC_BENCH_SENSORS    unrelated sensors interleaved in it   (default 20)
+  RECALC_BENCH_JSON       write the benchmark table to this JSON file
+  RECALC_BENCH_BASELINE   JSON from an earlier run; fail when a path got slower
+  RECALC_BENCH_TOLERANCE  allowed slowdown vs the baseline     (default 1.5)
+"""
+import json
+import os
+import pathlib
+import sys
+
+import pytest
+
+SCRIPTS_DIR = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SCRIPTS_DIR))
+
+import make_recorder_db  # noqa: E402
+
+BENCH_RESULTS = []
+
+
+@pytest.fixture(scope="session")
+def recorder_db(tmp_path_factory):
+    """Synthetic recorder db with gaps, NULL sums and a few resets."""
+    path = tmp_path_factory.mktemp("recorder") / "home-assistant_v2.db"
+    make_recorder_db.generate(
+        str(path),
+        years=float(os.environ.get("RECALC_BENCH_YEARS", "0.25")),
+        extra_sensors=int(os.environ.get("RECALC_BENCH_SENSORS", "20")),
+        gap_rate=0.01,
+        null_rate=0.002,
+        reset_rate=0.0005,
+        seed=1,
+    )
+    return path
+
+
+@pytest.fixture
+def bench_report():
+    """Append a benchmark measurement (dict) to the session report."""
+    return BENCH_RESULTS.append
+
+
+def _baseline():
+    path = os.environ.get("RECALC_BENCH_BASELINE")
+    if not path:
+        return {}
+    with open(path) as f:
+        return {row["path"]: row for row in json.load(f)}
+
+
+@pytest.fixture(scope="session")
+def bench_baseline():
+    return _baseline(), float(os.environ.get("RECALC_BENCH_TOLERANCE", "1.5"))
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not BENCH_RESULTS:
+        return
+    tr = terminalreporter
+    tr.section("recalc benchmarks")
+    tr.write_line(f"{'path':<24}{'wall s':>10}{'cpu s':>10}{'peak +RSS MB':>14}{'rows/s':>14}")
+    for row in BENCH_RESULTS:
+        tr.write_line(
+            f"{row['path']:<24}{row['wall_s']:>10.3f}{row['cpu_s']:>10.3f}"
+            f"{row['peak_rss_growth_kb'] / 1024:>14.1f}{row['rows_per_s']:>14.0f}"
+        )
+    out = os.environ.get("RECALC_BENCH_JSON")
+    if out:
+        with open(out, "w") as f:
+            json.dump(BENCH_RESULTS, f, indent=2)
+        tr.write_line(f"written to {out}")
@@ -0,0 +1,105 @@
+"""Batch totals over many recorder db snapshots (recalc_batch.py)."""
+import csv
+import shutil
+import sqlite3
+
+import pytest
+
+import recalc_batch
+import recalc_self_consumption as recalc
+
+DAY = 24 * 3600
+
+
+def truncated_copy(db, path, days):
+    """Copy of db as it was `days` days before its last hour."""
+    shutil.copy(db, path)
+    conn = sqlite3.connect(path)
+    (last,) = conn.execute("SELECT MAX(start_ts) FROM statistics").fetchone()
+    conn.execute("DELETE FROM statistics WHERE start_ts > ?", (last - days * DAY,))
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def totals_of(path):
+    conn = recalc.connect_readonly(path)
+    cur = conn.cursor()
+    results = recalc.aggregate_sql(cur, recalc.get_metadata_id(cur, recalc.TARIFF_ID))
+    conn.close()
+    return results
+
+
+@pytest.fixture(scope="module")
+def snapshots(recorder_db, tmp_path_factory):
+    """Four backups (two identical) plus files that are not databases."""
+    directory = tmp_path_factory.mktemp("backups")
+    paths = {
+        "b": truncated_copy(recorder_db, directory / "ha.db.2", 14),
+        "a": truncated_copy(recorder_db, directory / "ha.db.3", 28),
+        "c": str(directory / "ha.db.1"),
+        "d": str(directory / "ha.db.0"),
+    }
+    shutil.copy(recorder_db, paths["c"])
+    shutil.copy(recorder_db, paths["d"])
+    (directory / "notes.txt").write_text("not a database")
+    return directory, paths
+
+
+def test_batch_matches_a_report_per_snapshot(snapshots):
+    directory, paths = snapshots
+    found = recalc_batch.find_databases([str(directory)])
+    assert found == sorted(paths.values())
+
+    entries = recalc_batch.run_batch(found, workers=2)
+    by_path = {e["path"]: e for e in entries}
+    assert [e["path"] for e in entries[:2]] == [paths["a"], paths["b"]]  # oldest data first
+    for name in ("a", "b", "c"):
+        assert by_path[paths[name]]["results"] == totals_of(paths[name]), name
+    # c and d hold the same statistics: only one of them is aggregated.
+    assert sorted(by_path[paths[n]]["status"] for n in "cd") == ["new", "same"]
+    assert by_path[paths["d"]]["results"] == by_path[paths["c"]]["results"]
+    assert by_path[paths["a"]]["as_of"] < by_path[paths["b"]]["as_of"] < by_path[paths["c"]]["as_of"]
+
+
+def test_results_file_skips_known_snapshots(snapshots, tmp_path):
+    directory, paths = snapshots
+    results_path = str(tmp_path / "batch.json")
+    found = recalc_batch.find_databases([str(directory)])
+    stored = recalc_batch.load_results(results_path)
+    first = recalc_batch.run_batch(found, workers=2, stored=stored)
+    recalc_batch.save_results(results_path, stored)
+
+    second = recalc_batch.run_batch(found, workers=2,
+                                    stored=recalc_batch.load_results(results_path))
+    assert {e["status"] for e in second} == {"stored"}
+    assert [e["results"] for e in second] == [e["results"] for e in first]
+
+
+def test_unreadable_snapshot_is_reported(snapshots, tmp_path, capsys):
+    directory, paths = snapshots
+    broken = tmp_path / "broken.db"
+    broken.write_bytes(recalc_batch.SQLITE_HEADER + b"\0" * 4000)
+    output = tmp_path / "trend.csv"
+    with pytest.raises(SystemExit) as exit_info:
+        recalc_batch.main([paths["a"], str(tmp_path / "*.db"), "--workers", "2",
+                           "--format", "csv", "--output", str(output)])
+    assert exit_info.value.code == 1
+    err = capsys.readouterr().err
+    assert "2 snapshots" in err and "1 berekend" in err and "1 fout" in err
+
+    with open(output) as f:
+        rows = list(csv.DictReader(f))
+    assert {row["snapshot"] for row in rows} == {paths["a"]}
+    assert len(rows) == len(recalc.BATTERY_SIZES)
+
+
+def test_comparison_table(snapshots, capsys):
+    directory, paths = snapshots
+    recalc_batch.main([str(directory), "--workers", "2"])
+    out = capsys.readouterr().out
+    assert "4 snapshots" in out and "3 berekend, 1 ongewijzigd overgeslagen" in out
+    lines = out.splitlines()
+    table = lines[lines.index(next(line for line in lines if line.startswith("snapshot"))):]
+    assert len(table) == 5
+    assert "(+" in table[2]  # EUR gained since the previous snapshot
@@ -0,0 +1,239 @@
+"""Benchmarks + cross-checks for the self-consumption aggregation paths.
+
+Run from the repo root:
+
+    pytest services/home-assistant/scripts/tests/ -rA
+
+Every path runs against the same synthetic recorder db (make_recorder_db.py)
+in a fresh spawned process, so wall time, CPU time and peak memory are
+measured per path. Memory is the peak RSS above the RSS once the interpreter
+and every path's imports (numpy included) are loaded: on Linux the high-water
+mark is reset at that point (/proc/self/clear_refs), elsewhere only growth
+beyond the import peak shows. SQLite and numpy buffers count too. The table
+is printed at the end of the session; see conftest.py for the size knobs and
+the JSON baseline used to catch regressions. Each path must also produce the
+same totals as the reference Python loop.
+"""
+import contextlib
+import importlib
+import multiprocessing
+import re
+import resource
+import shutil
+import sqlite3
+import time
+
+import pytest
+
+import recalc_checkpoint
+import recalc_self_consumption as recalc
+
+ENERGY_IDS = [recalc.ENERGY_OUT_PATTERN.format(cap=cap) for cap in recalc.BATTERY_SIZES]
+WEEK = 7 * 24 * 3600
+
+
+def _open(db):
+    conn = recalc.connect_readonly(db)
+    cur = conn.cursor()
+    return conn, cur, recalc.get_metadata_id(cur, recalc.TARIFF_ID)
+
+
+def run_python(db):
+    conn, cur, tariff_meta = _open(db)
+    try:
+        return recalc.aggregate_python(cur, tariff_meta)
+    finally:
+        conn.close()
+
+
+def run_sql(db):
+    conn, cur, tariff_meta = _open(db)
+    try:
+        return recalc.aggregate_sql(cur, tariff_meta)
+    finally:
+        conn.close()
+
+
+def run_checkpoint(db, store_path):
+    conn, cur, tariff_meta = _open(db)
+    store = recalc_checkpoint.CheckpointStore(store_path, recalc.TOTAL_KEYS)
+    try:
+        return recalc_checkpoint.aggregate_incremental(
+            cur, recalc.aggregate_sql, store, recalc.energy_out_sensors(cur),
+            (recalc.TARIFF_ID, tariff_meta), recalc.PRICE_THRESHOLD
+        )
+    finally:
+        store.close()
+        conn.close()
+
+
+def run_cache(db, cache_path):
+    import recalc_cache
+
+    conn, cur, _ = _open(db)
+    try:
+        cache = recalc_cache.StatisticsCache(cache_path)
+        cache.update(cur, ENERGY_IDS + [recalc.TARIFF_ID])
+        return recalc_cache.aggregate_cached(cache)
+    finally:
+        conn.close()
+
+
+def run_simulate(db):
+    import vb_simulate
+
+    conn = recalc.connect_readonly(db)
+    try:
+        series = vb_simulate.load_series(conn.cursor())
+    finally:
+        conn.close()
+    configs = vb_simulate.make_configs(capacity=recalc.BATTERY_SIZES)
+    results = vb_simulate.simulate(series, configs)
+    return {cap: results["total_eur"][i] for i, cap in enumerate(recalc.BATTERY_SIZES)}
+
+
+def _status_kb(field):
+    with open("/proc/self/status") as f:
+        return int(re.search(rf"^{field}:\s+(\d+)", f.read(), re.M).group(1))
+
+
+def _reset_peak_rss():
+    """RSS now, with the peak reset to it (Linux); else the peak so far."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _status_kb("VmRSS")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _peak_rss():
+    try:
+        return _status_kb("VmHWM")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(fn, args):
+    # Same imports for every path, so none is charged for numpy's.
+    for module in ("numpy", "recalc_cache", "vb_simulate"):
+        with contextlib.suppress(ImportError):
+            importlib.import_module(module)
+    baseline_kb = _reset_peak_rss()
+    started, cpu_started = time.perf_counter(), time.process_time()
+    result = fn(*args)
+    return {
+        "result": result,
+        "wall_s": time.perf_counter() - started,
+        "cpu_s": time.process_time() - cpu_started,
+        "peak_rss_growth_kb": _peak_rss() - baseline_kb,
+    }
+
+
+def measure(fn, *args):
+    """Run fn(*args) in a fresh process; returns result + resource usage."""
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(_measure, (fn, args))
+
+
+def input_rows(db):
+    conn = sqlite3.connect(db)
+    ids = ENERGY_IDS + [recalc.TARIFF_ID]
+    (rows,) = conn.execute(
+        "SELECT COUNT(*) FROM statistics s JOIN statistics_meta m"
+        " ON m.id = s.metadata_id"
+        f" WHERE m.statistic_id IN ({', '.join('?' * len(ids))})",
+        ids,
+    ).fetchone()
+    conn.close()
+    return rows
+
+
+@pytest.fixture(scope="module")
+def reference(recorder_db):
+    return run_python(str(recorder_db))
+
+
+def without_last_week(db, path):
+    shutil.copy(db, path)
+    conn = sqlite3.connect(path)
+    (last,) = conn.execute("SELECT MAX(start_ts) FROM statistics").fetchone()
+    conn.execute("DELETE FROM statistics WHERE start_ts > ?", (last - WEEK,))
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def warm_checkpoint(recorder_db, tmp_path):
+    """Checkpoint store built from the same history minus its last week."""
+    older = without_last_week(recorder_db, tmp_path / "older.db")
+    store_path = str(tmp_path / "checkpoint.sqlite")
+    run_checkpoint(str(older), store_path)
+    return store_path
+
+
+@pytest.fixture
+def warm_cache(recorder_db, tmp_path):
+    """Statistics cache built from the same history minus its last week."""
+    pytest.importorskip("numpy")
+    older = without_last_week(recorder_db, tmp_path / "older.db")
+    cache_path = str(tmp_path / "cache")
+    run_cache(str(older), cache_path)
+    return cache_path
+
+
+def assert_same_totals(actual, expected):
+    assert actual.keys() == expected.keys()
+    for cap, totals in expected.items():
+        for key, value in totals.items():
+            assert actual[cap][key] == pytest.approx(value, rel=1e-9, abs=1e-9), (cap, key)
+
+
+def check_benchmark(name, measured, db, bench_report, bench_baseline):
+    rows = input_rows(db)
+    row = {
+        "path": name,
+        "wall_s": measured["wall_s"],
+        "cpu_s": measured["cpu_s"],
+        "peak_rss_growth_kb": measured["peak_rss_growth_kb"],
+        "rows": rows,
+        "rows_per_s": rows / measured["wall_s"] if measured["wall_s"] else 0.0,
+    }
+    bench_report(row)
+    baseline, tolerance = bench_baseline
+    if name in baseline:
+        assert row["wall_s"] <= baseline[name]["wall_s"] * tolerance, (
+            f"{name} regressed: {row['wall_s']:.3f}s vs baseline "
+            f"{baseline[name]['wall_s']:.3f}s"
+        )
+
+
+# --- aggregation paths ----------------------------------------------------
+@pytest.mark.parametrize("name, fn", [("python", run_python), ("sql", run_sql)])
+def test_aggregate_full(name, fn, recorder_db, reference, bench_report, bench_baseline):
+    measured = measure(fn, str(recorder_db))
+    assert_same_totals(measured["result"], reference)
+    check_benchmark(name, measured, recorder_db, bench_report, bench_baseline)
+
+
+def test_aggregate_checkpoint_last_week(recorder_db, reference, warm_checkpoint,
+                                        bench_report, bench_baseline):
+    measured = measure(run_checkpoint, str(recorder_db), warm_checkpoint)
+    assert_same_totals(measured["result"], reference)
+    check_benchmark("sql+checkpoint", measured, recorder_db, bench_report, bench_baseline)
+
+
+def test_aggregate_cache_last_week(recorder_db, reference, warm_cache,
+                                   bench_report, bench_baseline):
+    measured = measure(run_cache, str(recorder_db), warm_cache)
+    assert_same_totals(measured["result"], reference)
+    check_benchmark("numpy+cache", measured, recorder_db, bench_report, bench_baseline)
+
+
+def test_simulate_battery_sizes(recorder_db, bench_report, bench_baseline):
+    pytest.importorskip("numpy")
+    measured = measure(run_simulate, str(recorder_db))
+    assert all(eur >= 0 for eur in measured["result"].values())
+    check_benchmark("simulate", measured, recorder_db, bench_report, bench_baseline)
@@ -0,0 +1,158 @@
+"""Memory-mapped statistics cache (recalc_cache.py) against the recorder."""
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import recalc_cache  # noqa: E402
+import recalc_self_consumption as recalc  # noqa: E402
+import vb_simulate  # noqa: E402
+
+ENERGY_IDS = [recalc.ENERGY_OUT_PATTERN.format(cap=cap) for cap in recalc.BATTERY_SIZES]
+WEEK = 7 * 24 * 3600
+
+
+def truncated_copy(db, path, before=WEEK):
+    """Copy of db without its last `before` seconds of statistics."""
+    shutil.copy(db, path)
+    conn = sqlite3.connect(path)
+    (last,) = conn.execute("SELECT MAX(start_ts) FROM statistics").fetchone()
+    conn.execute("DELETE FROM statistics WHERE start_ts > ?", (last - before,))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def update(db, cache_path, ids=None, rebuild=False):
+    conn = recalc.connect_readonly(str(db))
+    cur = conn.cursor()
+    cache = recalc_cache.StatisticsCache(str(cache_path))
+    added = cache.update(cur, ids or recalc_cache.cached_ids(cur), rebuild=rebuild)
+    conn.close()
+    return cache, added
+
+
+def recorder_rows(db, statistic_id):
+    conn = recalc.connect_readonly(str(db))
+    cur = conn.cursor()
+    meta_id = recalc.get_metadata_id(cur, statistic_id)
+    rows = recalc.get_hourly_rows(cur, [meta_id])[meta_id]
+    conn.close()
+    return np.array(rows, dtype=float).reshape(-1, 3)
+
+
+def assert_matches_recorder(cache, db, statistic_ids):
+    for statistic_id in statistic_ids:
+        columns = cache.columns(statistic_id)
+        expected = recorder_rows(db, statistic_id)
+        np.testing.assert_array_equal(np.column_stack(columns), expected, err_msg=statistic_id)
+
+
+def test_cache_holds_the_recorder_rows_memory_mapped(recorder_db, tmp_path):
+    cache, added = update(recorder_db, tmp_path / "cache")
+    ids = ENERGY_IDS + [recalc.TARIFF_ID, vb_simulate.GRID_IMPORT_ID, vb_simulate.GRID_EXPORT_ID]
+    assert sorted(added) == sorted(ids)
+    assert_matches_recorder(cache, recorder_db, ids)
+
+    columns = cache.columns(recalc.TARIFF_ID)
+    assert isinstance(columns.start_ts, np.memmap)
+    assert not columns.mean.flags.writeable
+    assert cache.columns("sensor.does_not_exist") is None
+
+
+def test_incremental_update_appends_new_hours(recorder_db, tmp_path):
+    older = truncated_copy(recorder_db, tmp_path / "older.db")
+    update(older, tmp_path / "cache")
+    cache, added = update(recorder_db, tmp_path / "cache")
+    assert all(n > 0 for n in added.values())
+    assert_matches_recorder(cache, recorder_db, added)
+
+    _, again = update(recorder_db, tmp_path / "cache")
+    assert set(again.values()) == {0}
+
+
+def test_rewritten_history_rebuilds_the_sensor(recorder_db, tmp_path, capsys):
+    db = tmp_path / "rewritten.db"
+    shutil.copy(recorder_db, db)
+    update(db, tmp_path / "cache", ENERGY_IDS)
+
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "UPDATE statistics SET sum = sum + 1 WHERE start_ts = (SELECT MAX(start_ts)"
+        " FROM statistics) AND metadata_id = (SELECT id FROM statistics_meta"
+        " WHERE statistic_id = ?)", (ENERGY_IDS[0],),
+    )
+    conn.commit()
+    conn.close()
+
+    cache, added = update(db, tmp_path / "cache", ENERGY_IDS)
+    assert f"Cache {ENERGY_IDS[0]} invalid (history rewritten)" in capsys.readouterr().err
+    assert added[ENERGY_IDS[0]] == cache.manifest[ENERGY_IDS[0]]["rows"]
+    assert added[ENERGY_IDS[1]] == 0
+    assert_matches_recorder(cache, db, ENERGY_IDS)
+
+
+def test_interrupted_append_tail_is_cut_off(recorder_db, tmp_path):
+    older = truncated_copy(recorder_db, tmp_path / "older.db")
+    cache, _ = update(older, tmp_path / "cache", [recalc.TARIFF_ID])
+    for column in recalc_cache.COLUMNS:
+        with open(cache._file(recalc.TARIFF_ID, column), "ab") as f:
+            f.write(b"\xff" * 24)  # rows written, manifest never replaced
+
+    cache, _ = update(recorder_db, tmp_path / "cache", [recalc.TARIFF_ID])
+    assert_matches_recorder(cache, recorder_db, [recalc.TARIFF_ID])
+
+
+def test_cached_totals_match_python_loop(recorder_db, tmp_path):
+    cache, _ = update(recorder_db, tmp_path / "cache")
+    conn = recalc.connect_readonly(str(recorder_db))
+    cur = conn.cursor()
+    tariff_meta = recalc.get_metadata_id(cur, recalc.TARIFF_ID)
+    first = cache.columns(ENERGY_IDS[0]).start_ts
+    since = {recalc.BATTERY_SIZES[0]: float(first[len(first) // 2])}
+    for kwargs in ({}, {"threshold": 0.2, "since": since}):
+        expected = recalc.aggregate_python(cur, tariff_meta, **kwargs)
+        actual = recalc_cache.aggregate_cached(cache, **kwargs)
+        assert actual.keys() == expected.keys()
+        for cap, totals in expected.items():
+            for key, value in totals.items():
+                assert actual[cap][key] == pytest.approx(value, rel=1e-9, abs=1e-9), (cap, key)
+    conn.close()
+
+
+def test_series_from_cache_matches_recorder(recorder_db, tmp_path):
+    conn = recalc.connect_readonly(str(recorder_db))
+    cur = conn.cursor()
+    expected = vb_simulate.load_series(cur)
+    cached = vb_simulate.load_series(cur, cache=recalc_cache.StatisticsCache(str(tmp_path / "c")))
+    conn.close()
+    for name, values in expected._asdict().items():
+        np.testing.assert_array_equal(getattr(cached, name), values, err_msg=name)
+
+
+def test_report_with_cache(recorder_db, tmp_path, capsys):
+    recalc.main([str(recorder_db), "--format", "json"])
+    expected = json.loads(capsys.readouterr().out)
+    cache_path = str(tmp_path / "cache")
+    for _ in range(2):  # build, then read the warm cache
+        recalc.main([str(recorder_db), "--cache", cache_path, "--format", "json"])
+        actual = json.loads(capsys.readouterr().out)
+        assert [row["battery_kwh"] for row in actual] == [row["battery_kwh"] for row in expected]
+        for got, want in zip(actual, expected):
+            assert got == pytest.approx(want, rel=1e-9)
+
+
+def test_does_not_import_the_report_script():
+    # recalc_self_consumption.py imports this module for --cache; importing it
+    # back would load a second copy of the script.
+    code = "import sys, recalc_cache; print('recalc_self_consumption' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code],
+                         cwd=os.path.dirname(recalc_cache.__file__),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "False"
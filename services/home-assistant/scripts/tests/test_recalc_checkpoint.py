@@ -0,0 +1,128 @@
+"""Checkpointed running totals (recalc_checkpoint.py) and their invalidation."""
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import recalc_checkpoint
+import recalc_self_consumption as recalc
+
+WEEK = 7 * 24 * 3600
+
+
+def older_copy(db, path, before=WEEK):
+    """Copy of db without its last `before` seconds of statistics."""
+    shutil.copy(db, path)
+    conn = sqlite3.connect(path)
+    (last,) = conn.execute("SELECT MAX(start_ts) FROM statistics").fetchone()
+    conn.execute("DELETE FROM statistics WHERE start_ts > ?", (last - before,))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def tariff_meta_of(conn):
+    return conn.execute("SELECT id FROM statistics_meta WHERE statistic_id = ?",
+                        (recalc.TARIFF_ID,)).fetchone()[0]
+
+
+def run(db, store_path, aggregate=recalc.aggregate_sql):
+    conn = recalc.connect_readonly(str(db))
+    cur = conn.cursor()
+    store = recalc_checkpoint.CheckpointStore(str(store_path), recalc.TOTAL_KEYS)
+    try:
+        return recalc_checkpoint.aggregate_incremental(
+            cur, aggregate, store, recalc.energy_out_sensors(cur),
+            (recalc.TARIFF_ID, recalc.get_metadata_id(cur, recalc.TARIFF_ID)),
+            recalc.PRICE_THRESHOLD,
+        )
+    finally:
+        store.close()
+        conn.close()
+
+
+def full(db):
+    conn = recalc.connect_readonly(str(db))
+    cur = conn.cursor()
+    try:
+        return recalc.aggregate_python(cur, recalc.get_metadata_id(cur, recalc.TARIFF_ID))
+    finally:
+        conn.close()
+
+
+def assert_same_totals(actual, expected):
+    assert actual.keys() == expected.keys()
+    for cap, totals in expected.items():
+        for key, value in totals.items():
+            assert actual[cap][key] == pytest.approx(value, rel=1e-9, abs=1e-9), (cap, key)
+
+
+def test_incremental_run_matches_full_aggregation(recorder_db, tmp_path, capsys):
+    store = tmp_path / "checkpoint.sqlite"
+    run(older_copy(recorder_db, tmp_path / "older.db"), store)
+    assert_same_totals(run(recorder_db, store), full(recorder_db))
+    assert "invalid" not in capsys.readouterr().err
+
+
+def test_backfilled_tariff_rebuilds(recorder_db, tmp_path, capsys):
+    # Prices of a few hours were missing when the checkpoint was written and
+    # imported later: the totals of those hours changed.
+    older = older_copy(recorder_db, tmp_path / "older.db")
+    conn = sqlite3.connect(older)
+    conn.execute("DELETE FROM statistics WHERE metadata_id = ? AND start_ts IN"
+                 " (SELECT start_ts FROM statistics WHERE metadata_id = ?"
+                 "  ORDER BY start_ts LIMIT 48 OFFSET 100)",
+                 (tariff_meta_of(conn),) * 2)
+    conn.commit()
+    conn.close()
+    store = tmp_path / "checkpoint.sqlite"
+    stale = run(older, store)
+
+    totals = run(recorder_db, store)
+    assert "(tariff history changed), rebuilding" in capsys.readouterr().err
+    assert_same_totals(totals, full(recorder_db))
+    assert totals[30]["total_eur"] != pytest.approx(stale[30]["total_eur"])
+
+
+def test_recreated_tariff_rebuilds(recorder_db, tmp_path, capsys):
+    store = tmp_path / "checkpoint.sqlite"
+    run(recorder_db, store)
+    db = tmp_path / "recreated.db"
+    shutil.copy(recorder_db, db)
+    conn = sqlite3.connect(db)
+    meta_id = tariff_meta_of(conn)
+    conn.execute("UPDATE statistics_meta SET id = 9999 WHERE id = ?", (meta_id,))
+    conn.execute("UPDATE statistics SET metadata_id = 9999 WHERE metadata_id = ?", (meta_id,))
+    conn.commit()
+    conn.close()
+
+    assert_same_totals(run(db, store), full(db))
+    assert "(tariff recreated), rebuilding" in capsys.readouterr().err
+
+
+def test_checkpoint_of_an_older_version_is_dropped(recorder_db, tmp_path):
+    store = tmp_path / "checkpoint.sqlite"
+    conn = sqlite3.connect(store)
+    conn.execute("CREATE TABLE checkpoint (statistic_id TEXT NOT NULL, tariff_id TEXT"
+                 " NOT NULL, threshold REAL NOT NULL, metadata_id INTEGER NOT NULL,"
+                 " last_sum REAL, n_rows INTEGER, PRIMARY KEY (statistic_id, tariff_id,"
+                 " threshold))")
+    conn.execute("INSERT INTO checkpoint VALUES (?, ?, ?, 1, 0, 5)",
+                 (recalc.ENERGY_OUT_PATTERN.format(cap=30), recalc.TARIFF_ID,
+                  recalc.PRICE_THRESHOLD))
+    conn.commit()
+    conn.close()
+    assert_same_totals(run(recorder_db, store), full(recorder_db))
+
+
+def test_does_not_import_the_report_script():
+    # recalc_self_consumption.py imports this module when run as a script;
+    # importing it back would load a second copy of the script.
+    code = "import sys, recalc_checkpoint; print('recalc_self_consumption' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code],
+                         cwd=os.path.dirname(recalc_checkpoint.__file__),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "False"
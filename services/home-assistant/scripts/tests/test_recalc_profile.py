@@ -0,0 +1,88 @@
+"""Stage profiling of the report (--profile, recalc_profile.py)."""
+import json
+import pstats
+
+import pytest
+
+import recalc_profile
+import recalc_self_consumption as recalc
+
+ENERGY_IDS = [recalc.ENERGY_OUT_PATTERN.format(cap=cap) for cap in recalc.BATTERY_SIZES]
+
+
+def stages(result):
+    return {s["stage"]: s for s in result["stages"]}
+
+
+def test_profile_keeps_output_and_appends_json(recorder_db, tmp_path, capsys):
+    recalc.main([str(recorder_db), "--aggregate", "python", "--format", "json"])
+    expected = capsys.readouterr().out
+
+    path = tmp_path / "profile.jsonl"
+    dump = tmp_path / "profile.pstats"
+    for _ in range(2):
+        recalc.main([str(recorder_db), "--aggregate", "python", "--format", "json",
+                     "--profile", str(path), "--profile-dump", str(dump)])
+        out, err = capsys.readouterr()
+        assert out == expected
+        assert "aggregate" in err and f"Profile appended to {path}" in err
+
+    runs = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(runs) == 2
+    run = stages(runs[-1])
+    assert {"total", "open", "list_statistic_ids", "aggregate", "aggregate/fetch",
+            "aggregate/tariff_dict", "aggregate/accumulate_10kwh", "output"} <= set(run)
+    assert runs[-1]["db_bytes"] == recorder_db.stat().st_size
+    assert all(s["wall_s"] >= 0 and s["peak_kib"] >= 0 for s in run.values())
+    assert run["aggregate"]["peak_kib"] >= run["aggregate/fetch"]["peak_kib"] > 0
+
+    # The fetch stage read every row of the five sensors, through one query.
+    conn = recalc.connect_readonly(str(recorder_db))
+    cur = conn.cursor()
+    meta_ids = recalc.get_metadata_ids(cur, ENERGY_IDS + [recalc.TARIFF_ID])
+    expected_rows = sum(recalc.count_rows(cur, m) for m in meta_ids.values())
+    conn.close()
+    fetches = [q for q in runs[-1]["queries"]
+               if q["stage"] == "aggregate/fetch" and q["query"].startswith("SELECT")]
+    assert [(q["calls"], q["rows"]) for q in fetches] == [(1, expected_rows)]
+    assert run["total"]["rows"] >= expected_rows
+
+    assert pstats.Stats(str(dump)).total_calls > 0
+    assert recalc_profile.ACTIVE is None
+
+
+def test_profile_sql_path_counts_result_rows(recorder_db, tmp_path, capsys):
+    path = tmp_path / "profile.jsonl"
+    recalc.main([str(recorder_db), "--profile", str(path)])
+    capsys.readouterr()
+    (run,) = [json.loads(line) for line in path.read_text().splitlines()]
+    assert stages(run)["aggregate"]["rows"] >= len(recalc.BATTERY_SIZES)
+
+
+def test_stage_peaks_nest():
+    profiler = recalc_profile.Profiler()
+    profiler.start()
+    with recalc_profile.stage("outer"):
+        with recalc_profile.stage("big"):
+            block = bytearray(4 * 1024 * 1024)
+            del block
+        with recalc_profile.stage("small"):
+            block = bytearray(1024)
+            del block
+    profiler.stop()
+    run = stages(profiler.result())
+    assert run["outer/big"]["peak_kib"] >= 4096
+    assert run["outer/small"]["peak_kib"] < 1024
+    assert run["outer"]["peak_kib"] >= run["outer/big"]["peak_kib"]
+    assert run["total"]["peak_kib"] >= run["outer"]["peak_kib"]
+
+
+def test_stage_is_a_no_op_without_profile():
+    assert recalc_profile.ACTIVE is None
+    with recalc_profile.stage("anything"):
+        pass
+
+
+def test_profile_dump_needs_profile(recorder_db):
+    with pytest.raises(SystemExit):
+        recalc.parse_args([str(recorder_db), "--profile-dump", "x.pstats"])
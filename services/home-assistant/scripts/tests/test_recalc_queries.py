@@ -0,0 +1,47 @@
+"""Index usage of the recorder queries (EXPLAIN QUERY PLAN checks)."""
+import shutil
+import sqlite3
+
+import recalc_common
+import recalc_self_consumption as recalc
+
+ENERGY_IDS = [recalc.ENERGY_OUT_PATTERN.format(cap=cap) for cap in recalc.BATTERY_SIZES]
+
+
+def test_metadata_ids_resolved_in_one_query(recorder_db):
+    conn = recalc.connect_readonly(str(recorder_db))
+    cur = conn.cursor()
+    ids = recalc.get_metadata_ids(cur, ENERGY_IDS + ["sensor.does_not_exist"])
+    assert sorted(ids) == sorted(ENERGY_IDS)
+    assert all(ids[sid] == recalc.get_metadata_id(cur, sid) for sid in ENERGY_IDS)
+    conn.close()
+
+
+def test_debug_listing_matches_prefixes(recorder_db):
+    conn = recalc.connect_readonly(str(recorder_db))
+    listed = recalc.list_statistic_ids(conn.cursor())
+    conn.close()
+    assert listed == sorted(ENERGY_IDS + [recalc.TARIFF_ID])
+
+
+def test_aggregations_use_statistics_index(recorder_db, capsys):
+    conn = recalc.connect_readonly(str(recorder_db))
+    cur = conn.cursor()
+    tariff_meta = recalc.get_metadata_id(cur, recalc.TARIFF_ID)
+    assert recalc.aggregate_python(cur, tariff_meta) == recalc.aggregate_sql(cur, tariff_meta)
+    conn.close()
+    assert "WARNING" not in capsys.readouterr().err
+
+
+def test_warns_without_statistics_index(recorder_db, tmp_path, capsys):
+    db = tmp_path / "noindex.db"
+    shutil.copy(recorder_db, db)
+    conn = sqlite3.connect(db)
+    conn.execute(f"DROP INDEX {recalc_common.STATISTICS_INDEX}")
+    conn.close()
+
+    conn = recalc.connect_readonly(str(db))
+    cur = conn.cursor()
+    recalc.aggregate_python(cur, recalc.get_metadata_id(cur, recalc.TARIFF_ID))
+    conn.close()
+    assert f"WARNING: query plan does not use {recalc_common.STATISTICS_INDEX}" in capsys.readouterr().err
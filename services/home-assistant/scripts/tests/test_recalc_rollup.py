@@ -0,0 +1,212 @@
+"""Daily/monthly rollups (recalc_rollup.py) against a brute-force recompute."""
+import shutil
+import sqlite3
+
+import pytest
+
+import recalc_rollup
+import recalc_self_consumption as recalc
+
+CAP = 30
+STATISTIC_ID = recalc.ENERGY_OUT_PATTERN.format(cap=CAP)
+WEEK = 7 * 24 * 3600
+
+
+class Rollups:
+    def __init__(self, db, store_path, edges=(recalc.PRICE_THRESHOLD,)):
+        self.edges = list(edges)
+        self.conn = recalc.connect_readonly(str(db))
+        self.cur = self.conn.cursor()
+        self.tariff_meta = recalc.get_metadata_id(self.cur, recalc.TARIFF_ID)
+        self.store = recalc_rollup.RollupStore(str(store_path))
+
+    def update(self, rebuild=False):
+        return recalc_rollup.update(self.cur, self.store, self.edges, self.tariff_meta, rebuild)
+
+    def range(self, start_ts, end_ts):
+        meta_id = recalc.get_metadata_id(self.cur, STATISTIC_ID)
+        return recalc_rollup.range_sums(self.cur, self.store, self.edges, STATISTIC_ID,
+                                        meta_id, self.tariff_meta, start_ts, end_ts)
+
+    def close(self):
+        self.store.close()
+        self.conn.close()
+
+
+def brute_force(db, edges, start_ts, end_ts):
+    conn = sqlite3.connect(db)
+    rows = conn.execute(
+        "SELECT s.start_ts, s.sum FROM statistics s JOIN statistics_meta m"
+        " ON m.id = s.metadata_id WHERE m.statistic_id = ? ORDER BY s.start_ts",
+        (STATISTIC_ID,),
+    ).fetchall()
+    tariff = dict(conn.execute(
+        "SELECT s.start_ts, s.mean FROM statistics s JOIN statistics_meta m"
+        " ON m.id = s.metadata_id WHERE m.statistic_id = ?", (recalc.TARIFF_ID,),
+    ).fetchall())
+    conn.close()
+    sums = {}
+    for (_, prev), (ts, total) in zip(rows, rows[1:]):
+        delta = (total or 0) - (prev or 0)
+        if delta <= 0 or not start_ts <= ts < end_ts:
+            continue
+        price = tariff.get(ts)
+        bucket = recalc_rollup.bucket_of(edges, price)
+        hours, kwh, eur = sums.get(bucket, (0, 0.0, 0.0))
+        sums[bucket] = (hours + 1, kwh + delta, eur + (delta * price if price is not None else 0.0))
+    return sums
+
+
+def assert_same_sums(actual, expected):
+    assert sorted(actual) == sorted(expected)
+    for bucket, (hours, kwh, eur) in expected.items():
+        assert actual[bucket][0] == hours, bucket
+        assert actual[bucket][1] == pytest.approx(kwh, rel=1e-9), bucket
+        assert actual[bucket][2] == pytest.approx(eur, rel=1e-9), bucket
+
+
+@pytest.fixture
+def rollups(recorder_db, tmp_path):
+    r = Rollups(recorder_db, tmp_path / "rollup.sqlite", edges=(0.2, 0.3))
+    r.update()
+    yield r
+    r.close()
+
+
+def test_full_range_matches_report_totals(recorder_db, tmp_path):
+    r = Rollups(recorder_db, tmp_path / "rollup.sqlite")
+    r.update()
+    expected = recalc.aggregate_python(r.cur, r.tariff_meta)[CAP]
+    sums, pieces = r.range(expected["ts_first"], expected["ts_last"] + 3600)
+    r.close()
+    assert all(kind != "hours" for kind, _, _ in pieces[1:-1])
+    assert sums[1][1] == pytest.approx(expected["total_kwh_high"], rel=1e-9)
+    assert sums[1][2] == pytest.approx(expected["total_eur_high"], rel=1e-9)
+    assert sums[0][1] == pytest.approx(expected["total_kwh_low"], rel=1e-9)
+    assert sums[0][0] + sums[1][0] == expected["hours_matched"]
+    assert sums.get(recalc_rollup.NO_TARIFF, [0])[0] == expected["hours_unmatched"]
+
+
+@pytest.mark.parametrize("start, end", [
+    ("2024-01-15T13:00", "2024-03-02T05:00"),  # partial days, whole month in between
+    ("2024-02-01", "2024-02-29"),              # exactly one month (--to inclusive)
+    ("2024-02-03T10:00", "2024-02-03T18:00"),  # within one day
+    ("2024-03-30", "2024-04-02"),              # across the DST change
+])
+def test_ranges_match_brute_force(rollups, recorder_db, start, end):
+    start_ts = recalc_rollup.parse_time(start)
+    end_ts = recalc_rollup.parse_time(end, end=True)
+    sums, pieces = rollups.range(start_ts, end_ts)
+    assert_same_sums(sums, brute_force(str(recorder_db), rollups.edges, start_ts, end_ts))
+
+
+def test_range_uses_monthly_rollup():
+    pieces = recalc_rollup.split_range(recalc_rollup.parse_time("2024-01-15T13:00"),
+                                       recalc_rollup.parse_time("2024-03-02T05:00"))
+    assert [kind for kind, _, _ in pieces] == [
+        "hours", "rollup_day", "rollup_month", "rollup_day", "hours",
+    ]
+    assert pieces[2][1:] == ("2024-02", "2024-03")
+
+
+def test_incremental_update_equals_rebuild(recorder_db, tmp_path):
+    older = tmp_path / "older.db"
+    shutil.copy(recorder_db, older)
+    conn = sqlite3.connect(older)
+    (last,) = conn.execute("SELECT MAX(start_ts) FROM statistics").fetchone()
+    conn.execute("DELETE FROM statistics WHERE start_ts > ?", (last - WEEK,))
+    conn.commit()
+    conn.close()
+
+    store = tmp_path / "rollup.sqlite"
+    r = Rollups(older, store)
+    r.update()
+    r.close()
+    incremental = Rollups(recorder_db, store)
+    incremental.update()
+    rebuilt = Rollups(recorder_db, tmp_path / "fresh.sqlite")
+    rebuilt.update()
+    for table in recalc_rollup.PERIODS:
+        a = incremental.store.sums(STATISTIC_ID, recalc.TARIFF_ID, "0.3", table, "", "9")
+        b = rebuilt.store.sums(STATISTIC_ID, recalc.TARIFF_ID, "0.3", table, "", "9")
+        assert_same_sums(a, {k: tuple(v) for k, v in b.items()})
+    incremental.close()
+    rebuilt.close()
+
+
+def test_rewritten_history_rebuilds(recorder_db, tmp_path, capsys):
+    db = tmp_path / "rewritten.db"
+    shutil.copy(recorder_db, db)
+    store = tmp_path / "rollup.sqlite"
+    r = Rollups(db, store)
+    r.update()
+    r.close()
+
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "UPDATE statistics SET sum = sum + 5 WHERE metadata_id ="
+        " (SELECT id FROM statistics_meta WHERE statistic_id = ?)", (STATISTIC_ID,),
+    )
+    conn.commit()
+    conn.close()
+
+    r = Rollups(db, store)
+    r.update()
+    first, last = (recalc_rollup.parse_time(d) for d in ("2024-01-01", "2024-04-01"))
+    sums, _ = r.range(first, last)
+    r.close()
+    out, err = capsys.readouterr()
+    assert f"Rollup {CAP} kWh invalid (sum rewritten)" in err and "invalid" not in out
+    assert_same_sums(sums, brute_force(str(db), r.edges, first, last))
+
+
+def test_backfilled_tariff_rebuilds(recorder_db, tmp_path, capsys):
+    # Built while two days of prices were missing; they were imported later.
+    db = tmp_path / "gap.db"
+    shutil.copy(recorder_db, db)
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "DELETE FROM statistics WHERE metadata_id ="
+        " (SELECT id FROM statistics_meta WHERE statistic_id = ?)"
+        " AND start_ts >= ? AND start_ts < ?",
+        (recalc.TARIFF_ID, *(recalc_rollup.parse_time(d) for d in ("2024-02-10", "2024-02-12"))),
+    )
+    conn.commit()
+    conn.close()
+    first, last = (recalc_rollup.parse_time(d) for d in ("2024-01-01", "2024-04-01"))
+    store = tmp_path / "rollup.sqlite"
+    r = Rollups(db, store)
+    r.update()
+    stale, _ = r.range(first, last)
+    r.close()
+
+    r = Rollups(recorder_db, store)
+    r.update()
+    sums, _ = r.range(first, last)
+    r.close()
+    assert f"Rollup {CAP} kWh invalid (tariff history changed)" in capsys.readouterr().err
+    expected = brute_force(str(recorder_db), r.edges, first, last)
+    assert_same_sums(sums, expected)
+    no_tariff = recalc_rollup.NO_TARIFF
+    assert stale[no_tariff][0] > expected.get(no_tariff, (0,))[0]
+
+
+def test_rollups_of_an_older_version_are_dropped(recorder_db, tmp_path):
+    store = tmp_path / "rollup.sqlite"
+    conn = sqlite3.connect(store)
+    conn.execute("CREATE TABLE rollup_state (statistic_id TEXT NOT NULL, tariff_id TEXT"
+                 " NOT NULL, edges TEXT NOT NULL, metadata_id INTEGER NOT NULL,"
+                 " ts_first REAL, ts_last REAL, last_sum REAL,"
+                 " PRIMARY KEY (statistic_id, tariff_id, edges))")
+    conn.execute("CREATE TABLE rollup_day (statistic_id TEXT, tariff_id TEXT, edges TEXT,"
+                 " day TEXT, bucket INTEGER, hours INTEGER, kwh REAL, eur REAL)")
+    conn.execute("CREATE TABLE rollup_month (statistic_id TEXT, tariff_id TEXT, edges TEXT,"
+                 " month TEXT, bucket INTEGER, hours INTEGER, kwh REAL, eur REAL)")
+    conn.commit()
+    conn.close()
+    r = Rollups(recorder_db, store)
+    r.update()
+    first, last = (recalc_rollup.parse_time(d) for d in ("2024-01-01", "2024-04-01"))
+    sums, _ = r.range(first, last)
+    r.close()
+    assert_same_sums(sums, brute_force(str(recorder_db), r.edges, first, last))
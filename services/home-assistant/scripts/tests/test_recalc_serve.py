@@ -0,0 +1,164 @@
+"""Machine-readable output and the warm HTTP query service."""
+import csv
+import io
+import json
+import shutil
+import sqlite3
+import threading
+import urllib.request
+
+import pytest
+
+import recalc_self_consumption as recalc
+
+np = pytest.importorskip("numpy")
+import recalc_serve  # noqa: E402
+
+DAY = 24 * 3600
+
+
+def aggregate(db):
+    conn = recalc.connect_readonly(str(db))
+    cur = conn.cursor()
+    try:
+        return recalc.aggregate_python(cur, recalc.get_metadata_id(cur, recalc.TARIFF_ID))
+    finally:
+        conn.close()
+
+
+def assert_same_totals(actual, expected):
+    for key, value in expected.items():
+        assert actual[key] == pytest.approx(value, rel=1e-9, abs=1e-9), key
+
+
+@pytest.mark.parametrize("fmt", ["json", "csv"])
+def test_machine_readable_output(fmt, recorder_db, capsys):
+    recalc.main([str(recorder_db), "--format", fmt])
+    out, err = capsys.readouterr()
+    assert "Available relevant statistics" in err
+    rows = json.loads(out) if fmt == "json" else list(csv.DictReader(io.StringIO(out)))
+    expected = aggregate(recorder_db)
+    assert [int(row["battery_kwh"]) for row in rows] == sorted(expected)
+    for row in rows:
+        t = expected[int(row["battery_kwh"])]
+        assert float(row["total_eur"]) == pytest.approx(t["total_eur"], rel=1e-9)
+        assert int(row["hours_matched"]) == t["hours_matched"]
+
+
+def test_cache_totals_match_full_aggregation(recorder_db):
+    cache = recalc_serve.TotalsCache(str(recorder_db))
+    expected = aggregate(recorder_db)
+    totals = cache.totals()
+    assert totals.keys() == expected.keys()
+    for cap, t in expected.items():
+        assert_same_totals(totals[cap], t)
+
+
+def test_ranges_add_up(recorder_db):
+    cache = recalc_serve.TotalsCache(str(recorder_db))
+    full = cache.totals(caps=[30])[30]
+    middle = full["ts_first"] + 40 * DAY
+    before = cache.totals([30], end_ts=middle)[30]
+    after = cache.totals([30], start_ts=middle)[30]
+    assert before["n_rows"] + after["n_rows"] == full["n_rows"]
+    for key in ("total_kwh", "total_eur", "total_eur_high", "total_kwh_low", "hours_matched"):
+        assert before[key] + after[key] == pytest.approx(full[key], rel=1e-9)
+
+
+def test_other_threshold(recorder_db):
+    cache = recalc_serve.TotalsCache(str(recorder_db))
+    conn = recalc.connect_readonly(str(recorder_db))
+    cur = conn.cursor()
+    expected = recalc.aggregate_sql(cur, recalc.get_metadata_id(cur, recalc.TARIFF_ID), 0.2)
+    conn.close()
+    for cap, t in cache.totals(threshold=0.2).items():
+        assert_same_totals(t, expected[cap])
+
+
+def test_reloads_when_new_hour_appears(recorder_db, tmp_path):
+    db = tmp_path / "live.db"
+    shutil.copy(recorder_db, db)
+    cache = recalc_serve.TotalsCache(str(db), check_interval=0)
+    before = cache.totals([10])[10]
+    assert not cache.refresh()
+
+    conn = sqlite3.connect(db)
+    (meta_id,) = conn.execute(
+        "SELECT id FROM statistics_meta WHERE statistic_id = ?",
+        (recalc.ENERGY_OUT_PATTERN.format(cap=10),),
+    ).fetchone()
+    (last_ts, last_sum) = conn.execute(
+        "SELECT start_ts, sum FROM statistics WHERE metadata_id = ?"
+        " ORDER BY start_ts DESC LIMIT 1", (meta_id,),
+    ).fetchone()
+    conn.execute("INSERT INTO statistics (metadata_id, start_ts, sum) VALUES (?, ?, ?)",
+                 (meta_id, last_ts + 3600, (last_sum or 0) + 1.0))
+    conn.commit()
+    conn.close()
+
+    after = cache.totals([10])[10]
+    assert cache.loads == 2
+    assert after["n_rows"] == before["n_rows"] + 1
+    assert after["ts_last"] == last_ts + 3600
+
+
+def test_http_totals(recorder_db):
+    cache = recalc_serve.TotalsCache(str(recorder_db))
+    server = recalc_serve.make_server(cache, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{base}/totals?battery=20&from=2024-02-01&to=2024-02-29") as r:
+            body = json.load(r)
+        with urllib.request.urlopen(f"{base}/status") as r:
+            status = json.load(r)
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            urllib.request.urlopen(f"{base}/totals?from=february")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert exc.value.code == 400
+    assert list(body["batteries"]) == ["20"]
+    expected = cache.totals([20], recalc_serve.local_day_start("2024-02-01"),
+                            recalc_serve.local_day_start("2024-03-01"))[20]
+    assert body["batteries"]["20"] == expected
+    assert 0 < expected["n_rows"] <= 29 * 24
+    assert status["hours"]["20"] > expected["n_rows"]
+
+
+def test_http_unavailable_when_the_tariff_is_gone(recorder_db, tmp_path):
+    db = tmp_path / "purged.db"
+    shutil.copy(recorder_db, db)
+    conn = sqlite3.connect(db)
+    conn.execute("DELETE FROM statistics_meta WHERE statistic_id = ?", (recalc.TARIFF_ID,))
+    conn.commit()
+    conn.close()
+    cache = recalc_serve.TotalsCache(str(db))
+    missing = recalc_serve.TotalsCache(str(tmp_path / "missing.db"))
+
+    server = recalc_serve.make_server(cache, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    errors = []
+    try:
+        for cache_, path in ((cache, "/totals"), (cache, "/status"), (missing, "/totals")):
+            server.cache = cache_
+            with pytest.raises(urllib.error.HTTPError) as exc:
+                urllib.request.urlopen(f"{base}{path}?battery=10")
+            errors.append((exc.value.code, json.load(exc.value)["error"]))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert errors[0] == (503, f"no statistics for '{recalc.TARIFF_ID}'")
+    assert errors[1] == errors[0]                   # retried, not cached as empty
+    assert errors[2][0] == 503 and "unable to open" in errors[2][1]
+
+
+def test_main_exits_when_the_totals_cannot_be_loaded(tmp_path, capsys):
+    with pytest.raises(SystemExit) as exc:
+        recalc_serve.main([str(tmp_path / "missing.db"), "--port", "0"])
+    assert exc.value.code == 1
+    err = capsys.readouterr().err
+    assert err.startswith("ERROR: unable to open") and "Traceback" not in err
@@ -0,0 +1,109 @@
+"""Access to the live recorder: read-only connection and snapshot copies."""
+import shutil
+import sqlite3
+import threading
+
+import pytest
+
+import recalc_self_consumption as recalc
+
+
+@pytest.fixture
+def live_db(recorder_db, tmp_path):
+    """Copy of the recorder in WAL mode, like HA keeps it."""
+    db = tmp_path / "home-assistant_v2.db"
+    shutil.copy(recorder_db, db)
+    conn = sqlite3.connect(db)
+    assert conn.execute("PRAGMA journal_mode = WAL").fetchone() == ("wal",)
+    conn.close()
+    return db
+
+
+def count_rows(db):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM statistics").fetchone()[0]
+    finally:
+        conn.close()
+
+
+class Writer(threading.Thread):
+    """Stand-in for the HA recorder: commits a row at a time until stopped
+    (or after `limit` commits). timeout=0: any lock held by a reader fails."""
+
+    def __init__(self, db, limit=None):
+        super().__init__(daemon=True)
+        self.db = db
+        self.limit = limit
+        self.stop = threading.Event()
+        self.busy = threading.Event()
+        self.commits = 0
+        self.error = None
+
+    def run(self):
+        conn = sqlite3.connect(self.db, timeout=0)
+        try:
+            while not self.stop.is_set() and self.commits != self.limit:
+                conn.execute("INSERT INTO statistics (metadata_id, start_ts, sum)"
+                             " VALUES (-1, ?, 0)", (self.commits,))
+                conn.commit()
+                self.commits += 1
+                self.busy.set()
+        except sqlite3.Error as exc:
+            self.error = exc
+        finally:
+            conn.close()
+
+
+def test_readonly_connection_cannot_write(live_db):
+    conn = recalc.connect_readonly(str(live_db))
+    try:
+        assert conn.execute("PRAGMA query_only").fetchone() == (1,)
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM statistics")
+    finally:
+        conn.close()
+    assert count_rows(live_db) > 0
+
+
+def test_readonly_snapshot_does_not_block_the_writer(live_db):
+    # An open read transaction (one report) while the recorder keeps committing.
+    conn = recalc.connect_readonly(str(live_db))
+    conn.execute("BEGIN")
+    before = conn.execute("SELECT COUNT(*) FROM statistics").fetchone()[0]
+    writer = Writer(live_db, limit=20)
+    writer.start()
+    writer.join()
+    assert writer.error is None and writer.commits == 20
+    assert conn.execute("SELECT COUNT(*) FROM statistics").fetchone()[0] == before
+    conn.close()
+
+
+def test_snapshot_of_an_idle_recorder(live_db, tmp_path):
+    dest = tmp_path / "snapshot.db"
+    assert recalc.snapshot_copy(str(live_db), str(dest), pages=64) == 0
+    assert count_rows(dest) == count_rows(live_db)
+
+
+def test_snapshot_copies_the_rest_at_once_after_restarts(live_db, tmp_path):
+    # One page per step while the writer commits all the time: every step
+    # sees a changed source, so the copy only finishes through the fallback.
+    before = count_rows(live_db)
+    writer = Writer(live_db)
+    writer.start()
+    writer.busy.wait()
+    dest = tmp_path / "snapshot.db"
+    try:
+        restarts = recalc.snapshot_copy(str(live_db), str(dest), pages=1, sleep=0.001,
+                                        max_restarts=2)
+    finally:
+        writer.stop.set()
+        writer.join()
+    assert writer.error is None
+    assert restarts == 3                            # raised on the third: fallback ran
+
+    conn = sqlite3.connect(dest)
+    assert conn.execute("PRAGMA integrity_check").fetchall() == [("ok",)]
+    (copied,) = conn.execute("SELECT COUNT(*) FROM statistics").fetchone()
+    conn.close()
+    assert before <= copied <= count_rows(live_db)
@@ -0,0 +1,113 @@
+"""Sub-hourly aggregation (recalc_subhourly.py) against the hourly totals."""
+import os
+import subprocess
+import sys
+import tracemalloc
+
+import pytest
+
+import make_recorder_db
+import recalc_self_consumption as recalc
+import recalc_subhourly
+
+HOUR = 3600
+SUM_KEYS = ("total_kwh", "total_eur", "total_kwh_high", "total_eur_high",
+            "total_kwh_low", "total_eur_low")
+
+
+def make_db(path, fine_days, null_rate=0.0):
+    make_recorder_db.generate(str(path), years=30 / 365.25, fine_days=fine_days,
+                              null_rate=null_rate, seed=3)
+    return str(path)
+
+
+def open_db(path):
+    conn = recalc.connect_readonly(path)
+    cur = conn.cursor()
+    return conn, cur, recalc.get_metadata_id(cur, recalc.TARIFF_ID)
+
+
+@pytest.fixture(scope="module")
+def clean_db(tmp_path_factory):
+    return make_db(tmp_path_factory.mktemp("subhourly") / "clean.db", fine_days=3)
+
+
+def test_resolutions_report_same_totals(clean_db):
+    conn, cur, tariff_meta = open_db(clean_db)
+    (first_fine,) = cur.execute("SELECT MIN(start_ts) FROM statistics_short_term").fetchone()
+    caps = recalc.BATTERY_SIZES
+    # Anchor every resolution on the sum at the end of the first fine hour.
+    hourly = recalc.aggregate_sql(cur, tariff_meta, since=dict.fromkeys(caps, first_fine))
+    five_min = recalc_subhourly.aggregate_short_term(
+        cur, tariff_meta, since=dict.fromkeys(caps, first_fine + HOUR - 300)
+    )
+    states = recalc_subhourly.aggregate_states(
+        cur, tariff_meta, since=dict.fromkeys(caps, first_fine + HOUR)
+    )
+    conn.close()
+
+    for cap in caps:
+        assert hourly[cap]["total_kwh"] > 0
+        for key in SUM_KEYS:
+            assert five_min[cap][key] == pytest.approx(hourly[cap][key], rel=1e-9), (cap, key)
+            assert states[cap][key] == pytest.approx(hourly[cap][key], rel=1e-9), (cap, key)
+        assert five_min[cap]["hours_unmatched"] == states[cap]["hours_unmatched"] == 0
+
+
+def test_unavailable_states_are_skipped(tmp_path):
+    db = make_db(tmp_path / "nulls.db", fine_days=2, null_rate=0.05)
+    conn, cur, tariff_meta = open_db(db)
+    five_min = recalc_subhourly.aggregate_short_term(cur, tariff_meta)
+    states = recalc_subhourly.aggregate_states(cur, tariff_meta)
+    conn.close()
+    for cap in recalc.BATTERY_SIZES:
+        assert states[cap]["n_rows"] < five_min[cap]["n_rows"]
+        # A skipped sample only merges two deltas; the energy total is the same
+        # except for the first interval (no state at the window start).
+        assert states[cap]["total_kwh"] <= five_min[cap]["total_kwh"] + 1e-9
+
+
+def test_price_is_the_tariff_valid_at_each_event():
+    events = [(5, "a"), (10, "a"), (15, "a"), (40, "a")]
+    tariffs = [(10, 0.2), (30, 0.4)]
+    assert [e[-1] for e in recalc_subhourly.price(events, tariffs)] == [None, 0.2, 0.2, 0.4]
+    assert [e[-1] for e in recalc_subhourly.price(events, tariffs, max_age=0)] == [
+        None, 0.2, None, None,
+    ]
+
+
+def test_deltas_dated_at_interval_start():
+    samples = [(0, 1.0), (60, 1.5), (180, 2.5)]
+    assert list(recalc_subhourly.deltas(samples, "a")) == [
+        (0, "a", 0, None), (60, "a", 60, 0.5), (180, "a", 180, 1.0),
+    ]
+    assert [d[0] for d in recalc_subhourly.deltas(samples, "a", at_previous=True)] == [0, 0, 60]
+
+
+def _peak_bytes(db):
+    conn, cur, tariff_meta = open_db(db)
+    tracemalloc.start()
+    try:
+        recalc_subhourly.aggregate_states(cur, tariff_meta)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        conn.close()
+
+
+def test_state_pipeline_memory_is_flat(tmp_path, monkeypatch):
+    # Both histories span many fetch batches; peak memory is one batch per stream.
+    monkeypatch.setattr(recalc_subhourly, "FETCH_ROWS", 100)
+    small = _peak_bytes(make_db(tmp_path / "small.db", fine_days=2))
+    large = _peak_bytes(make_db(tmp_path / "large.db", fine_days=20))
+    assert large < small * 1.5
+
+
+def test_does_not_import_the_report_script():
+    # recalc_self_consumption.py imports this module for --resolution; importing
+    # it back would load a second copy of the script.
+    code = "import sys, recalc_subhourly; print('recalc_self_consumption' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code],
+                         cwd=os.path.dirname(recalc_subhourly.__file__),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "False"
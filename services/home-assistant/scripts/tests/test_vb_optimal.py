@@ -0,0 +1,102 @@
+"""Optimal dispatch (vb_optimal.py): hand-checked cases, brute force, heuristic."""
+import itertools
+
+import numpy as np
+import pytest
+
+import recalc_self_consumption as recalc
+import vb_optimal
+import vb_simulate
+
+
+def make_series(import_kwh, export_kwh, tariff):
+    """One local day of hourly data, every hour with a tariff."""
+    n = len(tariff)
+    return vb_simulate.Series(
+        start_ts=3600.0 * np.arange(n),
+        import_kwh=np.asarray(import_kwh, dtype=float),
+        export_kwh=np.asarray(export_kwh, dtype=float),
+        solar_kwh=np.zeros(n),
+        tariff=np.asarray(tariff, dtype=float),
+        has_tariff=np.ones(n, dtype=bool),
+        hour_of_day=np.arange(n),
+        day=np.zeros(n, dtype=np.int64),
+    )
+
+
+def test_discharges_into_the_most_expensive_hours():
+    series = make_series([0, 1, 1, 1], [3, 0, 0, 0], [0.10, 0.20, 0.50, 0.40])
+    kwargs = dict(capacities=[2], max_rate=5, min_soc=0, ev_daily=0, soc_step=0.5)
+    gross = vb_optimal.optimal_dispatch(series, objective="gross", **kwargs)
+    assert gross["total_eur"][0] == pytest.approx(0.9)
+    assert gross["energy_in"][0] == pytest.approx(2)
+    net = vb_optimal.optimal_dispatch(series, objective="net", feedin=0.07, **kwargs)
+    assert net["eur_self"][0] == pytest.approx(0.9 - 2 * 0.07)
+
+
+def test_ev_takes_its_share_of_the_export_first():
+    series = make_series([0, 0, 0], [2, 2, 2], [0.2, 0.2, 0.2])
+    available, ev = vb_optimal.ev_export(series, ev_daily=3)
+    assert ev.tolist() == [2, 1, 0]
+    assert available.tolist() == [0, 1, 2]
+
+
+def brute_force(series, capacity, max_rate, min_soc, soc_step, feedin):
+    """Best net value over every charge and discharge amount on the grid.
+
+    Independent of the closed-form split in vb_optimal: each hour tries every
+    (charge, discharge) pair of grid multiples within the rules. With import
+    and export on the grid too, the optimum is among them.
+    """
+    amounts = [k * soc_step for k in range(int(round(max_rate / soc_step)) + 1)]
+    best = -np.inf
+    for plan in itertools.product(itertools.product(amounts, amounts),
+                                  repeat=len(series.tariff)):
+        soc, total = 0.0, 0.0
+        for h, (charge, discharge) in enumerate(plan):
+            if (charge > series.export_kwh[h] + 1e-9 or charge > capacity - soc + 1e-9
+                    or discharge > series.import_kwh[h] + 1e-9
+                    or discharge > max(soc - min_soc, 0) + 1e-9):
+                break
+            total += discharge * series.tariff[h] - charge * feedin
+            soc += charge - discharge
+        else:
+            best = max(best, total)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    n = 5
+    # Import and export on the 0.5 kWh grid, so brute_force can reach the optimum.
+    series = make_series(rng.integers(0, 4, n) * 0.5 * (rng.random(n) < 0.7),
+                         rng.integers(0, 4, n) * 0.5 * (rng.random(n) < 0.5),
+                         rng.uniform(0.02, 0.45, n))
+    result = vb_optimal.optimal_dispatch(series, capacities=[1.5], max_rate=1.0,
+                                         min_soc=0.5, ev_daily=0, feedin=0.07,
+                                         soc_step=0.5)
+    expected = brute_force(series, 1.5, 1.0, 0.5, 0.5, 0.07)
+    assert result["eur_self"][0] == pytest.approx(expected, abs=1e-6)
+    assert result["value"][0] == pytest.approx(expected, abs=1e-4)
+
+
+@pytest.fixture(scope="module")
+def series(recorder_db):
+    conn = recalc.connect_readonly(str(recorder_db))
+    try:
+        return vb_simulate.load_series(conn.cursor())
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("objective", sorted(vb_optimal.OBJECTIVES))
+def test_optimum_beats_the_heuristic_for_every_battery_size(series, objective):
+    key = vb_optimal.OBJECTIVES[objective]
+    configs = vb_simulate.make_configs(capacity=recalc.BATTERY_SIZES)
+    heuristic = vb_simulate.simulate(series, configs)
+    optimal = vb_optimal.optimal_dispatch(series, recalc.BATTERY_SIZES, objective=objective)
+    assert np.all(optimal[key] >= heuristic[key])
+    assert optimal["value"] == pytest.approx(optimal[key], rel=1e-4)
+    # A bigger battery can always copy the smaller one's schedule.
+    assert np.all(np.diff(optimal[key]) >= -1e-6)
@@ -0,0 +1,87 @@
+"""Virtual battery replay (vb_simulate.py): the live rules on hand-checked series."""
+import numpy as np
+import pytest
+
+import vb_simulate
+
+
+def make_series(import_kwh, export_kwh, tariff, day=None):
+    """Hourly data; a None tariff is an hour without a recorded price."""
+    n = len(tariff)
+    day = np.zeros(n, dtype=np.int64) if day is None else np.asarray(day, dtype=np.int64)
+    has_tariff = np.array([price is not None for price in tariff])
+    day_start = np.searchsorted(day, day)
+    return vb_simulate.Series(
+        start_ts=3600.0 * np.arange(n),
+        import_kwh=np.asarray(import_kwh, dtype=float),
+        export_kwh=np.asarray(export_kwh, dtype=float),
+        solar_kwh=np.zeros(n),
+        tariff=np.array([vb_simulate.DEFAULT_TARIFF if p is None else p for p in tariff]),
+        has_tariff=has_tariff,
+        hour_of_day=np.arange(n) - day_start,
+        day=day,
+    )
+
+
+def run(series, **params):
+    """Totals of one configuration; the policy defaults let every discharge through."""
+    params = {"min_soc": 0, "discharge_min_price": 0, "discharge_top_percent": 100,
+              "ev_daily_kwh": 0, **params}
+    configs = vb_simulate.make_configs(**{k: [v] for k, v in params.items()})
+    results = vb_simulate.simulate(series, configs, feedin=0.07)
+    return {key: results[key][0] for key in vb_simulate.RESULT_KEYS}
+
+
+def test_max_rate_limits_charge_and_discharge():
+    series = make_series([0, 10, 10], [10, 0, 0], [0.1, 0.3, 0.3])
+    totals = run(series, capacity=10, max_rate=3)
+    assert totals["energy_in"] == 3                 # 10 kWh exported, 3 kW charger
+    assert totals["energy_out"] == 3                # 3 this hour, nothing left after
+    assert totals["total_eur"] == pytest.approx(0.9)
+    assert totals["eur_self"] == pytest.approx(0.9 - 3 * 0.07)
+    assert totals["eur_export"] == pytest.approx(7 * 0.07)
+
+
+def test_discharge_stops_at_min_soc_and_charge_at_capacity():
+    series = make_series([0, 0, 4, 4], [4, 4, 0, 0], [0.1, 0.1, 0.3, 0.3])
+    totals = run(series, capacity=6, max_rate=5, min_soc=2)
+    assert totals["energy_in"] == 6                 # full after 4 + 2
+    assert totals["energy_out"] == 4                # down to the 2 kWh floor at once
+    assert totals["hours_matched"] == 1             # then nothing is left above it
+
+
+def test_discharge_needs_min_price_and_top_percent():
+    # Top 50 % of the rest of the day: [0.1, 0.2, 0.3, 0.4] -> 0.3 at first,
+    # [0.2, 0.3, 0.4] -> 0.3 at 0.3, [0.2, 0.4] -> 0.4 at 0.2, and 0.4 last.
+    series = make_series([0, 1, 1, 1], [5, 0, 0, 0], [0.1, 0.3, 0.2, 0.4])
+    thresholds = vb_simulate.top_percent_thresholds(series, [50])[:, 0]
+    assert thresholds.tolist() == [0.3, 0.3, 0.4, 0.4]
+
+    top = run(series, capacity=10, max_rate=5, discharge_top_percent=50)
+    assert top["energy_out"] == 2 and top["total_eur"] == pytest.approx(0.7)
+    both = run(series, capacity=10, max_rate=5, discharge_top_percent=50,
+               discharge_min_price=0.35)
+    assert both["energy_out"] == 1 and both["total_eur"] == pytest.approx(0.4)
+    assert both["total_kwh_high"] == 1 and both["total_kwh_low"] == 0
+
+
+def test_ev_takes_its_daily_share_of_the_export_first():
+    series = make_series([0, 0, 0, 0], [2, 2, 2, 2], [0.1] * 4, day=[0, 0, 1, 1])
+    totals = run(series, capacity=10, max_rate=5, ev_daily_kwh=3)
+    assert totals["ev_kwh"] == 6                    # 3 kWh on each day
+    assert totals["energy_in"] == 2                 # what is left: 1 kWh per day
+
+
+def test_hours_without_a_tariff_leave_the_top_percent_cut_off():
+    # The hour without a price must not count as DEFAULT_TARIFF: the rest of
+    # the day from 0.3 is [0.3, 0.4], so top 50 % means 0.4.
+    series = make_series([0, 1, 1, 1], [5, 0, 0, 0], [0.1, 0.3, None, 0.4])
+    thresholds = vb_simulate.top_percent_thresholds(series, [50])[:, 0]
+    assert thresholds[1] == 0.4
+    # Nothing priced after the last real hour: no top-% limit, only the min price.
+    tail = make_series([1, 1], [0, 0], [0.3, None])
+    assert vb_simulate.top_percent_thresholds(tail, [50])[1, 0] == -np.inf
+
+    totals = run(series, capacity=10, max_rate=5, discharge_top_percent=50)
+    assert totals["hours_matched"] == 1             # 0.4 only
+    assert totals["hours_unmatched"] == 0           # 0.25 fallback < 0.4
@@ -0,0 +1,80 @@
+"""Parallel parameter sweep (vb_sweep.py): value ranges, shared memory, ranking."""
+import csv
+
+import numpy as np
+import pytest
+
+import recalc_self_consumption as recalc
+import vb_simulate
+import vb_sweep
+
+
+@pytest.fixture(scope="module")
+def series(recorder_db):
+    conn = recalc.connect_readonly(str(recorder_db))
+    try:
+        return vb_simulate.load_series(conn.cursor())
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("0.1", [0.1]),
+    ("5:40:5", [5, 10, 15, 20, 25, 30, 35, 40]),
+    ("0.10:0.30:0.05", [0.1, 0.15, 0.2, 0.25, 0.3]),   # stop kept despite float steps
+    ("20:75:25", [20, 45, 70]),
+])
+def test_parse_values(text, expected):
+    assert vb_sweep.parse_values(text) == expected
+
+
+def test_worker_maps_the_shared_series_read_only(series):
+    shm, layout = vb_sweep.share_series(series)
+    try:
+        vb_sweep._init_worker(shm.name, layout)
+        shared = vb_sweep._series
+        for name in vb_simulate.Series._fields:
+            np.testing.assert_array_equal(getattr(shared, name), getattr(series, name))
+            assert getattr(shared, name).dtype == getattr(series, name).dtype
+        with pytest.raises(ValueError):
+            shared.tariff[0] = 1.0
+    finally:
+        vb_sweep._series = None
+        vb_sweep._shm.close()
+        shm.close()
+        shm.unlink()
+
+
+def test_sweep_matches_simulate_and_ranks(series):
+    configs = vb_simulate.make_configs(capacity=[5, 10, 20], max_rate=[2.5, 5],
+                                       discharge_top_percent=[20, 50, 80])
+    results = vb_sweep.sweep(series, configs, workers=2)
+    expected = vb_simulate.simulate(series, configs)
+    assert results.keys() == expected.keys()
+    for key in vb_simulate.RESULT_KEYS:
+        np.testing.assert_allclose(results[key], expected[key], rtol=1e-12, err_msg=key)
+
+    rows = list(vb_sweep.ranked_rows(configs, results))
+    assert [row["rank"] for row in rows] == list(range(1, 19))
+    assert [row["eur_saved"] for row in rows] == sorted(expected["total_eur"], reverse=True)
+    for row in rows:
+        i = next(i for i in range(18) if all(configs[k][i] == row[k] for k in vb_simulate.DEFAULTS))
+        assert row["eur_self"] == expected["eur_self"][i]
+    net = list(vb_sweep.ranked_rows(configs, results, "net"))
+    assert net[0]["eur_saved"] == max(expected["eur_self"])
+
+
+def test_main_writes_the_ranked_table(recorder_db, tmp_path, capsys):
+    output = tmp_path / "sweep.csv"
+    vb_sweep.main([str(recorder_db), "--capacity", "5:15:5", "--max-rate", "2.5", "5",
+                   "--workers", "2", "--output", str(output), "--top", "3"])
+    out = capsys.readouterr().out
+    assert out.startswith("6 configuraties")
+    with open(output) as f:
+        rows = list(csv.DictReader(f))
+    assert sorted({(float(r["capacity"]), float(r["max_rate"])) for r in rows}) == [
+        (c, r) for c in (5, 10, 15) for r in (2.5, 5)
+    ]
+    eur = [float(r["eur_saved"]) for r in rows]
+    assert eur == sorted(eur, reverse=True)
+    assert "   1. " in out and "   4. " not in out
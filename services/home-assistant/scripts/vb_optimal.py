@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Optimal virtual battery dispatch: what the discharge heuristic could have earned.
+
+The live policy (config/packages/virtual_battery.yaml, replayed by
+vb_simulate.py) is a heuristic: discharge when the price is above a minimum
+and in the top-% of the rest of the day. This computes the best possible
+charge/discharge schedule over the same hourly statistics and rules, with
+perfect knowledge of every future price, import and export:
+
+  * the virtual EV takes its daily share of the export first (as simulate),
+  * charge only from the remaining export, discharge only into the import,
+    both at most max_rate per hour, SoC between min_soc and the capacity,
+  * objective "net" (default) = discharge × tariff − charge × feed-in, i.e.
+    vb_simulate's eur_self; "gross" = discharge × tariff over the hours with a
+    recorded tariff, i.e. the total_eur that recalc_self_consumption.py reports.
+
+Dynamic programming over the SoC discretized in --soc-step kWh, backwards over
+the hours. Per hour the value of every (battery size, SoC, SoC change) is one
+NumPy array; for a given SoC change the best split into charge and discharge
+follows in closed form (discharge as much as possible when the tariff is above
+the feed-in, else as little), so only the SoC change is searched, and only
+within what that hour's import/export allows. A forward pass replays the
+chosen schedule for the same totals as vb_simulate.
+
+The schedule is a real one on the SoC grid, so its value is a lower bound on
+the continuous optimum, and the reported gap a lower bound on what the
+heuristic leaves on the table: energy below one step per hour stays unused.
+That shortfall about halves with every halving of --soc-step (and the run
+time doubles); a year of hours for the four BATTERY_SIZES takes ~4 s at the
+default step.
+
+Run on Mars: python3 vb_optimal.py [path_to_db] [--capacity 10 20 30 40]
+                                   [--objective net|gross] [--soc-step 0.05]
+                                   [--cache [PATH]]
+Needs numpy (shipped with Home Assistant).
+"""
+
+import argparse
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import recalc_cache
+import vb_simulate
+from recalc_common import (
+    BATTERY_SIZES,
+    DEFAULT_DB_PATH,
+    PRICE_THRESHOLD,
+    connect_readonly,
+)
+
+OBJECTIVES = {
+    "net": "eur_self",    # minus the feed-in revenue given up to charge
+    "gross": "total_eur",  # avoided grid import, as recalc_self_consumption.py
+}
+SOC_STEP = 0.05  # kWh
+EPS = 1e-9
+
+
+def ev_export(series, ev_daily):
+    """(export left for the battery, EV kWh) per hour, as in simulate()."""
+    export = series.export_kwh
+    before = np.cumsum(export) - export
+    day_first = np.searchsorted(series.day, series.day)  # days are runs on the axis
+    before -= before[day_first]
+    ev = np.minimum(export, np.maximum(ev_daily - before, 0.0))
+    return export - ev, ev
+
+
+def _prices(series, objective, feedin):
+    """(price of a discharged kWh, cost of a charged kWh) per hour."""
+    if objective == "gross":
+        return np.where(series.has_tariff, series.tariff, 0.0), 0.0
+    return series.tariff, feedin
+
+
+def _discharge(d_room, c_room, delta, price, cost):
+    """Best discharge for each SoC change, and whether the change is feasible.
+
+    charge − discharge = delta with 0 <= discharge <= d_room and
+    0 <= charge <= c_room. The value discharge × (price − cost) − delta × cost
+    is linear in the discharge: take the most when price > cost, else the least.
+    """
+    d_hi = np.minimum(d_room, c_room - delta)
+    d_lo = np.maximum(-delta, 0.0)
+    feasible = d_hi >= d_lo - EPS
+    return (d_hi if price > cost else np.broadcast_to(d_lo, d_hi.shape)), feasible
+
+
+def optimal_dispatch(series, capacities=BATTERY_SIZES, max_rate=5.0, min_soc=1.0,
+                     ev_daily=5.0, feedin=vb_simulate.FEEDIN_TARIFF, objective="net",
+                     soc_step=SOC_STEP, threshold=PRICE_THRESHOLD):
+    """Best schedule for every capacity at once.
+
+    Returns a dict of per-capacity total arrays keyed like
+    vb_simulate.RESULT_KEYS, plus "value" (the optimized objective).
+    """
+    capacities = np.asarray(capacities, dtype=float)
+    n_hours, n_sizes = len(series.start_ts), len(capacities)
+    levels = np.floor(capacities / soc_step + EPS).astype(np.int64)
+    soc = np.arange(levels.max() + 1) * soc_step
+    # Charge room per state; negative above a smaller battery's top level,
+    # which makes every move from there infeasible.
+    headroom = np.where(soc[None, :] <= capacities[:, None] + EPS,
+                        capacities[:, None] - soc[None, :], -np.inf)
+    above_min = np.maximum(soc - min_soc, 0.0)
+
+    export, ev = ev_export(series, ev_daily)
+    c_max = np.minimum(export, max_rate)
+    d_max = np.minimum(series.import_kwh, max_rate)
+    k_up = np.floor(c_max / soc_step + EPS).astype(np.int64)
+    k_down = np.floor(d_max / soc_step + EPS).astype(np.int64)
+    price, cost = _prices(series, objective, feedin)
+
+    step_type = np.int8 if max(k_up.max(), k_down.max()) < 128 else np.int16
+    policy = np.zeros((n_hours, n_sizes, len(soc)), dtype=step_type)
+    # The value row sits in a buffer with -inf margins, so the value of the
+    # next state s + k is a window view for every k, without copies.
+    margin = int(max(k_up.max(), k_down.max()))
+    buffer = np.full((n_sizes, len(soc) + 2 * margin), -np.inf, dtype=np.float32)
+    value = buffer[:, margin:margin + len(soc)]
+    value[np.isfinite(headroom)] = 0.0
+    headroom, above_min = headroom.astype(np.float32), above_min.astype(np.float32)
+    for h in range(n_hours - 1, -1, -1):
+        if k_up[h] == k_down[h] == 0 and min(c_max[h], d_max[h]) == 0:
+            continue   # nothing to charge or discharge: value and policy stay
+        k = np.arange(-k_down[h], k_up[h] + 1)
+        delta = (k * soc_step).astype(np.float32)
+        c_room = np.minimum(np.float32(c_max[h]), headroom)[:, :, None]
+        d_room = np.minimum(np.float32(d_max[h]), above_min)[None, :, None]
+        d, feasible = _discharge(d_room, c_room, delta, price[h], cost)
+        q = d * np.float32(price[h] - cost) - delta * np.float32(cost)
+        window = buffer[:, margin - k_down[h]:margin + len(soc) + k_up[h]]
+        q += sliding_window_view(window, len(k), axis=1)
+        q[~feasible] = -np.inf
+        best = q.argmax(axis=2)
+        value[:] = np.take_along_axis(q, best[:, :, None], axis=2)[:, :, 0]
+        policy[h] = k[best]
+
+    totals = {key: np.zeros(n_sizes) for key in vb_simulate.RESULT_KEYS}
+    totals["value"] = value[:, 0]   # starts empty, like simulate()
+    state = np.zeros(n_sizes, dtype=np.int64)
+    sizes = np.arange(n_sizes)
+    for h in range(n_hours):
+        k = policy[h, sizes, state].astype(np.int64)
+        delta = k * soc_step
+        s = soc[state]
+        c_room = np.minimum(c_max[h], capacities - s)
+        d_room = np.minimum(d_max[h], np.maximum(s - min_soc, 0.0))
+        dp, _ = _discharge(d_room, c_room, delta, price[h], cost)
+        dp = np.maximum(dp, 0.0)
+        cp = np.maximum(delta + dp, 0.0)
+        state += k
+        _accumulate(totals, series, h, cp, dp, export[h], ev[h], feedin, threshold)
+    return totals
+
+
+def _accumulate(totals, series, h, cp, dp, export, ev, feedin, threshold):
+    """Add one hour to the totals, exactly as vb_simulate.simulate() does."""
+    price = series.tariff[h]
+    totals["energy_in"] += cp
+    totals["energy_out"] += dp
+    totals["ev_kwh"] += ev
+    totals["eur_self"] += dp * price - cp * feedin
+    totals["eur_export"] += (export - cp) * feedin
+    discharged = dp > 0
+    if not series.has_tariff[h]:
+        totals["hours_unmatched"] += discharged
+        return
+    totals["hours_matched"] += discharged
+    totals["total_kwh"] += dp
+    totals["total_eur"] += dp * price
+    side = "high" if price >= threshold else "low"
+    totals[f"total_kwh_{side}"] += dp
+    totals[f"total_eur_{side}"] += dp * price
+
+
+def compare(series, capacities, args):
+    """Heuristic (vb_simulate) and optimal totals for the same batteries."""
+    configs = vb_simulate.make_configs(
+        capacity=list(capacities), max_rate=[args.max_rate], min_soc=[args.min_soc],
+        discharge_min_price=[args.discharge_min_price],
+        discharge_top_percent=[args.discharge_top_percent],
+        ev_daily_kwh=[args.ev_daily_kwh],
+    )
+    heuristic = vb_simulate.simulate(series, configs, feedin=args.feedin)
+    started = time.perf_counter()
+    optimal = optimal_dispatch(
+        series, capacities, max_rate=args.max_rate, min_soc=args.min_soc,
+        ev_daily=args.ev_daily_kwh, feedin=args.feedin, objective=args.objective,
+        soc_step=args.soc_step,
+    )
+    return heuristic, optimal, time.perf_counter() - started
+
+
+def print_comparison(capacities, heuristic, optimal, objective):
+    key = OBJECTIVES[objective]
+    print(f"{'kWh':>5} {'heuristiek':>12} {'optimaal':>12} {'verschil':>10} {'%':>6}"
+          f" {'cycli h/o':>12}")
+    for i, cap in enumerate(capacities):
+        h_eur, o_eur = heuristic[key][i], optimal[key][i]
+        gap = o_eur - h_eur
+        pct = 100 * gap / o_eur if o_eur else 0.0
+        cycles = f"{heuristic['energy_out'][i] / cap:.0f}/{optimal['energy_out'][i] / cap:.0f}"
+        print(f"{cap:>5g} {h_eur:>12.2f} {o_eur:>12.2f} {gap:>10.2f} {pct:>6.1f} {cycles:>12}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Optimal virtual battery dispatch vs the live heuristic."
+    )
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH,
+                        help=f"recorder database (default: {DEFAULT_DB_PATH})")
+    parser.add_argument("--capacity", type=float, nargs="+", default=BATTERY_SIZES,
+                        metavar="KWH", help=f"battery sizes (default: {BATTERY_SIZES})")
+    for name in ("max_rate", "min_soc", "discharge_min_price", "discharge_top_percent",
+                 "ev_daily_kwh"):
+        default = vb_simulate.DEFAULTS[name]
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, type=float,
+                            default=default, metavar="X", help=f"(default: {default:g})")
+    parser.add_argument("--feedin", type=float, default=vb_simulate.FEEDIN_TARIFF,
+                        help=f"feed-in tariff EUR/kWh (default: {vb_simulate.FEEDIN_TARIFF})")
+    parser.add_argument("--objective", choices=sorted(OBJECTIVES), default="net",
+                        help="net self-consumption (default) or gross avoided import")
+    parser.add_argument("--soc-step", type=float, default=SOC_STEP,
+                        help=f"SoC grid in kWh (default: {SOC_STEP})")
+    parser.add_argument("--cache", nargs="?", const="", metavar="PATH",
+                        help="read the statistics from the memory-mapped cache "
+                             "(default: <db>.recalc-cache), see recalc_cache.py")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    conn = connect_readonly(args.db)
+    try:
+        series = vb_simulate.load_series(conn.cursor(),
+                                         cache=recalc_cache.open_cache(args.db, args.cache))
+    except LookupError as exc:
+        print(f"ERROR: {exc}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    first = datetime.fromtimestamp(series.start_ts[0], tz=timezone.utc)
+    last = datetime.fromtimestamp(series.start_ts[-1], tz=timezone.utc)
+    print(f"Historie: {len(series.start_ts)} uren, {first:%Y-%m-%d} t/m {last:%Y-%m-%d}")
+    heuristic, optimal, elapsed = compare(series, args.capacity, args)
+    print(f"Optimale inzet ({args.objective}, SoC-stap {args.soc_step:g} kWh):"
+          f" {len(args.capacity)} batterijen in {elapsed:.1f} s\n")
+    print_comparison(args.capacity, heuristic, optimal, args.objective)
+
+
+if __name__ == "__main__":
+    main()
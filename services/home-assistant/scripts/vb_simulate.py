@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Offline virtual battery simulator: replay recorded HA history for any size.
+
+The live simulation (config/packages/virtual_battery.yaml) only exists for the
+fixed 10/20/30/40 kWh batteries. This replays the same rules over the hourly
+long-term statistics of the grid meter and the Zonneplan tariff, for any
+capacity / charge rate / discharge policy:
+
+  * virtual EV takes up to ev_daily_kwh per (local) day from the export first,
+  * charge from the remaining export, limited by max rate and headroom,
+  * discharge into the import, limited by max rate and min SoC, only when the
+    price is >= max(discharge min price, top-% price of the remaining hours
+    of the day),
+  * gross self-consumption = discharge × tariff (what recalc_self_consumption.py
+    reports), net = gross − charge × feed-in tariff, export = rest × feed-in.
+
+Differences with the live automation, inherent to hourly statistics:
+  * one step per hour on hourly mean power instead of one per minute, so
+    import and export within the same hour are both seen in full,
+  * the feed-in tariff is a constant (--feedin); its forecast attribute is not
+    recorded in the statistics,
+  * the top-% threshold uses the recorded tariff of the rest of the day as the
+    forecast.
+
+All configurations are simulated together: the hour loop runs once and each
+step is a NumPy operation over the configuration vectors.
+
+Run on Mars: python3 vb_simulate.py [path_to_db] --capacity 10 15 20 --max-rate 5
+Every option takes several values; all combinations are simulated. With
+--cache [PATH] the statistics come from the memory-mapped cache of
+recalc_cache.py (updated with the new hours first) instead of the recorder.
+Needs numpy (shipped with Home Assistant).
+"""
+
+import argparse
+import itertools
+import sys
+from collections import namedtuple
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from recalc_common import (
+    DEFAULT_DB_PATH,
+    GRID_EXPORT_ID,
+    GRID_IMPORT_ID,
+    PRICE_THRESHOLD,
+    TARIFF_ID,
+    TIMEZONE,
+    connect_readonly,
+    get_hourly_rows,
+    get_metadata_ids,
+)
+from recalc_self_consumption import print_report
+
+HOUR = 3600
+
+# Fallbacks of the live automation (`| float(...)` defaults).
+DEFAULT_TARIFF = 0.25
+DEFAULTS = {
+    "capacity": 10.0,
+    "max_rate": 5.0,
+    "min_soc": 1.0,
+    "discharge_min_price": 0.15,
+    "discharge_top_percent": 50.0,
+    "ev_daily_kwh": 5.0,
+}
+FEEDIN_TARIFF = 0.07  # EUR/kWh, live fallback when there is no forecast
+
+# Hourly series on a gapless hourly axis. Missing grid hours are 0 kWh,
+# missing tariff hours use DEFAULT_TARIFF for decisions and are reported as
+# unmatched. solar_kwh is only informative (the rules use the grid meter).
+Series = namedtuple(
+    "Series",
+    "start_ts import_kwh export_kwh solar_kwh tariff has_tariff hour_of_day day",
+)
+
+RESULT_KEYS = (
+    "energy_in", "energy_out", "ev_kwh", "eur_self", "eur_export",
+    "hours_matched", "hours_unmatched", "total_kwh", "total_eur",
+    "total_kwh_high", "total_eur_high", "total_kwh_low", "total_eur_low",
+)
+
+
+def _hourly(cur, statistic_ids):
+    """{statistic_id: (start_ts, mean) arrays or None} from one index scan."""
+    meta_ids = get_metadata_ids(cur, statistic_ids)
+    rows = get_hourly_rows(cur, meta_ids.values()) if meta_ids else {}
+    data = {}
+    for statistic_id in statistic_ids:
+        if statistic_id not in meta_ids:
+            data[statistic_id] = None
+            continue
+        means = [(ts, mean) for ts, _, mean in rows[meta_ids[statistic_id]]]
+        means = np.array(means, dtype=float).reshape(-1, 2)
+        data[statistic_id] = (means[:, 0], means[:, 1])
+    return data
+
+
+def _on_axis(axis, data, scale=1.0):
+    """Values of data (start_ts, mean) on the hourly axis; NaN where missing."""
+    out = np.full(len(axis), np.nan)
+    if data is None or len(data[0]) == 0:
+        return out
+    start_ts, values = data
+    idx = np.round((start_ts - axis[0]) / HOUR).astype(np.int64)
+    ok = (idx >= 0) & (idx < len(axis))
+    out[idx[ok]] = values[ok] * scale
+    return out
+
+
+def load_series(cur, solar_id=None, tz=TIMEZONE, cache=None):
+    """Load grid, solar and tariff statistics once into aligned arrays.
+
+    With a recalc_cache.StatisticsCache the new hours are appended to the
+    cache and the statistics are read from its memory-mapped arrays.
+    """
+    ids = [GRID_IMPORT_ID, GRID_EXPORT_ID, TARIFF_ID] + ([solar_id] if solar_id else [])
+    if cache is None:
+        data = _hourly(cur, ids)
+    else:
+        cache.update(cur, ids)
+        data = cache.hourly(ids)
+    for statistic_id in ids[:3]:
+        if data[statistic_id] is None or len(data[statistic_id][0]) == 0:
+            raise LookupError(f"no statistics for '{statistic_id}'")
+    grid_import, grid_export, tariff = (data[i] for i in ids[:3])
+    solar = data[solar_id] if solar_id else None
+
+    first = min(grid_import[0][0], grid_export[0][0])
+    last = max(grid_import[0][-1], grid_export[0][-1])
+    axis = first + HOUR * np.arange(int(round((last - first) / HOUR)) + 1)
+
+    tariff_values = _on_axis(axis, tariff)
+    has_tariff = ~np.isnan(tariff_values)
+
+    zone = ZoneInfo(tz)
+    local = [datetime.fromtimestamp(ts, tz=zone) for ts in axis.tolist()]
+    _, day = np.unique([d.toordinal() for d in local], return_inverse=True)
+    day_start = np.searchsorted(day, day)  # axis is sorted, so days are runs
+
+    return Series(
+        start_ts=axis,
+        import_kwh=np.nan_to_num(_on_axis(axis, grid_import, 1 / 1000)),
+        export_kwh=np.nan_to_num(_on_axis(axis, grid_export, 1 / 1000)),
+        solar_kwh=np.nan_to_num(_on_axis(axis, solar, 1 / 1000)),
+        tariff=np.where(has_tariff, tariff_values, DEFAULT_TARIFF),
+        has_tariff=has_tariff,
+        hour_of_day=np.arange(len(axis)) - day_start,
+        day=day,
+    )
+
+
+def top_percent_thresholds(series, percents):
+    """Discharge price threshold per hour for each top-% value.
+
+    Mirrors the template: sort the prices of the remaining hours of today and
+    take index int((1 - pct/100) * n). Hours without a recorded tariff are left
+    out, as the template only sees real prices; with none left the threshold
+    is -inf (the template falls back to the min price). Returns shape
+    (n_hours, len(percents)).
+    """
+    n_days = int(series.day[-1]) + 1
+    width = int(series.hour_of_day.max()) + 1  # 25 on the DST day
+    prices = np.full((n_days, width), np.inf)
+    known = series.has_tariff
+    prices[series.day[known], series.hour_of_day[known]] = series.tariff[known]
+
+    # remaining[d, h, k] = price of hour k of day d if k >= h (else +inf),
+    # sorted ascending along k so the +inf padding ends up last.
+    k = np.arange(width)
+    remaining = np.where(k[None, :] >= k[:, None], prices[:, None, :], np.inf)
+    remaining.sort(axis=2)
+    # Real prices at hour h and later.
+    n_remaining = np.isfinite(prices)[:, ::-1].cumsum(axis=1)[:, ::-1]
+
+    percents = np.asarray(percents, dtype=float)
+    idx = ((1 - percents[None, None, :] / 100) * n_remaining[:, :, None]).astype(np.int64)
+    idx = np.clip(idx, 0, width - 1)
+    per_day = np.take_along_axis(remaining, idx, axis=2)  # (days, width, pct)
+    per_day = np.where(n_remaining[:, :, None] > 0, per_day, -np.inf)
+    return per_day[series.day, series.hour_of_day]
+
+
+def make_configs(**params):
+    """Cartesian product of parameter value lists -> dict of equal-length arrays."""
+    names = list(DEFAULTS)
+    values = [params.get(name) or [DEFAULTS[name]] for name in names]
+    combos = np.array(list(itertools.product(*values)), dtype=float).reshape(-1, len(names))
+    return {name: combos[:, i] for i, name in enumerate(names)}
+
+
+def simulate(series, configs, feedin=FEEDIN_TARIFF, threshold=PRICE_THRESHOLD):
+    """Replay the virtual battery rules for every configuration at once.
+
+    configs: dict of equal-length arrays keyed like DEFAULTS.
+    Returns a dict of per-configuration total arrays keyed by RESULT_KEYS.
+    """
+    capacity = np.asarray(configs["capacity"], dtype=float)
+    max_rate = np.asarray(configs["max_rate"], dtype=float)  # kW == kWh per hour
+    min_soc = np.asarray(configs["min_soc"], dtype=float)
+    min_price = np.asarray(configs["discharge_min_price"], dtype=float)
+    ev_daily = np.asarray(configs["ev_daily_kwh"], dtype=float)
+
+    percents, pct_idx = np.unique(configs["discharge_top_percent"], return_inverse=True)
+    top_thr = top_percent_thresholds(series, percents)
+    n = len(capacity)
+
+    stored = np.zeros(n)
+    ev_left = ev_daily.copy()
+    totals = {key: np.zeros(n) for key in RESULT_KEYS}
+    energy_in, energy_out = totals["energy_in"], totals["energy_out"]
+    ev_kwh, eur_self, eur_export = totals["ev_kwh"], totals["eur_self"], totals["eur_export"]
+
+    prev_day = series.day[0]
+    for h in range(len(series.start_ts)):
+        if series.day[h] != prev_day:
+            prev_day = series.day[h]
+            ev_left[:] = ev_daily
+        price = series.tariff[h]
+        imp = series.import_kwh[h]
+        exp = series.export_kwh[h]
+
+        ev = np.minimum(exp, ev_left) if exp > 0 else 0.0
+        ev_left -= ev
+        export = np.maximum(exp - ev, 0.0)
+
+        cp = np.where(export > 0, np.minimum(np.minimum(export, max_rate), capacity - stored), 0.0)
+        cp = np.maximum(cp, 0.0)
+        if imp > 0:
+            can = price >= np.maximum(min_price, top_thr[h, pct_idx])
+            dp = np.where(can, np.minimum(np.minimum(imp, max_rate), stored - min_soc), 0.0)
+            dp = np.maximum(dp, 0.0)
+        else:
+            dp = np.zeros(n)
+        stored = np.clip(stored + cp - dp, 0.0, capacity)
+
+        energy_in += cp
+        energy_out += dp
+        ev_kwh += ev
+        eur_self += dp * price - cp * feedin
+        eur_export += (export - cp) * feedin
+
+        discharged = dp > 0
+        if not series.has_tariff[h]:
+            totals["hours_unmatched"] += discharged
+            continue
+        totals["hours_matched"] += discharged
+        totals["total_kwh"] += dp
+        totals["total_eur"] += dp * price
+        side = "high" if price >= threshold else "low"
+        totals[f"total_kwh_{side}"] += dp
+        totals[f"total_eur_{side}"] += dp * price
+
+    return totals
+
+
+def config_label(configs, i):
+    return (
+        f"{configs['capacity'][i]:g} kWh, {configs['max_rate'][i]:g} kW,"
+        f" min SoC {configs['min_soc'][i]:g} kWh,"
+        f" ontladen >= {configs['discharge_min_price'][i]:g} EUR"
+        f" / top {configs['discharge_top_percent'][i]:g}%,"
+        f" EV {configs['ev_daily_kwh'][i]:g} kWh/dag"
+    )
+
+
+def print_simulation(series, configs, results, threshold=PRICE_THRESHOLD):
+    for i in range(len(configs["capacity"])):
+        totals = {key: results[key][i] for key in RESULT_KEYS}
+        totals["hours_matched"] = int(totals["hours_matched"])
+        totals["hours_unmatched"] = int(totals["hours_unmatched"])
+        totals["ts_first"] = series.start_ts[0]
+        totals["ts_last"] = series.start_ts[-1]
+        print(f"# {config_label(configs, i)}")
+        print_report(f"{configs['capacity'][i]:g}", totals, threshold)
+        print(f"Geladen:                {totals['energy_in']:>8.2f} kWh")
+        print(f"Virtuele EV:            {totals['ev_kwh']:>8.2f} kWh")
+        print(f"Netto zelfconsumptie:   {totals['eur_self']:>8.2f} EUR")
+        print(f"Verkoop overschot:      {totals['eur_export']:>8.2f} EUR")
+        print()
+
+
+def add_config_arguments(parser, value_type=float):
+    for name, default in DEFAULTS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, type=value_type,
+                            nargs="+", metavar="X", help=f"(default: {default:g})")
+    parser.add_argument("--feedin", type=float, default=FEEDIN_TARIFF,
+                        help=f"feed-in tariff EUR/kWh (default: {FEEDIN_TARIFF})")
+    parser.add_argument("--solar-id", help="optional solar production statistic_id")
+    parser.add_argument("--cache", nargs="?", const="", metavar="PATH",
+                        help="read the statistics from the memory-mapped cache "
+                             "(default: <db>.recalc-cache), see recalc_cache.py")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay the virtual battery rules over recorded HA statistics."
+    )
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH,
+                        help=f"recorder database (default: {DEFAULT_DB_PATH})")
+    add_config_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    import recalc_cache
+
+    conn = connect_readonly(args.db)
+    try:
+        series = load_series(conn.cursor(), args.solar_id,
+                             cache=recalc_cache.open_cache(args.db, args.cache))
+    except LookupError as exc:
+        print(f"ERROR: {exc}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    first = datetime.fromtimestamp(series.start_ts[0], tz=timezone.utc)
+    last = datetime.fromtimestamp(series.start_ts[-1], tz=timezone.utc)
+    print(f"Historie: {len(series.start_ts)} uren, {first:%Y-%m-%d} t/m {last:%Y-%m-%d}")
+    print(f"Netafname {series.import_kwh.sum():.0f} kWh, teruglevering "
+          f"{series.export_kwh.sum():.0f} kWh, zon {series.solar_kwh.sum():.0f} kWh\n")
+
+    configs = make_configs(**{name: getattr(args, name) for name in DEFAULTS})
+    results = simulate(series, configs, feedin=args.feedin)
+    print_simulation(series, configs, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Parallel parameter sweep over virtual battery size and discharge policy.
+
+Loads the hourly statistics once (see vb_simulate.py), places the arrays in
+one shared memory block that the worker processes map read-only, and fans
+the configurations out over a process pool in chunks. Each worker replays its
+chunk with vb_simulate.simulate(), so only the small configuration and
+result vectors are pickled.
+
+Writes a CSV table ranked by EUR saved and prints the top rows.
+
+Run on Mars:
+  python3 vb_sweep.py [path_to_db] --capacity 5:40:5 --max-rate 2.5 5 7.5 \\
+      --discharge-min-price 0.10:0.30:0.05 --discharge-top-percent 20:80:10 \\
+      --output sweep.csv
+Values are lists and/or inclusive start:stop:step ranges; all combinations
+are simulated. --workers defaults to all cores.
+"""
+
+import argparse
+import csv
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import recalc_cache
+import vb_simulate
+from recalc_common import DEFAULT_DB_PATH, connect_readonly
+
+RANK_KEYS = {
+    "gross": "total_eur",  # avoided grid import, as recalc_self_consumption.py
+    "net": "eur_self",     # minus the feed-in revenue given up to charge
+}
+
+_series = None  # worker-side view of the shared arrays
+_shm = None
+
+
+def parse_values(text):
+    """'0.1' -> [0.1]; '5:40:5' -> [5, 10, ..., 40] (stop inclusive)."""
+    if ":" not in text:
+        return [float(text)]
+    start, stop, step = (float(part) for part in text.split(":"))
+    count = int(math.floor((stop - start) / step + 1e-9)) + 1
+    return [round(start + i * step, 10) for i in range(count)]
+
+
+def share_series(series):
+    """Copy the series into one shared memory block; returns (shm, layout)."""
+    layout = []
+    offset = 0
+    for name, array in zip(series._fields, series):
+        offset = -(-offset // 8) * 8  # keep every array 8-byte aligned
+        layout.append((name, array.dtype.str, offset, len(array)))
+        offset += array.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (name, dtype, start, length), array in zip(layout, series):
+        np.ndarray(length, dtype, buffer=shm.buf, offset=start)[:] = array
+    return shm, layout
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track=; the parent owns and unlinks the block.
+        return shared_memory.SharedMemory(name=name)
+
+
+def _init_worker(shm_name, layout):
+    global _series, _shm
+    _shm = _attach(shm_name)
+    arrays = {}
+    for name, dtype, offset, length in layout:
+        array = np.ndarray(length, dtype, buffer=_shm.buf, offset=offset)
+        array.flags.writeable = False
+        arrays[name] = array
+    _series = vb_simulate.Series(**arrays)
+
+
+def _run_chunk(configs, feedin):
+    return vb_simulate.simulate(_series, configs, feedin=feedin)
+
+
+def sweep(series, configs, workers=None, feedin=vb_simulate.FEEDIN_TARIFF):
+    """Simulate all configurations over a process pool; returns merged totals."""
+    n = len(configs["capacity"])
+    workers = max(1, min(workers or os.cpu_count() or 1, n))
+    bounds = np.linspace(0, n, workers + 1).astype(int)
+    chunks = [
+        {name: values[lo:hi] for name, values in configs.items()}
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+
+    shm, layout = share_series(series)
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(shm.name, layout)) as pool:
+            parts = list(pool.map(_run_chunk, chunks, [feedin] * len(chunks)))
+    finally:
+        shm.close()
+        shm.unlink()
+    return {key: np.concatenate([p[key] for p in parts]) for key in vb_simulate.RESULT_KEYS}
+
+
+def ranked_rows(configs, results, rank_by="gross"):
+    order = np.argsort(-results[RANK_KEYS[rank_by]], kind="stable")
+    for rank, i in enumerate(order, start=1):
+        row = {"rank": rank}
+        row.update({name: float(configs[name][i]) for name in vb_simulate.DEFAULTS})
+        row["eur_saved"] = float(results[RANK_KEYS[rank_by]][i])
+        row.update({key: float(results[key][i]) for key in vb_simulate.RESULT_KEYS})
+        row["cycles"] = row["energy_out"] / row["capacity"] if row["capacity"] else 0.0
+        yield row
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parallel virtual battery parameter sweep over HA statistics."
+    )
+    parser.add_argument("db", nargs="?", default=DEFAULT_DB_PATH,
+                        help=f"recorder database (default: {DEFAULT_DB_PATH})")
+    vb_simulate.add_config_arguments(parser, value_type=parse_values)
+    parser.add_argument("--workers", type=int, help="processes (default: all cores)")
+    parser.add_argument("--rank-by", choices=sorted(RANK_KEYS), default="gross",
+                        help="gross (avoided import, default) or net self-consumption")
+    parser.add_argument("--output", default="vb_sweep.csv",
+                        help="ranked results table (default: vb_sweep.csv)")
+    parser.add_argument("--top", type=int, default=10, help="rows to print (default: 10)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    conn = connect_readonly(args.db)
+    try:
+        series = vb_simulate.load_series(conn.cursor(), args.solar_id,
+                                         cache=recalc_cache.open_cache(args.db, args.cache))
+    except LookupError as exc:
+        print(f"ERROR: {exc}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    params = {}
+    for name in vb_simulate.DEFAULTS:
+        values = getattr(args, name)
+        params[name] = [v for group in values for v in group] if values else None
+    configs = vb_simulate.make_configs(**params)
+
+    print(f"{len(configs['capacity'])} configuraties over {len(series.start_ts)} uren")
+    results = sweep(series, configs, workers=args.workers, feedin=args.feedin)
+
+    rows = list(ranked_rows(configs, results, args.rank_by))
+    write_csv(args.output, rows)
+    print(f"Resultaten: {args.output}\n")
+    for row in rows[:args.top]:
+        label = vb_simulate.config_label({k: [row[k]] for k in vb_simulate.DEFAULTS}, 0)
+        print(f"{row['rank']:>4}. {row['eur_saved']:>9.2f} EUR  {label}")
+
+
+if __name__ == "__main__":
+    main()